@@ -0,0 +1,93 @@
+import argparse
+import numpy as np
+from time import time
+from nn.net import ClassifierNetwork
+from nn.classifierUtils import createClassMap, createDenseClassMap
+from nn.profiler import setupLogging
+
+def benchmarkClassMap(network, image, step, batchSize) :
+    '''Build the class map and return the elapsed time with the results.
+
+       return : (seconds, windowsPerSecond, classifications, confidence)
+    '''
+    timer = time()
+    classifications, confidence = createClassMap(network, image, step,
+                                                 batchSize)
+    elapsed = time() - timer
+    return elapsed, classifications.size / elapsed, \
+           classifications, confidence
+
+def benchmarkDenseClassMap(network, image, tileSize) :
+    '''Build the class map with the fully-convolutional network.
+
+       return : (seconds, windowsPerSecond, classifications, confidence)
+    '''
+    timer = time()
+    classifications, confidence = createDenseClassMap(network, image,
+                                                      tileSize)
+    elapsed = time() - timer
+    return elapsed, classifications.size / elapsed, \
+           classifications, confidence
+
+'''This application compares the throughput of createClassMap when each window
+   is classified with its own network call (the original per-pixel loop)
+   against packing the windows into full mini-batches, and against the
+   fully-convolutional dense network. The resulting maps are verified to
+   match.
+'''
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', dest='logfile', type=str, default=None,
+                        help='Specify log output file.')
+    parser.add_argument('--level', dest='level', default='INFO', type=str,
+                        help='Log Level.')
+    parser.add_argument('--syn', dest='synapse', type=str, required=True,
+                        help='Load from a previously saved network.')
+    parser.add_argument('--step', dest='step', type=int, default=1,
+                        help='Number of pixels between classified windows.')
+    parser.add_argument('--size', dest='size', type=int, nargs=2,
+                        default=[256, 256],
+                        help='Synthetic scene size (rows, cols) when no ' +
+                             'image is specified.')
+    parser.add_argument('--skipLoop', dest='skipLoop', action='store_true',
+                        help='Skip the per-window baseline.')
+    parser.add_argument('--tile', dest='tileSize', type=int, default=256,
+                        help='Tile size for the dense network.')
+    parser.add_argument('image', nargs='?', default=None,
+                        help='Image to classify')
+    options = parser.parse_args()
+
+    log = setupLogging('classMapBenchmark', options.level, options.logfile)
+    network = ClassifierNetwork(options.synapse)
+    numChannels = network.getNetworkInputSize()[1]
+
+    # setup the scene
+    if options.image is not None :
+        from dataset.reader import readImage
+        image = readImage(options.image, log)
+    else :
+        import theano
+        image = np.random.RandomState(0).uniform(
+            size=[numChannels] + options.size).astype(theano.config.floatX)
+
+    elapsed, rate, batchClass, batchConf = benchmarkClassMap(
+        network, image, options.step, None)
+    log.info('Batched - ' + str(elapsed) + 's - ' + str(rate) + ' windows/s')
+
+    if not options.skipLoop :
+        elapsed, rate, loopClass, loopConf = benchmarkClassMap(
+            network, image, options.step, 1)
+        log.info('Per-window - ' + str(elapsed) + 's - ' + str(rate) +
+                 ' windows/s')
+        if not np.array_equal(loopClass, batchClass) or \
+           not np.allclose(loopConf, batchConf, atol=1e-5) :
+            log.warn('The batched class map differs from the per-window map.')
+
+    if options.step == 1 :
+        elapsed, rate, denseClass, denseConf = benchmarkDenseClassMap(
+            network, image, options.tileSize)
+        log.info('Dense - ' + str(elapsed) + 's - ' + str(rate) +
+                 ' windows/s')
+        if not np.array_equal(denseClass, batchClass) or \
+           not np.allclose(denseConf, batchConf, atol=1e-5) :
+            log.warn('The dense class map differs from the batched map.')
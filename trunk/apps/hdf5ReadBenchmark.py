@@ -0,0 +1,96 @@
+import argparse
+import os
+import tempfile
+import numpy as np
+from time import time
+from dataset.hdf5 import createHDF5Unlabeled, readHDF5
+from nn.profiler import setupLogging
+
+# layouts to compare -- (name, chunks, compression, shuffle)
+layouts = [('contiguous', False, None, False),
+           ('chunked', True, None, False),
+           ('chunked-lzf', True, 'lzf', True),
+           ('chunked-gzip', True, 'gzip', True)]
+
+def createSynthetic(dataShape, dtype, rng) :
+    '''Create a mini-batch of imagery resembling 8-bit normalized chips. Pure
+       noise would be incompressible, which misrepresents real archives.
+    '''
+    return (rng.randint(0, 256, size=dataShape[1:]) / 255.).astype(dtype)
+
+def writeLayout(outputFile, source, numBatches, layout, log) :
+    '''Write the source batches into a new file with the specified layout.'''
+    name, chunks, compression, shuffle = layout
+    handleH5, dataH5 = createHDF5Unlabeled(
+        outputFile, [numBatches] + list(source(0).shape), source(0).dtype,
+        log=log, chunks=chunks, compression=compression, shuffle=shuffle)
+    for ii in range(numBatches) :
+        dataH5[ii] = source(ii)
+    handleH5.flush()
+    handleH5.close()
+
+def readEpoch(inFile, order, cacheSize) :
+    '''Read each batch in the specified order and return the read MB/s.'''
+    (dataH5, _), _, _ = readHDF5(inFile, cacheSize=cacheSize)
+    batchBytes = np.prod(dataH5.shape[1:]) * dataH5.dtype.itemsize
+    timer = time()
+    for ii in order :
+        dataH5[ii]
+    elapsed = time() - timer
+    dataH5.file.close()
+    return len(order) * batchBytes / elapsed / (1024. * 1024.)
+
+'''This application benchmarks the mini-batch read throughput of the HDF5
+   layouts available in dataset.hdf5. Each layout is read using a sequential
+   epoch and a shuffled epoch access pattern.
+
+   NOTE: The operating system page cache will satisfy repeat reads. Use a
+         dataset larger than RAM, or drop the caches between runs, to measure
+         disk-backed throughput.
+'''
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', dest='logfile', type=str, default=None,
+                        help='Specify log output file.')
+    parser.add_argument('--level', dest='level', default='INFO', type=str,
+                        help='Log Level.')
+    parser.add_argument('--batches', dest='numBatches', type=int, default=200,
+                        help='Number of synthetic batches to create.')
+    parser.add_argument('--shape', dest='shape', type=int, nargs=4,
+                        default=[50, 3, 64, 64],
+                        help='Synthetic batch shape (batch, chan, row, col).')
+    parser.add_argument('--cache', dest='cacheSize', type=int, default=None,
+                        help='Chunk cache size in bytes for readHDF5.')
+    parser.add_argument('--dir', dest='dir', type=str, default=None,
+                        help='Directory for the scratch files.')
+    parser.add_argument('--data', dest='data', type=str, default=None,
+                        help='Optional HDF5 archive to use as the source.')
+    options = parser.parse_args()
+
+    log = setupLogging('hdf5ReadBenchmark', options.level, options.logfile)
+    rng = np.random.RandomState(0)
+
+    # setup the source of the batches
+    if options.data is not None :
+        (srcH5, _), _, _ = readHDF5(options.data, log)
+        numBatches = srcH5.shape[0]
+        source = lambda ii : srcH5[ii]
+    else :
+        numBatches = options.numBatches
+        batch = createSynthetic([numBatches] + options.shape, 'float32', rng)
+        source = lambda ii : batch
+
+    sequential = list(range(numBatches))
+    shuffled = rng.permutation(numBatches)
+    scratch = tempfile.mkdtemp(dir=options.dir)
+    for layout in layouts :
+        outputFile = os.path.join(scratch, layout[0] + '.hdf5')
+        writeLayout(outputFile, source, numBatches, layout, log)
+        sizeMB = os.path.getsize(outputFile) / (1024. * 1024.)
+        seq = readEpoch(outputFile, sequential, options.cacheSize)
+        shuf = readEpoch(outputFile, shuffled, options.cacheSize)
+        log.info('Layout [' + layout[0] + '] - ' + str(sizeMB) + ' MB - ' +
+                 'sequential ' + str(seq) + ' MB/s - ' +
+                 'shuffled ' + str(shuf) + ' MB/s')
+        os.remove(outputFile)
+    os.rmdir(scratch)
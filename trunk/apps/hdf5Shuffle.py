@@ -0,0 +1,34 @@
+import argparse
+import numpy as np
+from time import time
+from dataset.shuffle import hdf5Shuffle
+from nn.profiler import setupLogging
+
+'''This application shuffles the training examples of a HDF5 dataset in place.
+   The examples are permuted across mini-batches with a bounded amount of
+   memory, so it can be used on datasets far larger than RAM.
+'''
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', dest='logfile', type=str, default=None,
+                        help='Specify log output file.')
+    parser.add_argument('--level', dest='level', default='INFO', type=str,
+                        help='Log Level.')
+    parser.add_argument('--memory', dest='memory', type=float, default=1.,
+                        help='Memory budget of the shuffle in GBs.')
+    parser.add_argument('--tmp', dest='tmpDir', type=str, default=None,
+                        help='Directory for the temporary bucket file.')
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help='Random seed of the permutation.')
+    parser.add_argument('data', help='HDF5 file to shuffle')
+    options = parser.parse_args()
+
+    log = setupLogging('hdf5Shuffle: ' + options.data, options.level,
+                       options.logfile)
+
+    timer = time()
+    hdf5Shuffle(options.data, memory=int(options.memory * 2**30),
+                tmpDir=options.tmpDir,
+                rng=np.random.RandomState(options.seed), log=log)
+    log.info('Shuffled [' + options.data + '] in ' + str(time() - timer) +
+             's')
@@ -0,0 +1,73 @@
+import argparse
+import os
+import tempfile
+from time import time
+from dataset.ingest.labeled import readAndDivideData, readDataset
+from dataset.reader import getImageDims
+from dataset.hdf5 import createHDF5Unlabeled
+from nn.profiler import setupLogging
+
+def benchmarkEngine(engine, images, imageShape, batchSize, workers, log) :
+    '''Ingest the imagery into a scratch HDF5 using the specified engine.
+
+       return : (seconds, imagesPerSecond)
+    '''
+    import theano
+    outputFile = os.path.join(tempfile.mkdtemp(), engine + '.hdf5')
+    trainShape = [len(images) // batchSize, batchSize] + list(imageShape)
+    handleH5, dataH5 = createHDF5Unlabeled(outputFile, trainShape,
+                                           theano.config.floatX, log=log)
+    try :
+        timer = time()
+        readDataset(dataH5, images, trainShape, batchSize, workers, log,
+                    engine)
+        handleH5.flush()
+        elapsed = time() - timer
+    finally :
+        handleH5.close()
+        os.remove(outputFile)
+        os.rmdir(os.path.dirname(outputFile))
+    return elapsed, float(trainShape[0] * batchSize) / elapsed
+
+'''This application compares the throughput of the threaded and process-pool
+   ingest engines on a labeled directory structure. The imagery is written to
+   a scratch HDF5 which is removed after each run.
+'''
+if __name__ == '__main__' :
+    from multiprocessing import cpu_count
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', dest='logfile', type=str, default=None,
+                        help='Specify log output file.')
+    parser.add_argument('--level', dest='level', default='INFO', type=str,
+                        help='Log Level.')
+    parser.add_argument('--batch', dest='batchSize', type=int, default=50,
+                        help='Batch size for the ingest.')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        default=cpu_count(),
+                        help='Number of threads or processes to decode with.')
+    parser.add_argument('--limit', dest='limit', type=int, default=None,
+                        help='Maximum number of images to ingest.')
+    parser.add_argument('--engine', dest='engine', type=str, nargs='+',
+                        default=['thread', 'process'],
+                        help='Ingest engines to benchmark.')
+    parser.add_argument('data', help='Directory of labeled imagery.')
+    options = parser.parse_args()
+
+    # setup the logger
+    log = setupLogging('ingestBenchmark: ' + options.data,
+                       options.level, options.logfile)
+
+    # gather the imagery -- the holdout is unnecessary for this test
+    images = list(readAndDivideData(os.path.abspath(options.data),
+                                    0., 0, log)[0].paths)
+    if options.limit is not None :
+        images = images[:options.limit]
+    imageShape = getImageDims(images[0], log)
+
+    for engine in options.engine :
+        elapsed, rate = benchmarkEngine(engine, images, imageShape,
+                                        options.batchSize, options.workers,
+                                        log)
+        log.info('Engine [' + engine + '] - ' + str(elapsed) + 's - ' +
+                 str(rate) + ' images/s')
@@ -16,6 +16,7 @@ network = None
 likeness = None
 chips = None
 regions = None
+encodings = None
 likenessVector = None
 
 def convertImageToNP(image) :
@@ -28,7 +29,7 @@ def convertImageToNP(image) :
 def selectRegion (event, x, y, flags, param) :
     if event == cv2.EVENT_LBUTTONDBLCLK :
         # record the mouse click
-        global refLocation, referenceVector, likenessVector, chips, regions
+        global refLocation, referenceVector, likenessVector
         halfBox = options.chipSize / 2
 
         # chip and find the reference encoded vector
@@ -39,26 +40,35 @@ def selectRegion (event, x, y, flags, param) :
                  refLocation[1][0], refLocation[1][1]))),
                 (1, options.chipSize*options.chipSize)))[1][0]
 
-        # run against the entire image
-        likenessVector = []
-        for ii in range(chips.shape[0]) :
-
-            '''
-            # show progress by highlighting areas we've ran
-            draw.rectangle([(regions[ii][0][0],regions[ii][0][1]),
-                            (regions[ii][0][2],regions[ii][0][3])], 
-                           fill=(0,255,255,100))
-            cv2.imshow(windowName, np.array(thumb))
-            '''
-
-            # run the chip
-            matchVector = network.classifyAndSoftmax(chips[ii])[1][0]
-            likenessVector.append((np.dot(referenceVector, matchVector),
-                                   regions[ii][0]))
-
-        # sort so we can display the top choices
-        likenessVector = sorted(likenessVector, key=lambda tup: tup[0],
-                                reverse=True)
+        # run against the entire image --
+        # the chips were encoded up front, so this is a single matrix-vector
+        # product, and only the top matches are sorted for display.
+        likeness = np.dot(encodings, referenceVector)
+        top = topMatches(likeness, options.matches)
+        likenessVector = list(zip(likeness[top], regions[top]))
+
+def topMatches(likeness, numMatches) :
+    '''Return the indices of the most alike chips, ordered high to low.'''
+    numMatches = max(1, min(numMatches, likeness.size))
+    top = np.argpartition(-likeness, numMatches - 1)[:numMatches]
+    return top[np.argsort(-likeness[top], kind='mergesort')]
+
+def encodeChips(network, chips) :
+    '''Encode every chip of the image into one contiguous matrix.
+
+       network : Network used to encode the chips
+       chips   : Batched chips (numBatches, batchSize, chipSize*chipSize)
+       return  : numpy.ndarray (numBatches * batchSize, numFeatures)
+    '''
+    batchSize = chips.shape[1]
+    first = network.classifyAndSoftmax(chips[0])[1]
+    encoded = np.ndarray((chips.shape[0] * batchSize, first.shape[1]),
+                         dtype=first.dtype)
+    encoded[:batchSize] = first
+    for ii in range(1, chips.shape[0]) :
+        encoded[ii*batchSize:(ii+1)*batchSize] = \
+            network.classifyAndSoftmax(chips[ii])[1]
+    return encoded
 
 def subdivideImage(image, chipSize, stepFactor=1, 
                    batchSize=1, shuffle=False, log=None) :
@@ -100,7 +110,7 @@ def subdivideImage(image, chipSize, stepFactor=1,
 
 def createNetwork(image, log=None) :
     from nn.net import ClassifierNetwork
-    global chips, regions
+    global chips, regions, encodings
 
     # divide the image into chips
     chips, regions = subdivideImage(image, options.chipSize, 5,
@@ -226,6 +236,12 @@ def createNetwork(image, log=None) :
         # cast to the correct network type
         network.__class__ = ClassifierNetwork
 
+    # encode the entire image once, so each selection only ranks the chips
+    if log is not None :
+        log.info('Encoding the Chips...')
+    encodings = encodeChips(network, chips)
+    regions = np.reshape(regions, (-1, regions.shape[-1]))
+
     return network
 
 
@@ -262,6 +278,8 @@ if __name__ == '__main__' :
                              'unsupervised pre-training.')
     parser.add_argument('--batch', dest='batchSize', type=int, default=1,
                         help='Batch size for training and test sets.')
+    parser.add_argument('--matches', dest='matches', type=int, default=100,
+                        help='Number of most alike chips to rank.')
     parser.add_argument('--base', dest='base', type=str, default='./leNet5',
                         help='Base name of the network output and temp files.')
     parser.add_argument('image', help='Input image to train.')
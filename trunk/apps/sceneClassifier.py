@@ -0,0 +1,55 @@
+import argparse
+import numpy as np
+from multiprocessing import cpu_count
+from dataset.reader import normalize
+from nn.tileScheduler import classifyScene
+from nn.profiler import setupLogging
+
+'''This application classifies a large scene by dividing it into overlapping
+   tiles which are classified in a pool of worker processes. The confidence
+   map is optionally written as an 8-bit image, and the throughput in tiles
+   per second is reported.
+'''
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', dest='logfile', type=str, default=None,
+                        help='Specify log output file.')
+    parser.add_argument('--level', dest='level', default='INFO', type=str,
+                        help='Log Level.')
+    parser.add_argument('--syn', dest='synapse', type=str, required=True,
+                        help='Load from a previously saved network.')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        default=cpu_count(),
+                        help='Number of worker processes.')
+    parser.add_argument('--tile', dest='tileSize', type=int, default=256,
+                        help='Number of output pixels along a tile side.')
+    parser.add_argument('--dense', dest='dense', action='store_true',
+                        help='Classify using the fully-convolutional network.')
+    parser.add_argument('--stats', dest='stats', type=str, default=None,
+                        help='HDF5 dataset whose statistics standardize ' +
+                             'the scene, when built with dataset ' +
+                             'normalization.')
+    parser.add_argument('--out', dest='outFile', type=str, default=None,
+                        help='Output image of the confidence map.')
+    parser.add_argument('image', help='Image to classify')
+    options = parser.parse_args()
+
+    log = setupLogging('sceneClassifier: ' + options.image,
+                       options.level, options.logfile)
+
+    # the scene is handed over by path, so windowed formats are read by
+    # the workers a tile at a time
+    norm = 'image'
+    if options.stats is not None :
+        from dataset.statistics import loadStatistics
+        norm = loadStatistics(options.stats)
+    classification, confidence = classifyScene(
+        options.synapse, options.image, options.workers, options.tileSize,
+        options.dense, log, norm)
+
+    # write a product if it was asked for
+    if options.outFile is not None :
+        from PIL import Image
+        confidence = np.ndarray.astype(normalize(confidence) * 255,
+                                       dtype='uint8')
+        Image.fromarray(confidence, mode='L').save(options.outFile)
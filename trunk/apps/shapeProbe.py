@@ -0,0 +1,38 @@
+import argparse
+import os
+from time import time
+from dataset.scan import scanDirectory
+from dataset.reader import probeImageDims, shapeDistribution
+from nn.profiler import setupLogging
+
+'''This application reports the distribution of image shapes across a
+   directory tree. Only the image headers are read, which makes it practical
+   to choose a chip size on very large corpora.
+'''
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', dest='logfile', type=str, default=None,
+                        help='Specify log output file.')
+    parser.add_argument('--level', dest='level', default='INFO', type=str,
+                        help='Log Level.')
+    parser.add_argument('--sample', dest='sampleSize', type=int,
+                        default=None, help='Number of images to probe.')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help='Number of concurrent probes.')
+    parser.add_argument('data', help='Directory of imagery.')
+    options = parser.parse_args()
+
+    log = setupLogging('shapeProbe: ' + options.data, options.level,
+                       options.logfile)
+
+    images = [os.path.join(root, name) \
+              for root, names, sizes, mtimes in \
+                  scanDirectory(os.path.abspath(options.data), log=log) \
+              for name in names if not name.endswith('.hdf5')]
+
+    timer = time()
+    images, dims = probeImageDims(images, options.sampleSize,
+                                  options.workers, log)
+    log.info('Probed [' + str(len(images)) + '] images in ' +
+             str(time() - timer) + 's')
+    shapeDistribution(dims, log)
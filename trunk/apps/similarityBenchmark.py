@@ -0,0 +1,94 @@
+import argparse
+import numpy as np
+from time import time
+from ae.similarity import createIndex
+from nn.profiler import setupLogging
+
+def createSynthetic(numTargets, numQueries, numFeatures, numClusters, rng) :
+    '''Create clustered encodings. Real encodings are far from uniform, and
+       uniform noise would understate the recall of the partitioned indices.
+    '''
+    centers = rng.randn(numClusters, numFeatures)
+    def sample(num) :
+        return (centers[rng.randint(0, numClusters, num)] +
+                .5 * rng.randn(num, numFeatures)).astype(np.float32)
+    return sample(numTargets), sample(numQueries)
+
+def benchmarkIndex(indexType, targets, queries, k, truth, indexArgs) :
+    '''Build the index and query it.
+
+       return : (build seconds, query milliseconds per vector, recall@k)
+    '''
+    timer = time()
+    index = createIndex(targets, indexType, **indexArgs)
+    build = time() - timer
+
+    timer = time()
+    indices = index.query(queries, k)[0]
+    latency = (time() - timer) * 1000. / len(queries)
+
+    recall = np.mean([len(np.intersect1d(found, expected)) / float(k) \
+                      for found, expected in zip(indices, truth)])
+    return build, latency, recall
+
+'''This application measures the build time, query latency and recall of the
+   similarity indices in ae.similarity. The recall is measured against the
+   top-k of the exact index.
+'''
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', dest='logfile', type=str, default=None,
+                        help='Specify log output file.')
+    parser.add_argument('--level', dest='level', default='INFO', type=str,
+                        help='Log Level.')
+    parser.add_argument('--targets', dest='numTargets', type=int,
+                        default=200000, help='Number of synthetic targets.')
+    parser.add_argument('--queries', dest='numQueries', type=int,
+                        default=1000, help='Number of synthetic queries.')
+    parser.add_argument('--features', dest='numFeatures', type=int,
+                        default=128, help='Length of the encodings.')
+    parser.add_argument('--clusters', dest='numClusters', type=int,
+                        default=1000, help='Number of synthetic clusters.')
+    parser.add_argument('--k', dest='k', type=int, default=10,
+                        help='Number of neighbors per query.')
+    parser.add_argument('--probes', dest='numProbes', type=int, default=8,
+                        help='Number of partitions searched by the IVF index.')
+    parser.add_argument('--bits', dest='numBits', type=int, default=12,
+                        help='Number of projections per LSH table.')
+    parser.add_argument('--tables', dest='numTables', type=int, default=8,
+                        help='Number of LSH tables.')
+    parser.add_argument('--data', dest='data', type=str, default=None,
+                        help='Optional .npy file of target encodings. The ' +
+                             'queries are drawn from the targets.')
+    options = parser.parse_args()
+
+    log = setupLogging('similarityBenchmark', options.level, options.logfile)
+    rng = np.random.RandomState(0)
+
+    if options.data is not None :
+        targets = np.load(options.data, mmap_mode='r')
+        queries = np.asarray(targets[np.sort(rng.choice(
+            len(targets), options.numQueries, replace=False))])
+    else :
+        targets, queries = createSynthetic(
+            options.numTargets, options.numQueries, options.numFeatures,
+            options.numClusters, rng)
+
+    # the exact index establishes the ground truth
+    timer = time()
+    exact = createIndex(targets, 'exact')
+    truth = exact.query(queries, options.k)[0]
+    log.info('Index [exact] - ' + str(time() - timer) + 's to build and ' +
+             'query [' + str(len(targets)) + '] targets')
+
+    indexArgs = {'exact' : {},
+                 'ivf' : {'numProbes' : options.numProbes},
+                 'lsh' : {'numBits' : options.numBits,
+                          'numTables' : options.numTables}}
+    for indexType in ['exact', 'ivf', 'lsh'] :
+        build, latency, recall = benchmarkIndex(
+            indexType, targets, queries, options.k, truth,
+            indexArgs[indexType])
+        log.info('Index [' + indexType + '] - build ' + str(build) + 's - ' +
+                 str(latency) + ' ms/query - recall@' + str(options.k) +
+                 ' ' + str(recall))
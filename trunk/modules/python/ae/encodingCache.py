@@ -0,0 +1,139 @@
+import os
+import hashlib
+import numpy as np
+
+def networkHash(network) :
+    '''Hash the topology and weights of the network. Any change to the
+       synapse produces a different hash, so stale encodings are never used.
+    '''
+    sha = hashlib.sha1()
+    for layer in network._layers :
+        sha.update(type(layer).__name__.encode('utf-8'))
+        sha.update(str(layer.getInputSize()).encode('utf-8'))
+        for param in layer.getWeights() :
+            sha.update(np.ascontiguousarray(
+                param.get_value(borrow=True)).tobytes())
+    return sha.hexdigest()
+
+def directoryFingerprint(dirpath) :
+    '''Fingerprint the directory listing by name, size and modification time.
+       This does not read the file contents, so it is fast on large sets.
+    '''
+    sha = hashlib.sha1()
+    for name in sorted(os.listdir(dirpath)) :
+        st = os.stat(os.path.join(dirpath, name))
+        sha.update((name + ':' + str(st.st_size) + ':' +
+                    repr(st.st_mtime) + '\n').encode('utf-8'))
+    return sha.hexdigest()
+
+def arrayFingerprint(array) :
+    '''Fingerprint an in-memory target set by its contents.'''
+    array = np.ascontiguousarray(array)
+    sha = hashlib.sha1(str((array.shape, array.dtype.str)).encode('utf-8'))
+    sha.update(array.tobytes())
+    return sha.hexdigest()
+
+def cachePath(cacheDir, network, targetData) :
+    '''Return the cache file for the encodings of the target data. The
+       cache holds the encodings normalized to unit length, and the state of
+       the similarity indices built over them shares its key.
+
+       cacheDir   : Directory holding the cached encodings
+       network    : Network producing the encodings
+       targetData : Directory of target imagery or numpy.ndarray
+    '''
+    fingerprint = directoryFingerprint(targetData) \
+                  if isinstance(targetData, str) else \
+                  arrayFingerprint(targetData)
+    return os.path.join(cacheDir, networkHash(network) + '_' +
+                                  fingerprint + '_unit.npy')
+
+def indexPaths(filepath, indexType, indexArgs) :
+    '''Return the cache files of the similarity index state, keyed by the
+       state name, or None if the index cannot be cached. An index seeded
+       by a caller supplied generator cannot be identified, so it is always
+       rebuilt.
+
+       filepath  : Cache file of the encodings
+       indexType : 'exact', 'ivf' or 'lsh'
+       indexArgs : Dictionary of options for the similarity index
+    '''
+    from ae.similarity import indexTypes
+    if 'rng' in indexArgs :
+        return None
+    key = hashlib.sha1(repr((indexType, sorted(indexArgs.items())))
+                       .encode('utf-8')).hexdigest()
+    base = os.path.splitext(filepath)[0] + '_' + indexType + '_' + key
+    return dict((name, base + '_' + name + '.npy') \
+                for name in indexTypes[indexType].stateNames)
+
+def readEncodings(filepath, log=None) :
+    '''Memory map the cached encodings, or return None if not cached.'''
+    if not os.path.exists(filepath) :
+        return None
+    if log is not None :
+        log.info('Reading cached encodings [' + filepath + ']')
+    return np.load(filepath, mmap_mode='r')
+
+def readIndex(filepath, encodings, indexType, indexArgs, log=None) :
+    '''Restore the similarity index over the cached encodings from its
+       memory mapped state, or return None if it is not cached.
+
+       filepath  : Cache file of the encodings
+       encodings : Normalized encodings returned by readEncodings
+       indexType : 'exact', 'ivf' or 'lsh'
+       indexArgs : Dictionary of options for the similarity index
+    '''
+    from ae.similarity import createIndex
+    paths = indexPaths(filepath, indexType, indexArgs)
+    if paths is None or \
+       not all(os.path.exists(path) for path in paths.values()) :
+        return None
+    if log is not None :
+        log.info('Reading cached similarity index [' + indexType + ']')
+    state = dict((name, np.load(path, mmap_mode='r')) \
+                 for name, path in paths.items())
+    return createIndex(encodings, indexType, normalized=True, state=state,
+                       **indexArgs)
+
+def _writeArray(filepath, array) :
+    '''Write the array under a temporary name and rename it, so concurrent
+       processes never map a partially written cache.
+    '''
+    cacheDir = os.path.dirname(filepath)
+    if not os.path.exists(cacheDir) :
+        try :
+            os.makedirs(cacheDir)
+        except OSError :
+            # another process may have created it
+            if not os.path.isdir(cacheDir) :
+                raise
+    tmpFile = filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpFile, 'wb') as f :
+        np.save(f, np.ascontiguousarray(array))
+    os.rename(tmpFile, filepath)
+
+def writeEncodings(filepath, encodings, log=None) :
+    '''Write the normalized encodings to the cache.'''
+    if log is not None :
+        log.info('Writing cached encodings [' + filepath + ']')
+    _writeArray(filepath, encodings)
+
+def writeIndex(filepath, index, indexType, indexArgs, log=None) :
+    '''Write the state of the similarity index to the cache. The state is
+       written before readIndex can find every file, so a partial write is
+       rebuilt rather than used.
+
+       filepath  : Cache file of the encodings
+       index     : SimilarityIndex built over the cached encodings
+       indexType : 'exact', 'ivf' or 'lsh'
+       indexArgs : Dictionary of options for the similarity index
+    '''
+    paths = indexPaths(filepath, indexType, indexArgs)
+    if paths is None :
+        return
+    if log is not None :
+        log.info('Writing cached similarity index [' + indexType + ']')
+    state = index.getState()
+    for name, path in paths.items() :
+        _writeArray(path, state[name])
@@ -4,6 +4,7 @@ from nn.net import ClassifierNetwork
 from ae.encoder import AutoEncoder
 import numpy as np
 from dataset.shared import isShared
+from dataset.quantize import getQuantization, dequantizeVariable
 
 class SAENetwork (ClassifierNetwork) :
     '''The SAENetwork object allows autoencoders to be stacked such that the 
@@ -91,17 +92,27 @@ class ClassifierSAENetwork (SAENetwork) :
                   classification.
                   NOTE: This can either be an numpy.ndarray or a path to a
                         directory of target images.
-       filepath : Path to an already trained network on disk 
-                  'None' creates randomized weighting
-       prof     : Profiler to use
+       filepath  : Path to an already trained network on disk 
+                   'None' creates randomized weighting
+       prof      : Profiler to use
+       indexType : Similarity index over the target encodings. 'exact'
+                   searches all targets, while 'ivf' and 'lsh' are
+                   approximate. See ae.similarity.createIndex
+       indexArgs : Dictionary of options for the similarity index
+       cacheDir  : Directory to cache the encoded targets. The cache is keyed
+                   by the synapse and the target set, so it is reused across
+                   runs and processes. None disables the cache.
     '''
-    def __init__ (self, targetData, filepath=None, prof=None) :
+    def __init__ (self, targetData, filepath=None, prof=None,
+                  indexType='exact', indexArgs=None, cacheDir=None) :
         SAENetwork.__init__(self, filepath, prof)
 
-        # check if the data is currently in memory, if not read it
-        self._targetData = self.__readTargetData(targetData) \
-                           if isinstance(targetData, str) else \
-                           targetData
+        # a directory of targets is only read if the encodings are not
+        # already cached
+        self._targetData = targetData
+        self._cacheDir = cacheDir
+        self._indexType = indexType
+        self._indexArgs = {} if indexArgs is None else indexArgs
 
     def __getstate__(self) :
         '''Save network pickle'''
@@ -109,7 +120,7 @@ class ClassifierSAENetwork (SAENetwork) :
         # remove the training and test datasets before pickling. This both
         # saves disk space, and makes trained networks allow transfer learning
         dict['_targetData'] = None
-        if '_targetEncodings' in dict : del dict['_targetEncodings']
+        if '_targetIndex' in dict : del dict['_targetIndex']
         # remove the functions -- they will be rebuilt JIT
         if '_closeness' in dict : del dict['_closeness']
         return dict
@@ -132,39 +143,21 @@ class ClassifierSAENetwork (SAENetwork) :
         from dataset.minibatch import makeContiguous
         from dataset.reader import readImage
         return makeContiguous([(readImage(os.path.join(targetpath, im))) \
-                               for im in os.listdir(targetpath)])[0]
+                               for im in sorted(os.listdir(targetpath))])[0]
 
-    def finalizeNetwork(self, networkInput) :
-        '''Setup the network based on the current network configuration.
-           This creates several network-wide functions so they will be
-           pre-compiled and optimized when we need them.
-        '''
-        from theano import dot, function
-        from dataset.shared import toShared
+    def __encodeTargets(self, targetData, batchSize) :
+        '''Encode the target data and reduce it to the unique encodings.'''
         import numpy as np
 
-        if len(self._layers) == 0 :
-            raise IndexError('Network must have at least one layer' +
-                             'to call getNetworkInput().')
-
-        self._startProfile('Finalizing Network', 'info')
-
-        # disable the profiler temporarily so we don't get a second entry
-        tmp = self._profiler
-        self._profiler = None
-        SAENetwork.finalizeNetwork(self, networkInput)
-        self._profiler = tmp
-
         # ensure targetData is at least one batchSize, otherwise enlarge
-        batchSize = networkInput.shape.eval()[0]
-        numTargets = self._targetData.shape[0]
+        numTargets = targetData.shape[0]
         if numTargets < batchSize :
             # add rows of zeros to fill out the rest of the batch
-            self._targetData = np.resize(np.append(
+            targetData = np.resize(np.append(
                 np.zeros([batchSize-numTargets] +
-                         list(self._targetData.shape[1:]), 
-                         np.float32), self._targetData),
-                [batchSize] + list(self._targetData.shape[1:]))
+                         list(targetData.shape[1:]), 
+                         np.float32), targetData),
+                [batchSize] + list(targetData.shape[1:]))
 
         # produce the encoded feature matrix --
         # this matrix will be used for all closeness calculations
@@ -173,14 +166,14 @@ class ClassifierSAENetwork (SAENetwork) :
         enc = []
         for ii in range(int(numTargets / batchSize)) :
             enc.extend(self.encode(
-                self._targetData[ii*batchSize:(ii+1)*batchSize]))
+                targetData[ii*batchSize:(ii+1)*batchSize]))
 
         # run one last batch and collect the remainder --
         # this is also used if there is less than one batch worth of targets
         remainder = numTargets % batchSize
         if remainder > 0 :
             enc.extend(self.encode(
-                self._targetData[-batchSize:])[-remainder:])
+                targetData[-batchSize:])[-remainder:])
 
         # reduce the encodings to only check against unique vectors --
         # this is an optimization as many examples could be encoded to
@@ -190,23 +183,74 @@ class ClassifierSAENetwork (SAENetwork) :
             unique_a = np.unique(a.view([('', a.dtype)]*a.shape[1]))
             return unique_a.view(a.dtype).reshape((
                 unique_a.shape[0], a.shape[1]))
-        enc = uniqueRows(enc)
+        return uniqueRows(enc)
 
-        # NOTE: this is the transpose to orient for matrix multiplication
-        self._targetEncodings = toShared(enc, borrow=True).T
+    def finalizeNetwork(self, networkInput) :
+        '''Setup the network based on the current network configuration.
+           This creates several network-wide functions so they will be
+           pre-compiled and optimized when we need them.
+        '''
+        from theano import dot, function
+        from dataset.shared import toShared
+        from ae.similarity import createIndex, normalizeRows
+        from ae.encodingCache import cachePath, readEncodings, \
+                                     writeEncodings, readIndex, writeIndex
+
+        if len(self._layers) == 0 :
+            raise IndexError('Network must have at least one layer' +
+                             'to call getNetworkInput().')
+
+        self._startProfile('Finalizing Network', 'info')
+
+        # disable the profiler temporarily so we don't get a second entry
+        tmp = self._profiler
+        self._profiler = None
+        SAENetwork.finalizeNetwork(self, networkInput)
+        self._profiler = tmp
+
+        # reuse the normalized encodings if this synapse has seen these
+        # targets -- otherwise read and encode the targets, then populate
+        # the cache.
+        cacheFile = None if self._cacheDir is None else \
+                    cachePath(self._cacheDir, self, self._targetData)
+        enc = None if cacheFile is None else readEncodings(cacheFile)
+        if enc is None :
+            self._startProfile('Encoding the Target Data', 'info')
+            targetData = self.__readTargetData(self._targetData) \
+                         if isinstance(self._targetData, str) else \
+                         self._targetData
+            enc = normalizeRows(self.__encodeTargets(
+                targetData, networkInput.shape.eval()[0]))
+            if cacheFile is not None :
+                writeEncodings(cacheFile, enc)
+            self._endProfile()
+
+        # index the encodings for the nearest neighbor queries -- the index
+        # state is memory mapped from the cache alongside the encodings.
+        self._targetIndex = None if cacheFile is None else \
+                            readIndex(cacheFile, enc, self._indexType,
+                                      self._indexArgs)
+        if self._targetIndex is None :
+            self._targetIndex = createIndex(enc, self._indexType,
+                                            normalized=True,
+                                            **self._indexArgs)
+            if cacheFile is not None :
+                writeIndex(cacheFile, self._targetIndex, self._indexType,
+                           self._indexArgs)
 
         # TODO: Check if this should be the raw logit from the output layer or
         #       the softmax return of the output layer.
-        # TODO: This needs to be updated to handle matrix vs matrix cosine
-        #       similarities between all pairs of vectors
-        # setup the closeness execution graph based on target information
-        targets = t.fmatrix('targets')
+        # setup the closeness execution graph based on target information --
+        # the mean cosine similarity against every target is the cosine
+        # against the mean of the normalized targets, so the cost does not
+        # grow with the size of the target library. Each input is normalized
+        # by its own magnitude.
+        targets = toShared(self._targetIndex.getMeanVector(), borrow=True)
         outClass = self.getNetworkOutput()[0]
         cosineSimilarity = dot(outClass, targets) / \
-            (t.sqrt(t.sum(outClass**2)) * (t.sqrt(t.sum(targets**2))))
+            t.maximum(t.sqrt(t.sum(outClass**2, axis=1)), 1e-8)
         self._closeness = function([self.getNetworkInput()[0]],
-                                   t.mean(cosineSimilarity, axis=1),
-                                   givens={targets: self._targetEncodings})
+                                   cosineSimilarity)
         self._endProfile()
 
     def closeness(self, inputs, cosineVector=None) :
@@ -235,7 +279,7 @@ class ClassifierSAENetwork (SAENetwork) :
             inp = toShared(inputs, borrow=True) \
                   if not isShared(inputs) else inputs
             self.finalizeNetwork(inp[:])
-        if not hasattr(self, '_targetEncodings') :
+        if not hasattr(self, '_targetIndex') :
             raise ValueError('User must finalize the feature matrix before ' +
                              'attempting to finalize the network.')
 
@@ -247,6 +291,31 @@ class ClassifierSAENetwork (SAENetwork) :
         self._endProfile()
         return cosineVector
 
+    def neighbors(self, inputs, k=1) :
+        '''Find the most similar targets to each input. The encoded inputs
+           query the similarity index built over the unique target encodings.
+
+           inputs : Example imagery to test for closeness.
+                    (batchSize, numChannels, rows, cols)
+           k      : Number of neighbors to return for each input
+
+           return : (target indices, cosine similarities) each (batchSize, k)
+                    ordered from most to least similar. The indices refer
+                    to the rows of getTargetEncodings().
+        '''
+        self._startProfile('Finding Neighbors of Inputs', 'debug')
+        encodings = self.encode(inputs)
+        if not hasattr(self, '_targetIndex') :
+            raise ValueError('User must finalize the feature matrix before ' +
+                             'attempting to find neighbors.')
+        neighbors = self._targetIndex.query(encodings, k)
+        self._endProfile()
+        return neighbors
+
+    def getTargetEncodings(self) :
+        '''The unique, normalized target encodings held by the index.'''
+        return self._targetIndex.getVectors()
+
     def closenessAndEncoding (self, inputs) :
         '''This is a form of classification for SAE networks. The network has
            been provided a target input, which we now use to determine the
@@ -277,6 +346,8 @@ class TrainerSAENetwork (SAENetwork) :
 
        train    : theano.shared dataset used for network training in format --
                   (numBatches, batchSize, numChannels, rows, cols)
+                  A disk-backed dataset (ie. h5py.Dataset) is streamed onto
+                  the device through a rotating theano.shared window.
        regType  : type of regularization term to use
                   default None : perform no additional regularization
                   L1           : Least Absolute Deviation
@@ -286,17 +357,35 @@ class TrainerSAENetwork (SAENetwork) :
        filepath : Path to an already trained network on disk 
                   'None' creates randomized weighting
        prof     : Profiler to use
+       window   : Number of batches held on the device when train is not
+                  theano.shared
     '''
     def __init__ (self, train, regType='L2', regScaleFactor=0.,
-                  filepath=None, prof=None) :
+                  filepath=None, prof=None, window=16) :
         from nn.reg import Regularization
+        from dataset.shared import isShared
+        from dataset.window import SharedWindow
         SAENetwork.__init__ (self, filepath, prof)
         self._indexVar = t.lscalar('index')
         self._trainData = train[0] if isinstance(train, list) else train
-        self._numTrainBatches = self._trainData.shape.eval()[0]
+        if isShared(self._trainData) :
+            self._trainWindow = None
+            self._trainVar = self._trainData
+            self._numTrainBatches = self._trainData.shape.eval()[0]
+        else :
+            self._trainWindow = SharedWindow([self._trainData], window)
+            self._trainVar = self._trainWindow.variables[0]
+            self._numTrainBatches = self._trainWindow.getNumBatches()
         self._trainGreedy = []
         self._regularization = Regularization(regType, regScaleFactor)
 
+    def __trainBatch(self, index) :
+        '''The floatX training batch. Quantized data is transferred in its
+           stored type, and dequantized within the compiled functions.
+        '''
+        return dequantizeVariable(self._trainVar[index],
+                                  getQuantization(self._trainVar))
+
     def __buildEncoder(self) :
         '''Build the greedy-layerwise function --
            All layers start with the input original input, however are updated
@@ -311,7 +400,7 @@ class TrainerSAENetwork (SAENetwork) :
             self._trainGreedy.append(
                 theano.function([self._indexVar], out, updates=up,
                                 givens={self.getNetworkInput()[0] : 
-                                        self._trainData[self._indexVar]}))
+                                        self.__trainBatch(self._indexVar)}))
             self._endProfile()
 
     def __buildDecoder(self) :
@@ -360,7 +449,7 @@ class TrainerSAENetwork (SAENetwork) :
         self._trainNetwork = theano.function(
             [self._indexVar], costs, updates=updates, 
             givens={self.getNetworkInput()[0] : 
-                    self._trainData[self._indexVar]})
+                    self.__trainBatch(self._indexVar)})
             #mode=NanGuardMode(nan_is_error=True, inf_is_error=True,\
             #                   big_is_error=True))
         self._endProfile()
@@ -371,6 +460,8 @@ class TrainerSAENetwork (SAENetwork) :
         # remove the functions -- they will be rebuilt JIT
         if '_indexVar' in dict : del dict['_indexVar']
         if '_trainData' in dict : del dict['_trainData']
+        if '_trainVar' in dict : del dict['_trainVar']
+        if '_trainWindow' in dict : del dict['_trainWindow']
         if '_numTrainBatches' in dict : del dict['_numTrainBatches']
         if '_trainGreedy' in dict : del dict['_trainGreedy']
         if '_trainNetwork' in dict : del dict['_trainNetwork']
@@ -421,12 +512,16 @@ class TrainerSAENetwork (SAENetwork) :
                            '/' + str(self._numTrainBatches) + ']', 'debug')
         if not hasattr(self, '_trainGreedy') or \
            not hasattr(self, '_trainNetwork') :
-            self.finalizeNetwork(self._trainData[0])
+            self.finalizeNetwork(self.__trainBatch(0))
         if not isinstance(index, int) :
             raise Exception('Variable index must be an integer value')
         if index >= self._numTrainBatches :
             raise Exception('Variable index out of range for numBatches')
 
+        # map into the device-resident window when streaming from disk
+        if self._trainWindow is not None :
+            index = self._trainWindow.local(index)
+
         # train the input --
         # the user decides whether this will be a greedy or network training
         # by passing in a layer index. If the index does not have an associated
@@ -466,6 +561,10 @@ class TrainerSAENetwork (SAENetwork) :
                 costMessage += ' - Sparsity: ' + str(locCost[2])
             if len(locCost) == 4 :
                 costMessage += ' - Regularization: ' + str(locCost[3])
+            if self._trainWindow is not None :
+                costMessage += ' - Window Stall: ' + \
+                               str(self._trainWindow.stallTime) + 's'
+                self._trainWindow.resetStats()
             self._startProfile(costMessage, 'info')
             globCost.append(locCost)
             self._endProfile()
@@ -0,0 +1,306 @@
+import numpy as np
+
+def normalizeRows(vectors) :
+    '''Scale each row to unit length. Rows of zeros are left as zeros.
+
+       vectors : numpy.ndarray (numVectors, numFeatures)
+       return  : numpy.ndarray float32 copy of the normalized rows
+    '''
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+    norms[norms == 0.] = 1.
+    vectors /= norms[:, np.newaxis]
+    return vectors
+
+def mergeTopK(bestSims, bestIds, sims, ids, k) :
+    '''Merge a block of similarities into the running top-k.
+
+       bestSims : current best similarities (numQueries, k)
+       bestIds  : current best ids (numQueries, k)
+       sims     : block of similarities (numQueries, blockSize)
+       ids      : ids of the block (blockSize,) or (numQueries, blockSize)
+       return   : (bestSims, bestIds) unsorted
+    '''
+    ids = np.broadcast_to(ids, sims.shape)
+    sims = np.concatenate((bestSims, sims), axis=1)
+    ids = np.concatenate((bestIds, ids), axis=1)
+    if sims.shape[1] > k :
+        keep = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        rows = np.arange(sims.shape[0])[:, np.newaxis]
+        sims, ids = sims[rows, keep], ids[rows, keep]
+    return sims, ids
+
+def sortTopK(sims, ids) :
+    '''Order the top-k from most to least similar.'''
+    order = np.argsort(-sims, axis=1, kind='mergesort')
+    rows = np.arange(sims.shape[0])[:, np.newaxis]
+    return ids[rows, order], sims[rows, order]
+
+class SimilarityIndex () :
+    '''Cosine similarity index over a library of target vectors. Subclasses
+       trade exactness of the top-k neighbors for query speed.
+
+       The state built over the library is returned by getState, and may be
+       handed back to the constructor (ie. from ae.encodingCache) so the
+       index is not rebuilt.
+
+       vectors    : Target library (numTargets, numFeatures). The rows are
+                    normalized to unit length, so all similarities are
+                    cosine.
+       normalized : The rows are already unit length. They are then used
+                    as-is, so a memory mapped library is not copied.
+       state      : State returned by getState for this library, or None
+    '''
+    stateNames = ('mean',)
+
+    def __init__ (self, vectors, normalized=False, state=None) :
+        self._vectors = vectors if normalized else normalizeRows(vectors)
+        # the mean cosine against every target is the dot product with the
+        # mean of the normalized targets.
+        self._mean = self._vectors.mean(axis=0, dtype=np.float32) \
+                     if state is None else state['mean']
+
+    def getState(self) :
+        '''The arrays built over the library, keyed by stateNames.'''
+        return {'mean' : self._mean}
+
+    def __len__ (self) :
+        return self._vectors.shape[0]
+
+    def getNumFeatures(self) :
+        return self._vectors.shape[1]
+
+    def getVectors(self) :
+        '''The normalized target library (numTargets, numFeatures)'''
+        return self._vectors
+
+    def getMeanVector(self) :
+        '''The mean of the normalized targets (numFeatures,)'''
+        return self._mean
+
+    def meanSimilarity(self, vectors) :
+        '''Return the mean cosine similarity of each vector against the
+           entire library. This is O(numFeatures) per vector.
+        '''
+        return np.dot(normalizeRows(vectors), self._mean)
+
+    def _emptyTopK(self, numQueries, k) :
+        return np.full((numQueries, 0), -np.inf, dtype=np.float32), \
+               np.zeros((numQueries, 0), dtype=np.int64)
+
+    def query(self, vectors, k=1) :
+        '''Find the k most similar targets for each vector.
+
+           vectors : numpy.ndarray (numQueries, numFeatures)
+           k       : number of neighbors to return
+
+           return  : (indices, similarities) each (numQueries, k) ordered
+                     from most to least similar. Approximate indices may
+                     return fewer than k neighbors, which are padded with
+                     index -1 and similarity -inf.
+        '''
+        raise NotImplementedError('Implement the query() method')
+
+class ExactIndex (SimilarityIndex) :
+    '''Exhaustive search performed as blocked matrix multiplication. Only a
+       (numQueries, blockSize) block of similarities is held at once.
+
+       vectors   : Target library (numTargets, numFeatures)
+       blockSize : Number of targets compared per matrix multiplication
+    '''
+    def __init__ (self, vectors, blockSize=16384, normalized=False,
+                  state=None) :
+        SimilarityIndex.__init__(self, vectors, normalized, state)
+        self._blockSize = blockSize
+
+    def query(self, vectors, k=1) :
+        queries = normalizeRows(vectors)
+        k = min(k, len(self))
+        bestSims, bestIds = self._emptyTopK(queries.shape[0], k)
+        for start in range(0, len(self), self._blockSize) :
+            block = self._vectors[start:start + self._blockSize]
+            bestSims, bestIds = mergeTopK(
+                bestSims, bestIds, np.dot(queries, block.T),
+                np.arange(start, start + block.shape[0]), k)
+        return sortTopK(bestSims, bestIds)
+
+class IVFIndex (SimilarityIndex) :
+    '''Inverted file index. The library is partitioned with spherical k-means,
+       and each query is only compared against the targets of the numProbes
+       partitions with the closest centroids.
+
+       vectors    : Target library (numTargets, numFeatures)
+       numLists   : Number of partitions. Defaults to sqrt(numTargets)
+       numProbes  : Number of partitions searched per query
+       iterations : Number of k-means iterations
+       sampleSize : Number of targets used to train the centroids
+       rng        : numpy.random.RandomState for the centroid initialization
+    '''
+    stateNames = SimilarityIndex.stateNames + \
+                 ('centroids', 'order', 'offsets', 'sorted')
+
+    def __init__ (self, vectors, numLists=None, numProbes=8, iterations=10,
+                  sampleSize=None, rng=None, normalized=False, state=None) :
+        SimilarityIndex.__init__(self, vectors, normalized, state)
+        if state is not None :
+            self._centroids, self._order = state['centroids'], state['order']
+            self._offsets, self._sorted = state['offsets'], state['sorted']
+            self._numProbes = max(1, min(numProbes, len(self._centroids)))
+            return
+        if rng is None :
+            rng = np.random.RandomState(0)
+        numTargets = len(self)
+        numLists = int(np.sqrt(numTargets)) if numLists is None else numLists
+        numLists = max(1, min(numLists, numTargets))
+        self._numProbes = max(1, min(numProbes, numLists))
+
+        # train the centroids on a sample of the library
+        sampleSize = min(numTargets, 64 * numLists if sampleSize is None \
+                                     else sampleSize)
+        sample = self._vectors[rng.choice(numTargets, sampleSize,
+                                          replace=False)]
+        centroids = sample[rng.choice(sampleSize, numLists, replace=False)]
+        for ii in range(iterations) :
+            assign = np.argmax(np.dot(sample, centroids.T), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            # reseed any partition which lost all of its members
+            empty = np.bincount(assign, minlength=numLists) == 0
+            sums[empty] = sample[rng.choice(sampleSize, np.sum(empty))]
+            centroids = normalizeRows(sums)
+        self._centroids = centroids
+
+        # store the library contiguously by partition
+        assign = np.concatenate([
+            np.argmax(np.dot(self._vectors[ii:ii+16384], centroids.T), axis=1)
+            for ii in range(0, numTargets, 16384)])
+        self._order = np.argsort(assign, kind='mergesort')
+        self._offsets = np.searchsorted(assign[self._order],
+                                        np.arange(numLists + 1))
+        self._sorted = self._vectors[self._order]
+
+    def getState(self) :
+        state = SimilarityIndex.getState(self)
+        state.update(centroids=self._centroids, order=self._order,
+                     offsets=self._offsets, sorted=self._sorted)
+        return state
+
+    def query(self, vectors, k=1) :
+        queries = normalizeRows(vectors)
+        numQueries = queries.shape[0]
+        probes = np.argpartition(-np.dot(queries, self._centroids.T),
+                                 self._numProbes - 1,
+                                 axis=1)[:, :self._numProbes]
+        bestSims = np.full((numQueries, k), -np.inf, dtype=np.float32)
+        bestIds = np.full((numQueries, k), -1, dtype=np.int64)
+
+        # search each partition for all queries which probe it at once
+        for part in np.unique(probes) :
+            start, stop = self._offsets[part], self._offsets[part + 1]
+            if start == stop :
+                continue
+            rows = np.nonzero(np.any(probes == part, axis=1))[0]
+            sims, ids = mergeTopK(
+                bestSims[rows], bestIds[rows],
+                np.dot(queries[rows], self._sorted[start:stop].T),
+                self._order[start:stop], k)
+            bestSims[rows], bestIds[rows] = sims, ids
+        return sortTopK(bestSims, bestIds)
+
+class LSHIndex (SimilarityIndex) :
+    '''Random-projection locality sensitive hashing. Each table hashes the
+       targets by the signs of numBits random projections, and each query is
+       compared against the targets sharing a bucket in any table.
+
+       vectors   : Target library (numTargets, numFeatures)
+       numBits   : Number of projections per table
+       numTables : Number of independent hash tables
+       radius    : Hamming radius of the buckets probed (0 or 1)
+       rng       : numpy.random.RandomState for the projections
+    '''
+    stateNames = SimilarityIndex.stateNames + ('planes', 'orders', 'keys')
+
+    def __init__ (self, vectors, numBits=12, numTables=8, radius=1,
+                  rng=None, normalized=False, state=None) :
+        SimilarityIndex.__init__(self, vectors, normalized, state)
+        self._radius = radius
+        self._weights = (1 << np.arange(numBits)).astype(np.int64)
+        if state is not None :
+            self._planes = state['planes']
+            self._orders, self._keys = state['orders'], state['keys']
+            return
+        if rng is None :
+            rng = np.random.RandomState(0)
+        self._planes = rng.randn(numTables, self.getNumFeatures(),
+                                 numBits).astype(np.float32)
+
+        # sort the library by bucket in each table
+        self._orders, self._keys = [], []
+        for planes in self._planes :
+            keys = self._hash(self._vectors, planes)
+            order = np.argsort(keys, kind='mergesort')
+            self._orders.append(order)
+            self._keys.append(keys[order])
+        self._orders, self._keys = np.asarray(self._orders), \
+                                   np.asarray(self._keys)
+
+    def getState(self) :
+        state = SimilarityIndex.getState(self)
+        state.update(planes=self._planes, orders=self._orders,
+                     keys=self._keys)
+        return state
+
+    def _hash(self, vectors, planes) :
+        return np.dot(np.dot(vectors, planes) > 0., self._weights)
+
+    def _probeKeys(self, keys) :
+        '''The bucket keys within the hamming radius (numQueries, numKeys)'''
+        keys = keys[:, np.newaxis]
+        if self._radius > 0 :
+            keys = np.concatenate((keys, keys ^ self._weights), axis=1)
+        return keys
+
+    def query(self, vectors, k=1) :
+        queries = normalizeRows(vectors)
+        numQueries = queries.shape[0]
+
+        # collect the candidates from every table
+        candidates = [[] for ii in range(numQueries)]
+        for planes, order, sortedKeys in \
+            zip(self._planes, self._orders, self._keys) :
+            keys = self._probeKeys(self._hash(queries, planes))
+            starts = np.searchsorted(sortedKeys, keys, side='left')
+            stops = np.searchsorted(sortedKeys, keys, side='right')
+            for ii in range(numQueries) :
+                candidates[ii].extend(order[start:stop] for start, stop in \
+                                      zip(starts[ii], stops[ii]) \
+                                      if stop > start)
+
+        # rerank the candidates exactly
+        bestSims = np.full((numQueries, k), -np.inf, dtype=np.float32)
+        bestIds = np.full((numQueries, k), -1, dtype=np.int64)
+        for ii in range(numQueries) :
+            if len(candidates[ii]) == 0 :
+                continue
+            ids = np.unique(np.concatenate(candidates[ii]))
+            sims, ids = mergeTopK(
+                bestSims[ii:ii+1], bestIds[ii:ii+1],
+                np.dot(self._vectors[ids], queries[ii])[np.newaxis], ids, k)
+            bestSims[ii], bestIds[ii] = sims[0], ids[0]
+        return sortTopK(bestSims, bestIds)
+
+# registered index types for createIndex
+indexTypes = {'exact' : ExactIndex, 'ivf' : IVFIndex, 'lsh' : LSHIndex}
+
+def createIndex(vectors, indexType='exact', **kwargs) :
+    '''Create a similarity index over the target library.
+
+       vectors   : Target library (numTargets, numFeatures)
+       indexType : 'exact', 'ivf' or 'lsh'
+       kwargs    : Options passed to the index constructor, including
+                   normalized and state (see SimilarityIndex)
+    '''
+    if indexType not in indexTypes :
+        raise ValueError('Unsupported similarity index [' + str(indexType) +
+                         ']')
+    return indexTypes[indexType](vectors, **kwargs)
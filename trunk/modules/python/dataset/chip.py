@@ -1,94 +1,382 @@
+import numpy as np
 
-def prepareChips (chips, pixelRegion, batchSize=1, log=None) :
+class ChipView () :
+    '''A zero-copy (numChips, numChannels, chipRows, chipCols) view of chips
+       within an image. Each chip is a window into a strided view of the
+       image, so no pixels are copied until the chips are materialized.
+
+       NOTE: Chips on a constant-step grid (ie. regularGrid or overlapGrid)
+             are a single strided numpy.ndarray (see getGrid), which
+             materialize() copies a row of chips at a time. A general set
+             of chips (ie. random) cannot be expressed as one, so individual
+             chips are numpy views, while materialize() gathers them.
+
+       image    : numpy.ndarray formatted (numChannels, rows, cols)
+       chipSize : Size of the chips (rows, cols)
+       regions  : int32 array of the chip regions (numChips, 4) formatted
+                  (startRow, startCol, endRow, endCol)
+       step     : Pixels between the chips (rows, cols) when the regions are
+                  the row-major grid from the image origin, or None
+    '''
+    def __init__ (self, image, chipSize, regions, step=None) :
+        from numpy.lib.stride_tricks import as_strided
+        chipRows, chipCols = chipSize[0], chipSize[1]
+        chanStride, rowStride, colStride = image.strides
+
+        # view of every chip location in the image --
+        # (startRow, startCol, numChannels, chipRows, chipCols)
+        self._windows = as_strided(
+            image, shape=(image.shape[1] - chipRows + 1,
+                          image.shape[2] - chipCols + 1,
+                          image.shape[0], chipRows, chipCols),
+            strides=(rowStride, colStride, chanStride, rowStride, colStride))
+
+        # the grid is every step-th chip location --
+        # (gridRow, gridCol, numChannels, chipRows, chipCols)
+        self._grid = None if step is None else \
+                     self._windows[::step[0], ::step[1]]
+        self._span = (0, len(regions))
+        self.regions = regions
+        self.shape = (len(regions), image.shape[0], chipRows, chipCols)
+        self.dtype = image.dtype
+
+    def __len__ (self) :
+        return self.shape[0]
+
+    def __getitem__ (self, index) :
+        '''An integer returns the chip as a numpy.ndarray view, while a slice
+           or index array returns a ChipView of the selected chips.
+        '''
+        if isinstance(index, (int, np.integer)) :
+            if self._grid is None :
+                return self._windows[self.regions[index, 0],
+                                     self.regions[index, 1]]
+            if index < 0 :
+                index += len(self)
+            return self._grid[divmod(self._span[0] + index,
+                                     self._grid.shape[1])]
+        subset = ChipView.__new__(ChipView)
+        subset._windows = self._windows
+        subset._grid, subset._span = None, None
+        if self._grid is not None and isinstance(index, slice) and \
+           index.step in (None, 1) :
+            # a contiguous run of the grid remains on the grid
+            start, stop = index.indices(len(self))[:2]
+            subset._grid = self._grid
+            subset._span = (self._span[0] + start,
+                            self._span[0] + max(start, stop))
+        subset.regions = self.regions[index]
+        subset.shape = (len(subset.regions),) + self.shape[1:]
+        subset.dtype = self.dtype
+        return subset
+
+    def getGrid(self) :
+        '''Return the chips as a strided numpy.ndarray view formatted
+           (gridRows, gridCols, numChannels, chipRows, chipCols), or None if
+           the chips are not a whole grid.
+        '''
+        if self._grid is None or \
+           self._span != (0, self._grid.shape[0] * self._grid.shape[1]) :
+            return None
+        return self._grid
+
+    def _copyGrid(self, out, start, stop) :
+        '''Copy the chips [start, stop) of the grid, a row at a time.'''
+        gridCols = self._grid.shape[1]
+        first, last = self._span[0] + start, self._span[0] + stop
+        pos = 0
+        while first < last :
+            row, col = divmod(first, gridCols)
+            num = min(gridCols - col, last - first)
+            out[pos:pos + num] = self._grid[row, col:col + num]
+            pos += num
+            first += num
+
+    def __array__ (self, dtype=None) :
+        out = self.materialize()
+        return out if dtype is None else out.astype(dtype)
+
+    def materialize(self, out=None, blockSize=256) :
+        '''Copy the chips into contiguous memory. The chips are gathered in
+           blocks, so out may also be a HDF5 dataset or numpy.memmap.
+
+           out       : Buffer to fill, sized at least (numChips, ...). A new
+                       numpy.ndarray is allocated if None.
+           blockSize : Number of chips gathered per copy
+           return    : out
+        '''
+        if out is None :
+            out = np.ndarray(self.shape, dtype=self.dtype)
+        if self._grid is not None and isinstance(out, np.ndarray) :
+            self._copyGrid(out, 0, len(self))
+            return out
+        for start in range(0, len(self), blockSize) :
+            stop = min(start + blockSize, len(self))
+            if self._grid is None :
+                out[start:stop] = self._windows[self.regions[start:stop, 0],
+                                                self.regions[start:stop, 1]]
+            else :
+                block = np.ndarray((stop - start,) + self.shape[1:],
+                                   dtype=self.dtype)
+                self._copyGrid(block, start, stop)
+                out[start:stop] = block
+        return out
+
+class RegionView () :
+    '''A (numChips, numChannels, chipRows, chipCols) view of chips within an
+       image file. The chips are read from disk with readImageRegion as they
+       are accessed, so the image is never held in memory as a whole.
+
+       image       : Path to the image
+       chipSize    : Size of the chips (rows, cols)
+       regions     : int32 array of the chip regions (numChips, 4) formatted
+                     (startRow, startCol, endRow, endCol)
+       numChannels : Number of channels in the image
+       norm        : Normalization of the windows, as in readImageRegion.
+                     The 'image' normalization of the whole image (see
+                     reader.imageNormalization) matches the chips cut from
+                     readImage.
+    '''
+    def __init__ (self, image, chipSize, regions, numChannels,
+                  norm='image') :
+        import theano as t
+        self.image = image
+        self.regions = regions
+        self.norm = norm
+        self.shape = (len(regions), numChannels, chipSize[0], chipSize[1])
+        self.dtype = np.dtype(t.config.floatX)
+
+    def __len__ (self) :
+        return self.shape[0]
+
+    def __getitem__ (self, index) :
+        '''An integer reads the chip into a numpy.ndarray, while a slice or
+           index array returns a RegionView of the selected chips.
+        '''
+        from dataset.reader import readImageRegion
+        if isinstance(index, (int, np.integer)) :
+            region = self.regions[index]
+            return readImageRegion(self.image, region[0::2], region[1::2],
+                                   norm=self.norm)
+        subset = RegionView.__new__(RegionView)
+        subset.image = self.image
+        subset.regions = self.regions[index]
+        subset.norm = self.norm
+        subset.shape = (len(subset.regions),) + self.shape[1:]
+        subset.dtype = self.dtype
+        return subset
+
+    def __array__ (self, dtype=None) :
+        out = self.materialize()
+        return out if dtype is None else out.astype(dtype)
+
+    def _readInto(self, out, maxPixels) :
+        '''Read the chips into the numpy.ndarray. The chips are grouped into
+           strips of rows, and each strip is read with a single windowed
+           read spanning the columns of the chips, rather than opening the
+           image once per chip.
+        '''
+        from dataset.reader import readImageRegion
+        if len(self) == 0 :
+            return
+        regions = self.regions
+        order = np.argsort(regions[:, 0], kind='mergesort')
+        cols = (int(np.amin(regions[:, 1])), int(np.amax(regions[:, 3])))
+        maxRows = max(self.shape[2], maxPixels // (cols[1] - cols[0]))
+        start = 0
+        while start < len(order) :
+            top = int(regions[order[start], 0])
+            stop = start + 1
+            while stop < len(order) and \
+                  regions[order[stop], 2] - top <= maxRows :
+                stop += 1
+            group = order[start:stop]
+            strip = readImageRegion(self.image,
+                                    (top, int(np.amax(regions[group, 2]))),
+                                    cols, norm=self.norm)
+            for ii in group :
+                out[ii] = strip[:, regions[ii, 0] - top:regions[ii, 2] - top,
+                                   regions[ii, 1] - cols[0]:
+                                   regions[ii, 3] - cols[0]]
+            start = stop
+
+    def materialize(self, out=None, blockSize=256, maxPixels=2**22) :
+        '''Read the chips into contiguous memory. The chips are staged in
+           blocks, so out may also be a HDF5 dataset or numpy.memmap.
+
+           out       : Buffer to fill, sized at least (numChips, ...). A new
+                       numpy.ndarray is allocated if None.
+           blockSize : Number of chips staged per copy
+           maxPixels : Number of pixels per channel in each windowed read
+           return    : out
+        '''
+        if out is None :
+            out = np.ndarray(self.shape, dtype=self.dtype)
+        if isinstance(out, np.ndarray) :
+            self._readInto(out, maxPixels)
+            return out
+        block = np.ndarray((min(blockSize, len(self)),) + self.shape[1:],
+                           dtype=out.dtype)
+        for start in range(0, len(self), blockSize) :
+            stop = min(start + blockSize, len(self))
+            self[start:stop]._readInto(block, maxPixels)
+            out[start:stop] = block[:stop - start]
+        return out
+
+def imageShape(image) :
+    '''Return the (numChannels, rows, cols) of an image or image path. The
+       dimensions of a path are read from the header.
+    '''
+    if isinstance(image, str) :
+        from dataset.reader import getImageDims
+        return tuple(getImageDims(image))
+    return image.shape
+
+def chipView(image, chipSize, regions, step=None) :
+    '''Create the view of the chips. A path to an image which supports
+       windowed reads is chipped from disk, while any other image is decoded
+       into memory first. Either way the chips are normalized with the
+       statistics of the whole image. The step of grid regions lets the
+       in-memory chips be a single strided view (see ChipView).
+    '''
+    if isinstance(image, str) :
+        from dataset.reader import readImage, supportsRegionReads, \
+                                   imageNormalization
+        if supportsRegionReads(image) :
+            return RegionView(image, chipSize, regions, imageShape(image)[0],
+                              imageNormalization(image))
+        image = readImage(image)
+    return ChipView(image, chipSize, regions, step)
+
+def makeRegions(rows, cols, chipSize) :
+    '''Create the int32 region array from the chip origins.'''
+    regions = np.ndarray((len(rows), 4), dtype=np.int32)
+    regions[:, 0], regions[:, 1] = rows, cols
+    regions[:, 2], regions[:, 3] = rows + chipSize[0], cols + chipSize[1]
+    return regions
+
+def prepareChips (chips, pixelRegion, batchSize=1, out=None, log=None) :
     '''Make data contiguous in memory
        All pixels will be arranged into a single tensor of format
-           (numChips,numChannels,chipRows,chipCols), (numChips,4)
+           (numBatches,batchSize,numChannels,chipRows,chipCols),
+           (numBatches,batchSize,4)
+       Any partial batch is discarded.
 
-       chips       : the list of chips and pixels regions 
-                     [[numChannels,chipRows,chipCols], [4], ...]
-       pixelRegion : Save the relative pixel locations for each chip 
+       chips       : ChipView or RegionView returned from a chipping
+                     function
+       pixelRegion : Save the relative pixel locations for each chip
                      (startRow,startCol,endRow,endCol)
+       batchSize   : Size of a mini-batch
+       out         : Optional buffer to fill. This may be a preallocated
+                     numpy.ndarray or a HDF5 dataset.
+       log         : Logger to use
     '''
-    from minibatch import makeContiguous
-    pixels, regions = makeContiguous(chips, batchSize, log)
+    from dataset.minibatch import calcNumBatches
+    numBatches = calcNumBatches(len(chips), batchSize)
+    numChips = numBatches * batchSize
+    if log is not None :
+        log.debug('Making buffers contiguous in memory')
+    if out is None :
+        out = np.ndarray((numBatches, batchSize) + chips.shape[1:],
+                         dtype=chips.dtype)
+
+    # an in-memory buffer is filled in place, while other buffers (ie. HDF5)
+    # are written one staged mini-batch at a time
+    batch = None if isinstance(out, np.ndarray) else \
+            np.ndarray((batchSize,) + chips.shape[1:], dtype=out.dtype)
+    for ii in range(numBatches) :
+        subset = chips[ii*batchSize:(ii+1)*batchSize]
+        if batch is None :
+            subset.materialize(out[ii])
+        else :
+            out[ii] = subset.materialize(batch)
+
     if not pixelRegion :
         if log is not None :
             log.debug('Removing the pixelRegion')
-        regions = None
-    return pixels, regions
+        return out, None
+    return out, np.reshape(chips.regions[:numChips],
+                           (numBatches, batchSize, 4))
 
 def regularGrid(image, chipSize, skipFactor=0, log=None) :
     '''This chips the region into non-overlapping sub-regions. All partial
        border chips will be disgarded from the returned array.
 
-       image       : numpy.ndarray formatted (numChannels, rows, cols)
+       image       : numpy.ndarray formatted (numChannels, rows, cols), or
+                     the path to the image
        chipSize    : Size of chips to be extracted (rows, cols)
-       stepFactor  : Number of pixels to advance to next chip start
-                     (rows, cols)
+       skipFactor  : Number of chips to skip between extracted chips
        log         : Logger to use
+       return      : ChipView or RegionView of the chips
     '''
     return overlapGrid(image, chipSize, log=log,
                        stepFactor=(chipSize[0] * (skipFactor+1),
-                                   chipSize[0] * (skipFactor+1)))
+                                   chipSize[1] * (skipFactor+1)))
 
 def overlapGrid(image, chipSize, stepFactor, log=None) :
-    '''This chips the region into non-overlapping sub-regions. All partial
-       border chips will be discarded from the returned array.
+    '''This chips the region into a grid of possibly overlapping sub-regions.
+       All partial border chips will be discarded from the returned array.
 
-       image       : numpy.ndarray formatted (numChannels, rows, cols)
+       image       : numpy.ndarray formatted (numChannels, rows, cols), or
+                     the path to the image
        chipSize    : Size of chips to be extracted (rows, cols)
        stepFactor  : Number of pixels to advance to next chip start
                      (rows, cols)
        log         : Logger to use
+       return      : ChipView or RegionView of the chips
     '''
     if log is not None :
         log.info('Subdividing the Image')
 
     # grab an grid of chips
-    chips = []
-    chipRows, chipCols = chipSize[0], chipSize[1]
-    for row in range(0, image.shape[1] - chipSize, stepFactor[0]) :
-        for col in range(0, image.shape[2] - chipSize, stepFactor[1]) :
-            chips.append((image[:, row : row + chipRows, col : col + chipCols],
-                          [row, col, row + chipRows, col + chipCols]))
-    return chips
+    shape = imageShape(image)
+    rows, cols = np.meshgrid(
+        np.arange(0, shape[1] - chipSize[0] + 1, stepFactor[0]),
+        np.arange(0, shape[2] - chipSize[1] + 1, stepFactor[1]),
+        indexing='ij')
+    return chipView(image, chipSize, makeRegions(rows.ravel(), cols.ravel(),
+                                                 chipSize), stepFactor)
 
 def randomChip(image, chipSize, numChips=100, log=None) :
-    '''This chips the region randomly for a specified number of chips. 
+    '''This chips the region randomly for a specified number of chips.
 
-       image       : numpy.ndarray formatted (numChannels, rows, cols)
+       image       : numpy.ndarray formatted (numChannels, rows, cols), or
+                     the path to the image
        chipSize    : Size of chips to be extracted (rows, cols)
        numChips    : Number of chips to extract from the image
        log         : Logger to use
+       return      : ChipView or RegionView of the chips
     '''
-    from numpy.random import uniform
+    from numpy.random import randint
     if log is not None :
         log.info('Subdividing the Image')
 
     # randomly generate the chip pairs
-    chips = []
-    chipRows, chipCols = chipSize[0], chipSize[1]
-    randRows = uniform(low=0, high=image.shape[1]-chipRows,
-                       size=numChips).astype('int32')
-    randCols = uniform(low=0, high=image.shape[2]-chipCols,
-                       size=numChips).astype('int32')
-    for row, col in zip(randRows, randCols) :
-        chips.append((image[:, row : row + chipRows, col : col + chipCols],
-                      [row, col, row + chipRows, col + chipCols]))
-    return chips
+    shape = imageShape(image)
+    randRows = randint(0, shape[1] - chipSize[0] + 1, size=numChips)
+    randCols = randint(0, shape[2] - chipSize[1] + 1, size=numChips)
+    return chipView(image, chipSize, makeRegions(randRows, randCols,
+                                                 chipSize))
 
 def selectiveChip(image, chipSize, log=None) :
     raise Exception('Please Implement selectiveChip().')
 
 def applyChipping (images, log=None, *chipFunc, **kwargs) :
-    '''A utility to run the chipping function on a number of images
+    '''A utility to run the chipping function on a number of images. The
+       chips from all images are materialized once into a single buffer.
 
-       images   : List of images in memory
+       images   : List of images in memory, or paths to the images
        log      : Logger to use
        *chipFunc: Chipping function to use
        **kwargs : Chipping function parameters
+       return   : (numChips, numChannels, chipRows, chipCols), (numChips, 4)
     '''
-    chips = []
-    for im in images :
-        chips.extend(*chipFunc(im, **kwargs))
-    return chips
+    views = [chipFunc[0](im, **kwargs) for im in images]
+    numChips = sum(len(v) for v in views)
+    chips = np.ndarray((numChips,) + views[0].shape[1:],
+                       dtype=views[0].dtype)
+    offset = 0
+    for view in views :
+        view.materialize(chips[offset:offset + len(view)])
+        offset += len(view)
+    return chips, np.concatenate([v.regions for v in views])
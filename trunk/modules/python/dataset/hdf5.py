@@ -1,7 +1,58 @@
 import h5py
 
+def batchChunkShape(dataShape) :
+    '''Chunk shape aligned to a single mini-batch of the dataset. Data is
+       formatted (numBatches, batchSize, ...), so one chunk holds one batch
+       and a mini-batch read touches exactly one chunk.
+    '''
+    dataShape = tuple(dataShape)
+    if len(dataShape) < 2 :
+        return True
+    return (1,) + tuple(max(1, d) for d in dataShape[1:])
+
+def createDataset (hdf5, name, shape, dtype, maxshape=None, chunks=True,
+                   compression=None, compressionOpts=None, shuffle=False) :
+    '''Create a mini-batch formatted dataset with the layout options.
+
+       hdf5            : Open h5py.File handle
+       name            : Path of the dataset within the file
+       shape           : Dataset dimensions (numBatches, batchSize, ...)
+       dtype           : Dataset dtype
+       maxshape        : Optionally specify a maxshape for the dataset
+       chunks          : True aligns the chunks to one mini-batch, False
+                         stores contiguously, or a user-specified chunk shape
+       compression     : None, 'lzf' or 'gzip'
+       compressionOpts : Options for the compressor (ie. the gzip level)
+       shuffle         : Enable the byte shuffle filter. This groups the bytes
+                         of each float, and improves the compression ratio
+    '''
+    if compression not in (None, 'lzf', 'gzip') :
+        raise ValueError('Unsupported compression [' + str(compression) + ']')
+
+    # filters and resizable datasets require a chunked layout
+    if chunks is False and (compression is not None or shuffle or
+                            maxshape is not None) :
+        raise ValueError('Compression, shuffle and maxshape require chunks.')
+    if chunks is True and maxshape is None and 0 in tuple(shape) :
+        # an empty fixed-size dataset cannot hold a chunk -- it is stored
+        # contiguously, as there is nothing to filter
+        chunks, compression, shuffle = None, None, False
+    elif chunks is True :
+        chunks = batchChunkShape(shape) if maxshape is None else \
+                 batchChunkShape([1 if m is None else m for m in maxshape])
+    elif chunks is False :
+        chunks = None
+
+    return hdf5.create_dataset(name, shape=shape, dtype=dtype,
+                               maxshape=maxshape, chunks=chunks,
+                               compression=compression,
+                               compression_opts=compressionOpts,
+                               shuffle=shuffle)
+
 def createHDF5Unlabeled (outputFile, trainDataShape, trainDataDtype,
-                         trainMaxShape=None, log=None) :
+                         trainMaxShape=None, log=None, chunks=True,
+                         compression=None, compressionOpts=None,
+                         shuffle=False) :
     '''Utility to create the HDF5 file and return the handles. This allows
        users to fill out the buffers in a memory conscious manner.
 
@@ -11,6 +62,11 @@ def createHDF5Unlabeled (outputFile, trainDataShape, trainDataDtype,
        trainDataDtype    : Training data dtype
        trainMaxShape     : Optionally specify a maxshape for the training set
        log               : Logger to use
+       chunks            : True aligns the chunks to one mini-batch, False
+                           stores the data contiguously
+       compression       : None, 'lzf' or 'gzip'
+       compressionOpts   : Options for the compressor (ie. the gzip level)
+       shuffle           : Enable the byte shuffle filter
     '''
     if not outputFile.endswith('.h5') and not outputFile.endswith('.hdf5') :
         raise Exception('The file must end in the .h5 or .hdf5 extension.')
@@ -19,9 +75,9 @@ def createHDF5Unlabeled (outputFile, trainDataShape, trainDataDtype,
     hdf5 = h5py.File(outputFile, libver='latest', mode='w')
 
     # the file will always have training data in train/data
-    trainData = hdf5.create_dataset('train/data', shape=trainDataShape,
-                                    dtype=trainDataDtype,
-                                    maxshape=trainMaxShape)
+    trainData = createDataset(hdf5, 'train/data', trainDataShape,
+                              trainDataDtype, trainMaxShape, chunks,
+                              compression, compressionOpts, shuffle)
 
     # TODO: Should we additionally have a test/data set to allow early
     #       stoppage? This will test the ability to reconstruct data 
@@ -33,7 +89,8 @@ def createHDF5Unlabeled (outputFile, trainDataShape, trainDataDtype,
 def createHDF5Labeled (outputFile,
                        trainDataShape, trainDataDtype, trainIndicesDtype,
                        testDataShape, testDataDtype, testIndicesDtype, 
-                       labelsShape, log=None) :
+                       labelsShape, log=None, chunks=True, compression=None,
+                       compressionOpts=None, shuffle=False, resizable=False) :
     '''Utility to create the HDF5 file and return the handles. This allows
        users to fill out the buffers in a memory conscious manner.
 
@@ -47,21 +104,40 @@ def createHDF5Labeled (outputFile,
        testIndicesDtype  : Testing indicies dtype
        labelsShape       : Labels shape associated with indices
        log               : Logger to use
+       chunks            : True aligns the chunks to one mini-batch, False
+                           stores the data contiguously
+       compression       : None, 'lzf' or 'gzip'
+       compressionOpts   : Options for the compressor (ie. the gzip level)
+       shuffle           : Enable the byte shuffle filter
+       resizable         : Allow the number of batches of each set to change.
+                           This supports incremental updates of the dataset.
     '''
+    def maxShape(shape) :
+        return (None,) + tuple(shape[1:]) if resizable else None
+
     hdf5, trainData = createHDF5Unlabeled(outputFile, trainDataShape,
-                                          trainDataDtype, log=log)
+                                          trainDataDtype,
+                                          maxShape(trainDataShape), log=log,
+                                          chunks=chunks,
+                                          compression=compression,
+                                          compressionOpts=compressionOpts,
+                                          shuffle=shuffle)
 
     # supervised learning will have indices associated with the training data
     trainIndices = hdf5.create_dataset('train/indices',
                                        shape=tuple(trainDataShape[:2]),
-                                       dtype=trainIndicesDtype)
+                                       dtype=trainIndicesDtype,
+                                       maxshape=maxShape(trainDataShape[:2]))
 
     # add testing data and indices
-    testData = hdf5.create_dataset('test/data', shape=testDataShape,
-                                   dtype=testDataDtype)
+    testData = createDataset(hdf5, 'test/data', testDataShape, testDataDtype,
+                             maxShape(testDataShape), chunks=chunks,
+                             compression=compression,
+                             compressionOpts=compressionOpts, shuffle=shuffle)
     testIndices = hdf5.create_dataset('test/indices',
                                       shape=tuple(testDataShape[:2]),
-                                      dtype=testIndicesDtype)
+                                      dtype=testIndicesDtype,
+                                      maxshape=maxShape(testDataShape[:2]))
 
     # each index with have an associated string label
     labelsShape = labelsShape if isinstance(labelsShape, tuple) else\
@@ -107,11 +183,19 @@ def writeHDF5 (outputFile, trainData, trainIndices=None,
         hdf5.flush()
         hdf5.close()
 
-def readHDF5 (inFile, log=None) :
+def readHDF5 (inFile, log=None, cacheSize=None, cacheSlots=None,
+              cachePreemption=None) :
     '''Utility to read a pickle in from disk.
 
-       inFile : Name of the file to read. The extension should be pkl.gz
-       log    : Logger to use
+       inFile          : Name of the file to read. The extension should be
+                         pkl.gz
+       log             : Logger to use
+       cacheSize       : Size of the raw chunk cache in bytes. This should
+                         hold at least one chunk (ie. one mini-batch),
+                         otherwise chunks bypass the cache entirely.
+       cacheSlots      : Number of hash slots in the chunk cache. A prime
+                         around 100x the number of cached chunks is ideal.
+       cachePreemption : [0., 1.] preference to evict fully read chunks
 
        return : (train, test, labels)
     '''
@@ -121,8 +205,17 @@ def readHDF5 (inFile, log=None) :
     if log is not None :
         log.debug('Opening the file in memory-mapped mode')
 
-    # open the file
-    hdf5 = h5py.File(inFile, mode='r')
+    # open the file --
+    # the chunk cache is only specified when requested, so h5py defaults are
+    # used otherwise.
+    cache = {}
+    if cacheSize is not None :
+        cache['rdcc_nbytes'] = int(cacheSize)
+    if cacheSlots is not None :
+        cache['rdcc_nslots'] = int(cacheSlots)
+    if cachePreemption is not None :
+        cache['rdcc_w0'] = float(cachePreemption)
+    hdf5 = h5py.File(inFile, mode='r', **cache)
 
     # read the available information
     trainData = hdf5.get("train/data")
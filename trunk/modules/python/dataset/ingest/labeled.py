@@ -61,58 +61,50 @@ def checkAvailableMemory(dataMemoryConsumption, shared, log) :
 
     return shared
 
-def readDataset(trainDataH5, train, trainShape, batchSize, threads, log) :
+def readDataset(trainDataH5, train, trainShape, batchSize, threads, log,
+                engine='thread') :
+    '''Read the imagery into the HDF5 buffer one mini-batch at a time. This
+       runs as a bounded pipeline, so memory is fixed by the number of
+       staging slots and the writes land in sequential slice order.
+
+       trainDataH5 : HDF5 dataset to populate
+       train       : List of image paths to read
+       trainShape  : Shape of the dataset (numBatches, batchSize, ...)
+       batchSize   : Size of a mini-batch
+       threads     : Number of concurrent decoders
+       log         : Logger to use
+       engine      : 'thread' decodes within this process, 'process' decodes
+                     in a pool of worker processes to avoid the GIL
+    '''
     import theano
-    from six.moves import queue
-    import threading
-    from dataset.reader import padImageData, readImage
-
-    # add jobs to the queue --
-    # NOTE : h5py.Dataset doesn't implement __setslice__, so we must implement
-    #        the copy via __setitem__. This differs from my normal index
-    #        formatting, but it gets the job done.
-    workQueueData = queue.Queue()
-    for ii in range(trainShape[0]) :
-        workQueueData.put((trainDataH5, np.s_[ii, :], trainShape[1:],
-                           train[ii*batchSize:(ii+1)*batchSize], log))
-
-    # stream the imagery into the buffers --
-    # we are threading this for efficiency
-    def readImagery() :
-        while True :
-            dataH5, sliceIndex, batchSize, imageFiles, log = \
-                workQueueData.get()
-
-            # allocate a load the batch locally so our write are coherent
-            tmp = np.ndarray((batchSize), theano.config.floatX)
-            for ii, imageFile in enumerate(imageFiles) :
-                tmp[ii][:] = padImageData(readImage(imageFile[0], log),
-                                          batchSize[-3:])[:]
-            dataH5[sliceIndex] = tmp[:]
-
-            workQueueData.task_done()
-
-    # create the workers
-    for ii in range(threads) :
-        thread = threading.Thread(target=readImagery)
-        thread.daemon = True
-        thread.start()
-
-    # join the threads and complete
-    workQueueData.join()
-
-def readAndDivideData(path, holdoutPercentage, minTest=5, log=None) :
+    from dataset.ingest.pipeline import ingestBatches
+    ingestBatches(trainDataH5, train, trainShape[0], trainShape[1:],
+                  theano.config.floatX, threads, engine, log=log)
+
+def readAndDivideData(path, holdoutPercentage, minTest=5, log=None,
+                      workers=None) :
     '''This walks the directory structure and divides the data according to the
        user specified holdout over two "train" and "test" sets.
+
+       path              : Top-level directory containing the label directories
+       holdoutPercentage : Percentage of the data to holdout for testing
+       minTest           : Hard minimum on holdout if percentage is low
+       log               : Logger to use
+       workers           : Number of concurrent directory listings
+       return            : (train, test, labels) where train and test are
+                           dataset.scan.FileTable
     '''
-    from dataset.shuffle import naiveShuffle
+    from time import time
+    from dataset.reader import mostCommonExtension
+    from dataset.scan import FileTable, scanDirectory
 
     # read the directory structure --
     # each subdirectory becomes a label and the imagery within are examples.
     # Splitting the data per label ensures each category is represented in the
     # holdout set.
+    timer = time()
     train, test, labels = [], [], []
-    for root, dirs, files in os.walk(path) :
+    for root, files, sizes, mtimes in scanDirectory(path, workers, log) :
         if root == path :
             continue
         if len(files) == 0 :
@@ -127,73 +119,117 @@ def readAndDivideData(path, holdoutPercentage, minTest=5, log=None) :
         if log is not None :
             log.debug('Adding directory [' + root + '] as [' + label + ']')
 
+        # use the most common type of file in the dir and exclude
+        # other types (avoid generated jpegs, other junk)
+        suffix = mostCommonExtension(files, samplesize=50)
+        keep = np.asarray([f.endswith(suffix) for f in files], dtype=bool)
+        items = FileTable([os.path.join(root, f) for f in files],
+                          np.full(len(files), indx, np.int32),
+                          sizes, mtimes)[keep]
+
         # a small percentage of the data is held out to verify our training
         # isn't getting overfitted. We will randomize the input later.
-        numTest = max(minTest, int(holdoutPercentage * len(files)))
+        numTest = max(minTest, int(holdoutPercentage * len(items)))
         if log is not None :
             log.debug('Holding out [' + str(numTest) + '] of [' + \
-                      str(len(files)) + ']')
+                      str(len(items)) + ']')
 
         # this ensures a minimum number of examples are used for testing
-        holdoutPercentage = (float(numTest) / float(len(files)))
-
-        # use the most common type of file in the dir and exclude
-        # other types (avoid generated jpegs, other junk)
-        suffix = mostCommonSuffix(files, samplesize=50)
-
-        # prepare the data
-        items = np.asarray(
-            [(os.path.join(root, file), indx) for file in files
-                if file.endswith(suffix)],
-            dtype=np.object)
-        naiveShuffle(items)
+        holdout = min(1., float(numTest) / float(max(1, len(items))))
 
         # randomly distribute the data using Random Assignment based on
         # Bernoulli trials
-        # TODO: There may be a more compact way to represent this in python
-        randomAssign = np.random.binomial(1, holdoutPercentage, len(items))
-        train.extend(
-            [items[ii] for ii in range(len(items)) if randomAssign[ii] == 0])
-        test.extend(
-            [items[ii] for ii in range(len(items)) if randomAssign[ii] == 1])
+        randomAssign = np.random.binomial(1, holdout, len(items)) == 1
+        train.append(items[~randomAssign])
+        test.append(items[randomAssign])
 
     # randomize the data across categories -- otherwise its not stochastic
     if log is not None :
         log.info('Shuffling the data for randomization')
-    naiveShuffle(train)
-    naiveShuffle(test)
+    train = sum(train, FileTable()).shuffle()
+    test = sum(test, FileTable()).shuffle()
 
+    if log is not None :
+        log.info('Divided [' + str(len(train)) + '] train and [' +
+                 str(len(test)) + '] test files into [' + str(len(labels)) +
+                 '] labels in ' + str(time() - timer) + 's')
     return train, test, labels
 
 def hdf5Dataset(filepath, holdoutPercentage=.05, minTest=5,
-                batchSize=1, log=None) :
+                batchSize=1, engine='thread', compression=None,
+                shuffle=False, incremental=True, normalization='image',
+                storage='floatX', log=None) :
     '''Create a hdf5 file out of a directory structure. The directory structure
        is assumed to be a series of directories, each contains imagery assigned
        the label of the directory name.
 
+       The file holds a manifest of the ingested imagery. When the file
+       already exists only new or changed imagery is decoded, and a build
+       which was interrupted resumes from the last committed batch.
+
        filepath          : Top-level directory containing the label directories
        holdoutPercentage : Percentage of the data to holdout for testing
        minTest           : Hard minimum on holdout if percentage is low
        batchSize         : Size of a mini-batch
+       engine            : Decode engine to use -- 'thread' or 'process'
+       compression       : HDF5 compression filter -- None, 'lzf' or 'gzip'
+       shuffle           : Enable the HDF5 byte shuffle filter
+       incremental       : Update an existing file against the directory.
+                           False uses an existing file as-is.
+       normalization     : 'image' normalizes each image on its own. 'dataset'
+                           computes per-channel statistics over the training
+                           set, standardizes both sets with them and stores
+                           them in the train/data attributes, so inference
+                           applies the same affine transform to its imagery
+                           (see dataset.statistics.loadStatistics).
+                           Incremental updates reuse the stored statistics.
+       storage           : Pixel type stored -- 'floatX', 'float16' or
+                           'uint8'. The compact types record the per-channel
+                           scale and offset which recover floatX pixels, and
+                           the data is dequantized on the device as it is
+                           trained. 'uint8' stores the raw pixels of 8-bit
+                           imagery, and other imagery is rejected as it is
+                           decoded. It requires 'dataset' normalization, as
+                           per-image normalization cannot be recovered from
+                           the raw pixels. 'float16' saturates pixels beyond
+                           its range (see dataset.quantize.finalizeStorage).
        log               : Logger to use
     '''
+    import h5py
     import theano
-    import threading
     import multiprocessing
-    from six.moves import queue
-    from dataset.reader import getImageDims, mostCommon
+    from dataset.reader import probeImageDims, shapeDistribution, \
+                               expandSegments
     from dataset.hdf5 import createHDF5Labeled
+    from dataset.manifest import Manifest, updateSplit
+    from dataset.statistics import prepareStatistics, finalizeStatistics
+    from dataset.quantize import storageDtype, finalizeStorage, \
+                                 checkNormalization
+
+    if normalization not in ('image', 'dataset') :
+        raise ValueError('Unsupported normalization [' + str(normalization) +
+                         ']')
+    checkNormalization(storage, normalization)
 
     rootpath = os.path.abspath(filepath)
     outputFile = os.path.join(rootpath, os.path.basename(rootpath) + 
                               '_labeled' + 
                               '_holdout_' + str(holdoutPercentage) +
-                              '_batch_' + str(batchSize) +'.hdf5')
-    if os.path.exists(outputFile) :
-        if log is not None :
-            log.info('HDF5 exists for this dataset [' + outputFile +
-                     ']. Using this instead.')
-        return outputFile
+                              '_batch_' + str(batchSize) +
+                              ('_datasetnorm' if normalization == 'dataset' \
+                               else '') +
+                              ('_' + storage if storage != 'floatX' else '') +
+                              '.hdf5')
+    exists = os.path.exists(outputFile)
+    if exists :
+        # files written before the manifest cannot be updated
+        with h5py.File(outputFile, mode='r') as hdf5 :
+            legacy = 'manifest' not in hdf5
+        if legacy or not incremental :
+            if log is not None :
+                log.info('HDF5 exists for this dataset [' + outputFile +
+                         ']. Using this instead.')
+            return outputFile
 
     # walk the directory structure
     if log is not None :
@@ -226,70 +262,98 @@ def hdf5Dataset(filepath, holdoutPercentage=.05, minTest=5,
         train, test, labels = readAndDivideData(rootpath, holdoutPercentage,
                                                 minTest, log)
 
+    # each image segment of a multi-image file becomes an example --
+    # the segments are expanded after the split, so the segments of a file
+    # are never divided between the train and test sets.
+    train = expandSegments(train, log=log)
+    test = expandSegments(test, log=log)
+
     if len(train) == 0 :
         raise ValueError('No training examples found [' + filepath + ']')
 
-    # create a hdf5 memmap --
-    # Here we create the handles to the data buffers. This operates on the
-    # assumption the dataset may not fit entirely in memory. The handles allow
-    # data to overflow and ultimately be stored entirely on disk. 
-    #
-    # Sample the directory for a probable chip size
-    size = mostCommon((t[0] for t in train),
-                      lambda f: os.path.getsize(f),
-                      sampleSize=50)
-    sizedFile = next((t[0] for t in train if os.path.getsize(t[0]) == size))
-    imageShape = list(getImageDims(sizedFile, log))
-
-    trainShape = [len(train) // batchSize, batchSize] + imageShape
-    # TODO: performs a floor, so if there is less than one batch no
-    #       data will be returned. Add a check for this.
-    trainShape = [len(train) // batchSize, batchSize] + imageShape
-    testShape = [len(test) // batchSize, batchSize] + imageShape
-
-    [handleH5, trainDataH5, trainIndicesH5, 
-     testDataH5, testIndicesH5, labelsH5] = \
-        createHDF5Labeled (outputFile, 
-                           trainShape, theano.config.floatX, np.int32,
-                           testShape, theano.config.floatX, np.int32,
-                           len(labels), log)
+    if exists :
+        hdf5 = h5py.File(outputFile, mode='r+')
+
+        # previously ingested imagery keeps its split and label index --
+        # any new labels are numbered after the existing labels.
+        allLabels = [l.decode('utf-8') if isinstance(l, bytes) else l \
+                     for l in hdf5['labels'][...]]
+        allLabels.extend(l for l in labels if l not in allLabels)
+        remap = np.asarray([allLabels.index(l) for l in labels], np.int32)
+        train.labels, test.labels = remap[train.labels], remap[test.labels]
+        trainKnown = set(Manifest(hdf5['manifest/train']).paths) \
+                     if 'manifest/train' in hdf5 else set()
+        testKnown = set(Manifest(hdf5['manifest/test']).paths) \
+                    if 'manifest/test' in hdf5 else set()
+        toTest = np.asarray([p in testKnown for p in train.paths], bool)
+        toTrain = np.asarray([p in trainKnown for p in test.paths], bool)
+        train, test = train[~toTest] + test[toTrain], \
+                      test[~toTrain] + train[toTest]
+        labels = allLabels
+        if len(labels) != hdf5['labels'].shape[0] :
+            del hdf5['labels']
+            hdf5.create_dataset('labels', shape=(len(labels),),
+                                dtype=h5py.special_dtype(vlen=str))
+    else :
+        # create a hdf5 memmap --
+        # Here we create the handles to the data buffers. This operates on
+        # the assumption the dataset may not fit entirely in memory. The
+        # handles allow data to overflow and ultimately be stored entirely on
+        # disk. The sets start empty and grow as the imagery is committed.
+        #
+        # Sample the directory for a probable chip size --
+        # only the image headers are read.
+        dims = probeImageDims(train.paths, sampleSize=50, log=log)[1]
+        imageShape = [int(d) for d in shapeDistribution(dims, log)[0][0]]
+
+        hdf5 = createHDF5Labeled(outputFile,
+                                 [0, batchSize] + imageShape,
+                                 storageDtype(storage), np.int32,
+                                 [0, batchSize] + imageShape,
+                                 storageDtype(storage), np.int32,
+                                 len(labels), log, compression=compression,
+                                 shuffle=shuffle, resizable=True)[0]
+        # the manifest marks the file as resumable from this point on
+        hdf5.require_group('manifest')
+        hdf5.flush()
 
     if log is not None :
         log.info('Writing data to HDF5')
 
-    # populate the indice buffers
-    workQueueIndices = queue.Queue()
-    workQueueIndices.put((trainIndicesH5, trainIndicesH5, train))
-    workQueueIndices.put((testIndicesH5, testIndicesH5, test))
-
-    # stream the indices into the buffers --
-    # we are threading this for efficiency
-    def copyIndices() :
-        while True :
-            dataH5, indicesH5, data = workQueueIndices.get()
-            dataH5[:] = np.resize(np.asarray(data).flatten()[1::2],
-                                  indicesH5.shape).astype(np.int32)[:]
-            workQueueIndices.task_done()
-    for ii in range(2) :
-        thread = threading.Thread(target=copyIndices)
-        thread.daemon = True
-        thread.start()
-    workQueueIndices.join()
-
-    # read the image data
+    # read the image data --
+    # TODO: performs a floor, so if there is less than one batch no
+    #       data will be returned. Add a check for this.
     threads = multiprocessing.cpu_count()
-    readDataset(trainDataH5, train, trainShape, batchSize, threads, log)
-    readDataset(testDataH5, test, testShape, batchSize, threads, log)
-
-    # stream in the label in string form
-    labelsH5[:] = labels[:]
-
-    if log is not None :
-        log.info('Flushing to disk')
+    try :
+        # with dataset statistics, a new file is written unnormalized and
+        # standardized once the statistics are known. Once standardized,
+        # updates are standardized with the stored statistics as decoded.
+        # uint8 holds the raw pixels, and is normalized when dequantized.
+        norm, datasets = 'image', ['train/data', 'test/data']
+        if storage == 'uint8' :
+            norm = None
+        elif normalization == 'dataset' :
+            norm = prepareStatistics(hdf5, datasets, log)
+
+        for split, items in (('train', train), ('test', test)) :
+            updateSplit(hdf5, split, list(items.paths), items.labels,
+                        threads, engine, log, items.sizes, items.mtimes,
+                        norm)
+
+        if normalization == 'dataset' and norm is None and \
+           storage != 'uint8' :
+            finalizeStatistics(hdf5, datasets, log)
+        finalizeStorage(hdf5, datasets, storage, normalization, log)
+
+        # stream in the label in string form
+        hdf5['labels'][:] = labels[:]
+    finally :
+        if log is not None :
+            log.info('Flushing to disk')
 
-    # write it to disk    
-    handleH5.flush()
-    handleH5.close()
+        # write it to disk    
+        hdf5.flush()
+        hdf5.close()
 
     # return the output filename
     return outputFile
@@ -306,6 +370,7 @@ def ingestImagery(filepath, shared=True, log=None, **kwargs) :
                         data will ultimately determine how its loaded.
        log      : Logger for tracking the progress
        kwargs   : Any parameters needed to override defaults in hdf5Dataset
+                  (eg. engine='process' to decode in worker processes)
        return   :
            Format -- 
            (trainData, trainLabel), (testData, testLabel), labels
@@ -332,8 +397,14 @@ def ingestImagery(filepath, shared=True, log=None, **kwargs) :
     # Load the dataset to memory
     train, test, labels = readHDF5(filepath, log)
 
-    # calculate the memory needed by this dataset
+    # calculate the memory needed by this dataset --
+    # quantized data remains in its stored type on a device which accepts it.
+    from dataset.quantize import getQuantization
+    from dataset.shared import compactShared
     dt = [4., 4., 4., 4.] if t.config.floatX == 'float32' else [8., 4., 8., 4.]
+    for ii, data in ((0, train[0]), (2, test[0])) :
+        if getQuantization(data) is not None and compactShared() :
+            dt[ii] = float(data.dtype.itemsize)
     dataMemoryConsumption = \
         np.prod(np.asarray(train[0].shape, dtype=np.float32)) * dt[0] + \
         np.prod(np.asarray(train[1].shape, dtype=np.float32)) * dt[1] + \
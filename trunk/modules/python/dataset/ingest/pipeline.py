@@ -0,0 +1,492 @@
+import numpy as np
+
+class StagingSlots () :
+    '''A fixed pool of mini-batch sized staging buffers. The number of slots
+       is the memory ceiling of the ingest, as no stage may hold a batch
+       without first acquiring a slot.
+
+       numSlots   : Number of mini-batch buffers to allocate
+       batchShape : Shape of a mini-batch (batchSize, channels, rows, cols)
+       dtype      : Data type of the buffers
+       shared     : Allocate the buffers in shared memory so they may be
+                    filled by worker processes
+    '''
+    def __init__ (self, numSlots, batchShape, dtype, shared=False) :
+        from six.moves import queue
+        self._batchShape = tuple(batchShape)
+        self._dtype = np.dtype(dtype)
+        if shared :
+            from multiprocessing.sharedctypes import RawArray
+            self.raw = [RawArray(self._dtype.char,
+                                 int(np.prod(self._batchShape))) \
+                        for ii in range(numSlots)]
+            self._views = [slotView(raw, self._batchShape, self._dtype) \
+                           for raw in self.raw]
+        else :
+            self.raw = None
+            self._views = [np.ndarray(self._batchShape, self._dtype) \
+                           for ii in range(numSlots)]
+        self._free = queue.Queue()
+        for ii in range(numSlots) :
+            self._free.put(ii)
+
+    def acquire(self) :
+        '''Block until a slot is free and return its index.'''
+        return self._free.get()
+    def release(self, slotIndex) :
+        '''Return the slot to the pool once its contents are committed.'''
+        self._free.put(slotIndex)
+    def view(self, slotIndex) :
+        '''Return the numpy.ndarray for the slot.'''
+        return self._views[slotIndex]
+
+def slotView(raw, batchShape, dtype) :
+    '''Wrap a shared memory buffer as a mini-batch shaped numpy.ndarray.'''
+    return np.frombuffer(raw, dtype=dtype).reshape(batchShape)
+
+def padInto(out, imgData) :
+    '''Zero-pad the image into the target buffer. This is the equivalent of
+       reader.padImageData, but writes directly into the staging buffer
+       instead of allocating a padded copy.
+    '''
+    if imgData.shape == out.shape :
+        out[:] = imgData
+    else :
+        out.fill(0)
+        out[tuple(slice(0, d) for d in imgData.shape)] = imgData
+
+def decodeBatch(batch, imageFiles, log=None, norm='image') :
+    '''Decode, normalize and pad each image into the mini-batch buffer.
+
+       NOTE: reader.readImage decodes and normalizes directly into the slot
+             of the buffer, so no full image temporaries are allocated.
+    '''
+    from dataset.reader import readImage
+    for ii, imageFile in enumerate(imageFiles) :
+        readImage(imageFile, log, batch[ii], norm)
+
+# process-local state for the decode workers --
+# the pool initializer populates these so the shared memory slots are
+# inherited by each worker rather than pickled with every job.
+_workerSlots = None
+
+def _initDecodeWorker(raw, batchShape, dtype) :
+    '''Setup the process-local handles to the shared memory slots, and
+       import the decoders once for the life of the worker.
+    '''
+    global _workerSlots
+    from dataset.reader import preloadDecoders
+    _workerSlots = [slotView(r, batchShape, dtype) for r in raw]
+    preloadDecoders()
+
+def _decodeBatchWorker(slotIndex, imageFiles, norm='image') :
+    '''Decode an entire mini-batch into the shared memory slot. This runs
+       in a worker process, so the decode is not bound by the parent's GIL.
+       Errors are returned rather than raised so the parent can release the
+       slot and stop the pipeline.
+    '''
+    try :
+        decodeBatch(_workerSlots[slotIndex], imageFiles, norm=norm)
+        return slotIndex, None
+    except Exception as ex :
+        return slotIndex, ex
+
+def ingestBatches(dataH5, imageFiles, numBatches, batchShape, dtype,
+                  workers, engine='thread', numSlots=None, log=None,
+                  startBatch=0, commit=None, norm='image') :
+    '''Stream the imagery into the HDF5 dataset as a staged pipeline --
+
+           list -> decode/normalize/pad -> reorder -> write
+
+       Each stage is connected by a bounded queue, and the decode stage must
+       acquire a staging slot before it accepts a job, so the memory held by
+       the ingest never exceeds numSlots mini-batches. Completed batches pass
+       through a reorder buffer, which releases them to the single writer in
+       sequential slice order. This keeps the HDF5 writes contiguous on disk.
+
+       dataH5     : HDF5 dataset to populate (numBatches, batchSize, ...)
+       imageFiles : List of image paths to read
+       numBatches : Number of mini-batches to write
+       batchShape : Shape of a mini-batch (batchSize, channels, rows, cols)
+       dtype      : Data type of the staging buffers
+       workers    : Number of concurrent decoders
+       engine     : 'thread' decodes within this process, 'process' decodes
+                    in a pool of worker processes to avoid the GIL
+       numSlots   : Number of staging buffers. Defaults to twice the workers
+       log        : Logger to use
+       startBatch : Batch of dataH5 which receives the first batch of images
+       commit     : Optional callback receiving the index of each batch
+                    after it is written, so progress may be recorded
+       norm       : Normalization of each image, as in reader.readImage
+    '''
+    import threading
+    from six.moves import queue
+
+    if engine not in ('thread', 'process') :
+        raise ValueError('Unsupported ingest engine [' + str(engine) + ']')
+    if numBatches <= 0 :
+        return
+    batchSize = batchShape[0]
+    numSlots = 2 * workers if numSlots is None else max(numSlots, 1)
+    slots = StagingSlots(numSlots, batchShape, dtype, engine == 'process')
+    doneQueue = queue.Queue()
+    stop = threading.Event()
+
+    if log is not None :
+        log.debug('Ingesting [' + str(numBatches) + '] batches with [' +
+                  str(workers) + '] ' + engine + ' workers and [' +
+                  str(numSlots) + '] staging slots')
+
+    def listBatches() :
+        '''Yield the jobs lazily, so the listing is never held in a queue.'''
+        for ii in range(numBatches) :
+            if stop.is_set() :
+                return
+            yield ii, imageFiles[ii*batchSize:(ii+1)*batchSize]
+
+    threads, pool = [], None
+    if engine == 'thread' :
+        jobQueue = queue.Queue(maxsize=workers)
+
+        def listStage() :
+            for job in listBatches() :
+                jobQueue.put(job)
+            for ii in range(workers) :
+                jobQueue.put(None)
+
+        def decodeStage() :
+            while True :
+                # acquire the slot before the job -- this ensures the oldest
+                # outstanding batch always holds a slot and the reorder buffer
+                # cannot starve the pipeline.
+                slotIndex = slots.acquire()
+                job = jobQueue.get()
+                if job is None :
+                    slots.release(slotIndex)
+                    return
+                index, files = job
+                try :
+                    decodeBatch(slots.view(slotIndex), files, log, norm)
+                    doneQueue.put((index, slotIndex, None))
+                except Exception as ex :
+                    doneQueue.put((index, slotIndex, ex))
+
+        threads.append(threading.Thread(target=listStage))
+        threads.extend(threading.Thread(target=decodeStage) \
+                       for ii in range(workers))
+    else :
+        import multiprocessing
+        pool = multiprocessing.Pool(workers, _initDecodeWorker,
+                                    (slots.raw, batchShape, np.dtype(dtype)))
+
+        def listStage() :
+            for index, files in listBatches() :
+                slotIndex = slots.acquire()
+                pool.apply_async(
+                    _decodeBatchWorker, (slotIndex, files, norm),
+                    callback=lambda ret, index=index :
+                        doneQueue.put((index,) + tuple(ret)),
+                    # a worker which dies, or whose result cannot be
+                    # pickled, must still report so the writer wakes
+                    error_callback=lambda ex, index=index,
+                                          slotIndex=slotIndex :
+                        doneQueue.put((index, slotIndex, ex)))
+
+        threads.append(threading.Thread(target=listStage))
+
+    for thread in threads :
+        thread.daemon = True
+        thread.start()
+
+    # the writer is the only consumer of the HDF5 handle --
+    # batches are held in the reorder buffer until all preceding slices
+    # have been written.
+    reorder = {}
+    nextIndex = 0
+    try :
+        while nextIndex < numBatches :
+            index, slotIndex, error = doneQueue.get()
+            if error is not None :
+                raise error
+            reorder[index] = slotIndex
+            while nextIndex in reorder :
+                slotIndex = reorder.pop(nextIndex)
+                dataH5[startBatch + nextIndex] = slots.view(slotIndex)
+                slots.release(slotIndex)
+                if commit is not None :
+                    commit(startBatch + nextIndex)
+                nextIndex += 1
+    finally :
+        stop.set()
+        if pool is not None :
+            if nextIndex < numBatches :
+                pool.terminate()
+            else :
+                pool.close()
+            pool.join()
+
+def capReservoir(shuffleSize, chipShape, dtype, log=None) :
+    '''Limit the shuffle reservoir to half the available CPU memory, leaving
+       the same gigabyte of headroom as checkAvailableMemory.
+
+       shuffleSize : Requested number of chips in the reservoir
+       chipShape   : Shape of a chip (channels, rows, cols)
+       dtype       : Data type of the reservoir
+       log         : Logger to use
+       return      : Number of chips the reservoir may hold
+    '''
+    import psutil
+    if shuffleSize <= 0 :
+        return 0
+    chipBytes = int(np.prod(chipShape)) * np.dtype(dtype).itemsize
+    availableCPUMem = psutil.virtual_memory()[1] - 2 ** 30
+    maxSize = max(availableCPUMem // 2, 0) // max(chipBytes, 1)
+    if shuffleSize > maxSize :
+        if log is not None :
+            log.warn('Shuffle reservoir of [' + str(shuffleSize) +
+                     '] chips exceeds the available memory. Reducing it ' +
+                     'to [' + str(maxSize) + '] chips.')
+        shuffleSize = int(maxSize)
+    return shuffleSize
+
+class ChipReservoir () :
+    '''A fixed-size shuffle buffer of chips. Once the reservoir is full, each
+       incoming chip replaces a randomly selected resident, which is evicted
+       to the output. This mixes the chips of many images while holding only
+       shuffleSize chips in memory.
+
+       shuffleSize : Number of chips held by the reservoir
+       chipShape   : Shape of a chip (channels, rows, cols)
+       dtype       : Data type of the reservoir
+       rng         : numpy.random.RandomState for the replacement
+    '''
+    def __init__ (self, shuffleSize, chipShape, dtype, rng=None) :
+        self._buffer = np.ndarray((shuffleSize,) + tuple(chipShape), dtype)
+        self._count = 0
+        self._rng = np.random.RandomState() if rng is None else rng
+
+    def add(self, chips) :
+        '''Insert the chips and return those evicted (numEvicted, ...).'''
+        size = self._buffer.shape[0]
+        fill = min(len(chips), size - self._count)
+        self._buffer[self._count:self._count + fill] = chips[:fill]
+        self._count += fill
+
+        # replace distinct residents, so a block never evicts its own chips
+        evicted = []
+        for start in range(fill, len(chips), size) :
+            block = chips[start:start + size]
+            replace = self._rng.choice(size, len(block), replace=False)
+            evicted.append(self._buffer[replace])
+            self._buffer[replace] = block
+        return np.concatenate(evicted) if len(evicted) > 0 else \
+               self._buffer[:0]
+
+    def drain(self) :
+        '''Return the remaining chips in random order and empty the
+           reservoir.
+        '''
+        chips = self._buffer[self._rng.permutation(self._count)]
+        self._count = 0
+        return chips
+
+class BatchAppender () :
+    '''Append chips to a growable HDF5 dataset (numBatches, batchSize, ...)
+       one full mini-batch at a time. A partial mini-batch is staged until
+       enough chips arrive to complete it.
+
+       dataH5    : HDF5 dataset with maxshape None along the first axis
+       batchSize : Size of a mini-batch
+    '''
+    def __init__ (self, dataH5, batchSize) :
+        self._dataH5 = dataH5
+        self._batch = np.ndarray((batchSize,) + dataH5.shape[2:],
+                                 dataH5.dtype)
+        self._count = 0
+        self.numBatches = dataH5.shape[0]
+
+    def _append(self, batches) :
+        self._dataH5.resize(self.numBatches + batches.shape[0], axis=0)
+        self._dataH5[self.numBatches:] = batches
+        self.numBatches += batches.shape[0]
+
+    def write(self, chips) :
+        batchSize = self._batch.shape[0]
+
+        # complete the staged mini-batch
+        fill = min(len(chips), batchSize - self._count)
+        self._batch[self._count:self._count + fill] = chips[:fill]
+        self._count += fill
+        if self._count < batchSize :
+            return
+        self._append(self._batch[np.newaxis])
+        self._count = 0
+
+        # the full batches are written directly from the chips
+        numFull = (len(chips) - fill) // batchSize
+        stop = fill + numFull * batchSize
+        if numFull > 0 :
+            self._append(np.reshape(chips[fill:stop],
+                                    (numFull,) + self._batch.shape))
+        self._count = len(chips) - stop
+        self._batch[:self._count] = chips[stop:]
+
+    def getNumDiscarded(self) :
+        '''Number of chips in the incomplete mini-batch.'''
+        return self._count
+
+def chipImage(imageFile, chipFunc, chipArgs, log=None) :
+    '''Chip the image and materialize its chips. The chipping function is
+       handed the path, so formats supporting windowed reads only read the
+       chips rather than decoding the whole image.
+    '''
+    return chipFunc(imageFile, **chipArgs).materialize()
+
+def _chipImageWorker(imageFile, chipFunc, chipArgs) :
+    '''Chip the image in a worker process. Errors are returned rather than
+       raised so the parent can decide whether to skip the image.
+    '''
+    try :
+        return chipImage(imageFile, chipFunc, chipArgs), None
+    except Exception as ex :
+        return None, ex
+
+def ingestChips(dataH5, imageFiles, chipFunc, chipArgs, workers,
+                engine='thread', shuffleSize=0, maxPending=None, rng=None,
+                log=None) :
+    '''Stream chipped imagery into a growable HDF5 dataset --
+
+           list -> decode/chip -> reservoir shuffle -> append
+
+       The number of images in flight is bounded by maxPending, and the
+       reservoir holds at most shuffleSize chips, so the memory held by the
+       ingest does not depend on the number of images. Images which cannot
+       be read are skipped. Any chips which do not fill the final mini-batch
+       are discarded.
+
+       dataH5      : HDF5 dataset (0, batchSize, channels, rows, cols) with
+                     maxshape None along the first axis
+       imageFiles  : List of image paths to read
+       chipFunc    : Chipping function returning a dataset.chip.ChipView
+       chipArgs    : Dictionary of chipping function parameters
+       workers     : Number of concurrent decoders
+       engine      : 'thread' decodes within this process, 'process' decodes
+                     in a pool of worker processes to avoid the GIL
+       shuffleSize : Number of chips in the shuffle reservoir. Zero writes the
+                     chips in decode order. The reservoir is limited to the
+                     available memory (see capReservoir).
+       maxPending  : Number of images in flight. Defaults to twice the workers
+       rng         : numpy.random.RandomState for the reservoir
+       log         : Logger to use
+       return      : Number of mini-batches in the dataset
+    '''
+    import threading
+    from time import time
+    from six.moves import queue
+
+    if engine not in ('thread', 'process') :
+        raise ValueError('Unsupported ingest engine [' + str(engine) + ']')
+    maxPending = 2 * workers if maxPending is None else max(maxPending, 1)
+    pending = threading.Semaphore(maxPending)
+    doneQueue = queue.Queue()
+    stop = threading.Event()
+    appender = BatchAppender(dataH5, dataH5.shape[1])
+    shuffleSize = capReservoir(shuffleSize, dataH5.shape[2:], dataH5.dtype,
+                               log)
+    reservoir = ChipReservoir(shuffleSize, dataH5.shape[2:], dataH5.dtype,
+                              rng) if shuffleSize > 0 else None
+
+    if log is not None :
+        log.debug('Chipping [' + str(len(imageFiles)) + '] images with [' +
+                  str(workers) + '] ' + engine + ' workers and a [' +
+                  str(shuffleSize) + '] chip reservoir')
+
+    def listImages() :
+        '''Yield the jobs lazily, once an image may be put in flight.'''
+        for imageFile in imageFiles :
+            pending.acquire()
+            if stop.is_set() :
+                return
+            yield imageFile
+
+    threads, pool = [], None
+    if engine == 'thread' :
+        jobQueue = queue.Queue(maxsize=workers)
+
+        def listStage() :
+            for imageFile in listImages() :
+                jobQueue.put(imageFile)
+            for ii in range(workers) :
+                jobQueue.put(None)
+
+        def decodeStage() :
+            while True :
+                imageFile = jobQueue.get()
+                if imageFile is None :
+                    return
+                try :
+                    doneQueue.put((imageFile, chipImage(
+                        imageFile, chipFunc, chipArgs, log), None))
+                except Exception as ex :
+                    doneQueue.put((imageFile, None, ex))
+
+        threads.append(threading.Thread(target=listStage))
+        threads.extend(threading.Thread(target=decodeStage) \
+                       for ii in range(workers))
+    else :
+        import multiprocessing
+        from dataset.reader import preloadDecoders
+        pool = multiprocessing.Pool(workers, preloadDecoders)
+
+        def listStage() :
+            for imageFile in listImages() :
+                pool.apply_async(
+                    _chipImageWorker, (imageFile, chipFunc, chipArgs),
+                    callback=lambda ret, imageFile=imageFile :
+                        doneQueue.put((imageFile,) + tuple(ret)),
+                    error_callback=lambda ex, imageFile=imageFile :
+                        doneQueue.put((imageFile, None, ex)))
+
+        threads.append(threading.Thread(target=listStage))
+
+    for thread in threads :
+        thread.daemon = True
+        thread.start()
+
+    # the writer is the only consumer of the HDF5 handle
+    numChips, numDone = 0, 0
+    timer = time()
+    try :
+        while numDone < len(imageFiles) :
+            imageFile, chips, error = doneQueue.get()
+            numDone += 1
+            pending.release()
+            if isinstance(error, IOError) :
+                if log is not None :
+                    log.warning('Skipping unreadable image [' + imageFile +
+                                ']: ' + str(error))
+                continue
+            elif error is not None :
+                raise error
+            numChips += len(chips)
+            appender.write(chips if reservoir is None else
+                           reservoir.add(chips))
+        if reservoir is not None :
+            appender.write(reservoir.drain())
+    finally :
+        stop.set()
+        # wake the list stage should it be waiting on an image slot
+        pending.release()
+        if pool is not None :
+            if numDone < len(imageFiles) :
+                pool.terminate()
+            else :
+                pool.close()
+            pool.join()
+
+    if log is not None :
+        log.info('Ingested [' + str(numChips) + '] chips from [' +
+                 str(numDone) + '] images in ' + str(time() - timer) +
+                 's. Discarded [' + str(appender.getNumDiscarded()) +
+                 '] chips of the partial mini-batch')
+    return appender.numBatches
@@ -1,7 +1,9 @@
 import os
 import numpy as np
 
-def hdf5Dataset(filepaths, batchSize=1, log=None, chipFunc=None, **kwargs) :
+def hdf5Dataset(filepaths, batchSize=1, log=None, chipFunc=None,
+                engine='thread', shuffleSize=0, incremental=True,
+                normalization='image', storage='floatX', **kwargs) :
     '''Create a pickle out of a directory structure. The directory structure
        is assumed to be a series of directories, each contains imagery assigned
        the label of the directory name.
@@ -12,19 +14,56 @@ def hdf5Dataset(filepaths, batchSize=1, log=None, chipFunc=None, **kwargs) :
        batchSize         : Size of a mini-batch
        log               : Logger to use
        chipFunc          : Chipping function to use
+       engine            : Decode engine to use -- 'thread' or 'process'
+       shuffleSize       : Number of chips held in the shuffle reservoir.
+                           This mixes the chips across images, and zero
+                           writes the chips of each image contiguously.
+       incremental       : Update an existing file against the directories,
+                           so only new or changed imagery is decoded. False
+                           uses an existing file as-is.
+                           NOTE: Chipped files are always used as-is, as the
+                                 chips do not map one-to-one onto files.
+       normalization     : 'image' normalizes each image on its own, while
+                           'dataset' standardizes the imagery with the
+                           per-channel statistics of the whole set. These are
+                           stored in the train/data attributes for inference.
+                           NOTE: Chipped files are normalized per image.
+       storage           : Pixel type stored -- 'floatX', 'float16' or
+                           'uint8'. See dataset.ingest.labeled.hdf5Dataset.
+                           'uint8' requires 'dataset' normalization.
+                           NOTE: Chipped files may not be stored as 'uint8'.
        **kwargs          : Chipping function parameters
     '''
+    import h5py
+    from multiprocessing import cpu_count
     from dataset.hdf5 import createHDF5Unlabeled
     from dataset.shuffle import naiveShuffle
+    from dataset.quantize import storageDtype, finalizeStorage, \
+                                 checkNormalization
+
+    if normalization not in ('image', 'dataset') :
+        raise ValueError('Unsupported normalization [' + str(normalization) +
+                         ']')
+    if normalization == 'dataset' and chipFunc is not None :
+        raise ValueError('Dataset normalization is not supported when ' +
+                         'chipping.')
+    if storage == 'uint8' and chipFunc is not None :
+        raise ValueError('uint8 storage is not supported when chipping.')
+    checkNormalization(storage, normalization)
 
     # place the hdf5 archive in the root directory
     rootpath = os.path.commonprefix(filepaths)
 
-    # get the image dimensions
-    images = os.listdir(filepaths[0])
+    # get the image dimensions --
+    # the headers of a sample are probed for the most common shape.
+    images = [os.path.join(filepaths[0], im) \
+              for im in os.listdir(filepaths[0]) \
+              if not im.endswith('.hdf5')]
     if len(images) > 0 :
-        from dataset.reader import getImageDims
-        imageShape = getImageDims(os.path.join(filepaths[0], images[0]))
+        from dataset.reader import probeImageDims, shapeDistribution
+        dims = probeImageDims(images, sampleSize=50, log=log)[1]
+        imageShape = tuple(int(d) for d in \
+                           shapeDistribution(dims, log)[0][0])
     else :
         raise ValueError('No files found in [' + filepaths[0] + ']')
 
@@ -38,33 +77,41 @@ def hdf5Dataset(filepaths, batchSize=1, log=None, chipFunc=None, **kwargs) :
     chipSizeStr = '_' + str(chipSize[0]) + 'x' + str(chipSize[1])
     outputFile = os.path.join(rootpath, os.path.basename(rootpath) +
                                   '_unlabeled' + chipName + chipSizeStr +
-                                  '_batch_' + str(batchSize) + '.hdf5')
-
-    if os.path.exists(outputFile) :
-        if log is not None :
-            log.info('HDF5 exists for this dataset [' + outputFile +
-                     ']. Using this instead.')
-        return outputFile
-
-    # open the HDF5 file --
-    # HDF5 has the ability to be dynamically scaled. In this particular case
-    # we don't know the number of files yet, especially if chipFunc was
-    # specified, so this allows the file to scale to the appropriate size.
-    [handleH5, trainDataH5] = createHDF5Unlabeled(
-        outputFile, imageShape, np.float32, 
-        tuple([None, None] + list(chipSize)), log)
+                                  '_batch_' + str(batchSize) +
+                                  ('_datasetnorm' \
+                                   if normalization == 'dataset' else '') +
+                                  ('_' + storage \
+                                   if storage != 'floatX' else '') +
+                                  '.hdf5')
+
+    exists = os.path.exists(outputFile)
+    if exists :
+        # files written before the manifest cannot be updated
+        with h5py.File(outputFile, mode='r') as hdf5 :
+            legacy = 'manifest' not in hdf5
+        if legacy or not incremental or chipFunc is not None :
+            if log is not None :
+                log.info('HDF5 exists for this dataset [' + outputFile +
+                         ']. Using this instead.')
+            return outputFile
 
     # read the directory
     images = []
     for filepath in filepaths :
         images.extend([os.path.join(filepath, im) \
                        for im in os.listdir(filepath)])
+    if outputFile in images :
+        images.remove(outputFile)
+
+    # each image segment of a multi-image file is an image of its own
+    from dataset.reader import expandSegments
+    from dataset.scan import FileTable
+    images = list(expandSegments(FileTable(images), log=log).paths)
 
     # randomize the data across categories -- otherwise its not stochastic --
-    # NOTE: this is only pseudo-random because we are only randomizing the
-    #       files. If the user specifies a chipping utility these images will
-    #       be grouped contiguously. If the user desires complete stochasticity
-    #       they can chip the imagery to disk, and then use this function.
+    # NOTE: this only randomizes the files. If the user specifies a chipping
+    #       utility the chips of each image are grouped contiguously, unless
+    #       a shuffle reservoir is used to mix them across images.
     if log is not None :
         log.info('Shuffling the data for randomization')
     naiveShuffle(images)
@@ -72,25 +119,60 @@ def hdf5Dataset(filepaths, batchSize=1, log=None, chipFunc=None, **kwargs) :
     # walk through each file and either batch it directly or chip it according
     # to the user specified chipping utility.
     if chipFunc is not None :
-        # TODO: insert logic for chipping the imagery individually and 
-        #       batching appropriattely
-        raise NotImplementedError('Implement support for chipped ingest.')
-        #from dataset.reader import readImage
-        #from dataset.chip import prepareChips
-        #
-        #for im in images :
-        #    try :
-        #        # chip the image using the provided utility
-        #        chips = np.asarray(chipFunc(readImage(im, log), **kwargs))
-        #    except IOError : pass
+        from dataset.ingest.pipeline import ingestChips
+
+        # open the HDF5 file --
+        # HDF5 has the ability to be dynamically scaled. The number of chips
+        # is unknown until each image is read, so the dataset starts empty
+        # and grows one mini-batch at a time.
+        chipShape = [imageShape[0]] + list(chipSize)
+        [handleH5, trainDataH5] = createHDF5Unlabeled(
+            outputFile, [0, batchSize] + chipShape, storageDtype(storage),
+            tuple([None, batchSize] + chipShape), log)
+
+        try :
+            ingestChips(trainDataH5, images, chipFunc, kwargs, cpu_count(),
+                        engine, shuffleSize, log=log)
+            finalizeStorage(handleH5, ['train/data'], storage, normalization,
+                            log)
+        except :
+            # never leave a partial file, as it would be reused next time
+            handleH5.close()
+            os.remove(outputFile)
+            raise
     else :
-        from dataset.ingest.labeled import readDataset
-        from multiprocessing import cpu_count
+        from dataset.manifest import updateSplit
+        from dataset.statistics import prepareStatistics, finalizeStatistics
 
         # read all imagery directly --
-        # this assume all imagery is of the same size
-        readDataset(trainDataH5, images, imageShape, batchSize,
-                    cpu_count(), log)
+        # this assume all imagery is of the same size. The manifest records
+        # each image, so a later run only decodes new or changed imagery.
+        if exists :
+            handleH5 = h5py.File(outputFile, mode='r+')
+        else :
+            handleH5 = createHDF5Unlabeled(
+                outputFile, [0, batchSize] + list(imageShape),
+                storageDtype(storage),
+                tuple([None, batchSize] + list(imageShape)), log)[0]
+            handleH5.require_group('manifest')
+            handleH5.flush()
+        try :
+            # a new file is standardized once its statistics are known,
+            # while uint8 holds the raw pixels
+            norm = None if storage == 'uint8' else \
+                   prepareStatistics(handleH5, ['train/data'], log) \
+                   if normalization == 'dataset' else 'image'
+            updateSplit(handleH5, 'train', images,
+                        np.full(len(images), -1, dtype=np.int32),
+                        cpu_count(), engine, log, norm=norm)
+            if normalization == 'dataset' and norm is None and \
+               storage != 'uint8' :
+                finalizeStatistics(handleH5, ['train/data'], log)
+            finalizeStorage(handleH5, ['train/data'], storage,
+                            normalization, log)
+        except :
+            handleH5.close()
+            raise
 
     if log is not None :
         log.info('Flushing to disk')
@@ -104,7 +186,7 @@ def hdf5Dataset(filepaths, batchSize=1, log=None, chipFunc=None, **kwargs) :
 
 
 def ingestImagery(filepaths, shared=True, batchSize=1,
-                  log=None, chipFunc=None, **kwargs) :
+                  log=None, chipFunc=None, shuffleSize=0, **kwargs) :
     '''Load the unlabeled dataset into memory. This reads and chips any
        imagery found within the filepath according the the options sent to the
        function.
@@ -115,11 +197,13 @@ def ingestImagery(filepaths, shared=True, batchSize=1,
        batchSize: Size of a mini-batch
        log      : Logger for tracking the progress
        chipFunc : Chipping utility to use on each image
-       kwargs   : Parameters specific for the chipping function
-       return   : (trainingData, pixelRegion={None})
+       shuffleSize: Number of chips in the ingest shuffle reservoir
+       kwargs   : Parameters specific for the chipping function. These may
+                  also be passed as a dictionary through kwargs=
+       return   : trainingData
     '''
     import theano.tensor as t
-    from dataset.pickle import readPickleZip
+    from dataset.hdf5 import readHDF5
     from dataset.ingest.labeled import checkAvailableMemory
 
     if not isinstance(filepaths, list) :
@@ -133,16 +217,24 @@ def ingestImagery(filepaths, shared=True, batchSize=1,
 
     # read the directory structure and chip it
     if os.path.isdir(filepaths[0]) :
+        chipArgs = kwargs.pop('kwargs', {})
+        chipArgs.update(kwargs)
         filepath = hdf5Dataset(filepaths, batchSize=batchSize, log=log,
-                               chipFunc=chipFunc, **kwargs['kwargs'])
+                               chipFunc=chipFunc, shuffleSize=shuffleSize,
+                               **chipArgs)
     else :
         filepath = filepaths[0]
 
     # Load the dataset to memory
-    train = readPickleZip(filepath, log)
+    (train, _), _, _ = readHDF5(filepath, log)
 
-    # calculate the memory needed by this dataset
+    # calculate the memory needed by this dataset --
+    # quantized data remains in its stored type on a device which accepts it.
+    from dataset.quantize import getQuantization
+    from dataset.shared import compactShared
     dt = 4. if t.config.floatX == 'float32' else 8.
+    if getQuantization(train) is not None and compactShared() :
+        dt = float(train.dtype.itemsize)
     dataMemoryConsumption = np.prod(np.asarray(
         train.shape, dtype=np.float32)) * dt
 
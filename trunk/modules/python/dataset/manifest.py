@@ -0,0 +1,312 @@
+import os
+import hashlib
+import numpy as np
+from time import time
+
+def fileHash(filepath, blockSize=2**20) :
+    '''Hash the contents of the file. Each segment of a multi-image file is
+       identified by the hash of the whole file.
+    '''
+    from dataset.scan import splitSegment
+    sha = hashlib.sha1()
+    with open(splitSegment(filepath)[0], 'rb') as f :
+        for block in iter(lambda : f.read(blockSize), b'') :
+            sha.update(block)
+    return sha.hexdigest()
+
+def hashFiles(filepaths, workers) :
+    '''Hash the files concurrently. hashlib releases the GIL on large
+       buffers, so threads are sufficient.
+    '''
+    from multiprocessing.pool import ThreadPool
+    if len(filepaths) == 0 :
+        return []
+    pool = ThreadPool(workers)
+    try :
+        return pool.map(fileHash, filepaths, chunksize=16)
+    finally :
+        pool.terminate()
+        pool.join()
+
+def statFiles(filepaths) :
+    '''Return the sizes and modification times of the files.'''
+    from dataset.scan import splitSegment
+    stats = [os.stat(splitSegment(f)[0]) for f in filepaths]
+    return np.array([s.st_size for s in stats], dtype=np.int64), \
+           np.array([s.st_mtime for s in stats], dtype=np.float64)
+
+class Manifest () :
+    '''The record of the files ingested into one split of a HDF5 dataset.
+       Each entry holds the path, size, modification time and content hash
+       of a file, its label, and the example slot it occupies. The slot is
+       the flat index (batch * batchSize + example) into the split, or -1
+       when the file did not fill a complete mini-batch. done marks the
+       slots committed to disk, so an interrupted ingest resumes from the
+       last committed batch.
+
+       group : Optional HDF5 group to read the manifest from
+    '''
+    columns = ['path', 'size', 'mtime', 'hash', 'label', 'slot', 'done']
+
+    def __init__ (self, group=None) :
+        if group is None or 'path' not in group :
+            self.paths = []
+            self.sizes = np.zeros(0, dtype=np.int64)
+            self.mtimes = np.zeros(0, dtype=np.float64)
+            self.hashes = np.zeros(0, dtype='S40')
+            self.labels = np.zeros(0, dtype=np.int32)
+            self.slots = np.zeros(0, dtype=np.int64)
+            self.done = np.zeros(0, dtype=np.bool_)
+        else :
+            self.paths = [p.decode('utf-8') if isinstance(p, bytes) else p \
+                          for p in group['path'][...]]
+            self.sizes = group['size'][...]
+            self.mtimes = group['mtime'][...]
+            self.hashes = group['hash'][...]
+            self.labels = group['label'][...]
+            self.slots = group['slot'][...]
+            self.done = group['done'][...]
+        self._lastSave = time()
+
+    def __len__ (self) :
+        return len(self.paths)
+
+    def append(self, paths, sizes, mtimes, hashes, labels) :
+        '''Add entries for files which have not been ingested.'''
+        self.paths.extend(paths)
+        self.sizes = np.concatenate((self.sizes, sizes))
+        self.mtimes = np.concatenate((self.mtimes, mtimes))
+        self.hashes = np.concatenate((self.hashes,
+                                      np.asarray(hashes, dtype='S40')))
+        self.labels = np.concatenate((self.labels,
+                                      np.asarray(labels, dtype=np.int32)))
+        self.slots = np.concatenate((self.slots,
+                                     np.full(len(paths), -1, np.int64)))
+        self.done = np.concatenate((self.done,
+                                    np.zeros(len(paths), np.bool_)))
+
+    def select(self, entries) :
+        '''Keep only the specified entries.'''
+        self.paths = [self.paths[ii] for ii in entries]
+        for name in ('sizes', 'mtimes', 'hashes', 'labels', 'slots',
+                     'done') :
+            setattr(self, name, getattr(self, name)[entries])
+
+    def write(self, group) :
+        '''Replace the manifest stored in the group.'''
+        import h5py
+        for name in Manifest.columns :
+            if name in group :
+                del group[name]
+        group.create_dataset('path', data=self.paths,
+                             dtype=h5py.special_dtype(vlen=str))
+        group.create_dataset('size', data=self.sizes)
+        group.create_dataset('mtime', data=self.mtimes)
+        group.create_dataset('hash', data=self.hashes)
+        group.create_dataset('label', data=self.labels)
+        group.create_dataset('slot', data=self.slots)
+        group.create_dataset('done', data=self.done)
+        group.file.flush()
+
+    def commit(self, group, entries, interval=30.) :
+        '''Mark the entries as written. The done flags are saved to disk at
+           most once per interval seconds.
+        '''
+        self.done[entries] = True
+        if time() - self._lastSave >= interval :
+            self.save(group)
+
+    def save(self, group) :
+        '''Save the done flags and flush the file.'''
+        group['done'][...] = self.done
+        group.file.flush()
+        self._lastSave = time()
+
+def planUpdate(manifest, paths, labels, batchSize, workers, log=None,
+               sizes=None, mtimes=None) :
+    '''Compare the files against the manifest and assign the example slots.
+
+       Unchanged files keep their slots. A file whose size or modification
+       time differs is hashed, and it is only decoded again if its contents
+       changed. The slots of removed files are filled by moving the
+       examples at the end of the split, followed by the new files. Files
+       which do not fill the last complete mini-batch are left unassigned.
+
+       manifest  : Manifest of the split. This is updated in place.
+       paths     : Files currently in the split
+       labels    : Label index of each file
+       batchSize : Size of a mini-batch
+       workers   : Number of concurrent hashing threads
+       log       : Logger to use
+       sizes     : Size of each file, if known from the directory scan
+       mtimes    : Modification time of each file, if known
+       return    : (numBatches, [(srcSlot, dstSlot)]) moves to perform
+    '''
+    timer = time()
+    if sizes is None or mtimes is None :
+        sizes, mtimes = statFiles(paths)
+    known = dict((p, ii) for ii, p in enumerate(manifest.paths))
+    present = np.zeros(len(manifest), dtype=np.bool_)
+    stale, new = [], []
+    for ii, path in enumerate(paths) :
+        entry = known.get(path)
+        if entry is None :
+            new.append(ii)
+            continue
+        present[entry] = True
+        if sizes[ii] != manifest.sizes[entry] or \
+           mtimes[ii] != manifest.mtimes[entry] :
+            stale.append((ii, entry))
+
+    # only the contents of changed or new files are read
+    hashes = hashFiles([paths[ii] for ii, entry in stale] +
+                       [paths[ii] for ii in new], workers)
+    numChanged = 0
+    for (ii, entry), digest in zip(stale, hashes[:len(stale)]) :
+        if manifest.hashes[entry] != digest.encode('ascii') :
+            manifest.done[entry] = False
+            numChanged += 1
+        manifest.hashes[entry] = digest
+        manifest.sizes[entry], manifest.mtimes[entry] = sizes[ii], mtimes[ii]
+
+    numRemoved = len(manifest) - int(np.sum(present))
+    manifest.select(np.nonzero(present)[0])
+    manifest.append([paths[ii] for ii in new], sizes[new], mtimes[new],
+                     hashes[len(stale):], np.asarray(labels)[new])
+    if log is not None :
+        log.info('Manifest has [' + str(len(new)) + '] new, [' +
+                 str(numChanged) + '] changed and [' + str(numRemoved) +
+                 '] removed files. Scanned in ' + str(time() - timer) + 's')
+
+    # the split holds the complete mini-batches --
+    # any assigned examples beyond the capacity are released first.
+    slots, done = manifest.slots, manifest.done
+    capacity = (len(manifest) // batchSize) * batchSize
+    assigned = np.nonzero(slots >= 0)[0]
+    if len(assigned) > capacity :
+        release = assigned[np.argsort(slots[assigned])][capacity:]
+        slots[release], done[release] = -1, False
+
+    # move the examples beyond the capacity into the vacated slots
+    taken = np.zeros(capacity, dtype=np.bool_)
+    taken[slots[(slots >= 0) & (slots < capacity)]] = True
+    holes = np.nonzero(~taken)[0]
+    movers = np.nonzero(slots >= capacity)[0]
+    moves = [(slots[ii], dst) for ii, dst in zip(movers, holes) if done[ii]]
+    slots[movers] = holes[:len(movers)]
+    holes = holes[len(movers):]
+
+    # fill the remaining slots with unassigned files
+    pending = np.nonzero(slots < 0)[0][:len(holes)]
+    slots[pending], done[pending] = holes, False
+    return capacity // batchSize, moves
+
+def slotEntries(manifest, numSlots) :
+    '''Map each slot to its manifest entry.'''
+    entries = np.full(numSlots, -1, dtype=np.int64)
+    assigned = np.nonzero(manifest.slots >= 0)[0]
+    entries[manifest.slots[assigned]] = assigned
+    return entries
+
+def decodeSlots(dataH5, imageFiles, slots, workers, commit=None, log=None,
+                norm='image') :
+    '''Decode individual images into their slots. This is used to patch
+       changed files and fill vacated slots, which are not contiguous.
+    '''
+    from multiprocessing.pool import ThreadPool
+    from dataset.reader import readImage
+    from dataset.ingest.pipeline import padInto
+    batchSize = dataH5.shape[1]
+    buf = np.ndarray(dataH5.shape[2:], dtype=dataH5.dtype)
+    pool = ThreadPool(workers)
+    try :
+        for slot, imgData in zip(slots, pool.imap(
+            lambda imageFile : readImage(imageFile, norm=norm), imageFiles)) :
+            padInto(buf, imgData)
+            dataH5[slot // batchSize, slot % batchSize] = buf
+            if commit is not None :
+                commit(slot)
+    finally :
+        pool.terminate()
+        pool.join()
+
+def updateSplit(hdf5, split, paths, labels, workers, engine='thread',
+                log=None, sizes=None, mtimes=None, norm='image') :
+    '''Bring the split of the HDF5 file up to date with the files. Only new
+       or changed files are decoded, and an interrupted update resumes from
+       the last committed batch when run again.
+
+       hdf5    : HDF5 file opened for writing. The split must contain a
+                 resizable data dataset, and optionally an indices dataset.
+       split   : Name of the split (ie. 'train' or 'test')
+       paths   : Files currently in the split
+       labels  : Label index of each file
+       workers : Number of concurrent decoders
+       engine  : Decode engine to use -- 'thread' or 'process'
+       log     : Logger to use
+       sizes   : Size of each file, if known from the directory scan
+       mtimes  : Modification time of each file, if known
+       norm    : Normalization of each image, as in reader.readImage
+    '''
+    from dataset.ingest.pipeline import ingestBatches
+    dataH5 = hdf5[split + '/data']
+    indicesH5 = hdf5.get(split + '/indices')
+    group = hdf5.require_group('manifest/' + split)
+    batchSize = dataH5.shape[1]
+    manifest = Manifest(group)
+    numBatches, moves = planUpdate(manifest, paths, labels, batchSize,
+                                   workers, log, sizes, mtimes)
+
+    # the vacated slots are filled before the manifest records the moves,
+    # so the source examples remain valid should this be interrupted.
+    for src, dst in moves :
+        dataH5[dst // batchSize, dst % batchSize] = \
+            dataH5[src // batchSize, src % batchSize]
+    manifest.write(group)
+    dataH5.resize(numBatches, axis=0)
+
+    entries = slotEntries(manifest, numBatches * batchSize)
+    if indicesH5 is not None :
+        indicesH5.resize(numBatches, axis=0)
+        indicesH5[...] = np.reshape(manifest.labels[entries],
+                                    indicesH5.shape)
+
+    # stream the mini-batches which are entirely outstanding through the
+    # pipeline, and patch any remaining slots individually
+    outstanding = np.reshape(~manifest.done[entries], (numBatches, batchSize))
+    fullBatches = np.all(outstanding, axis=1)
+    if log is not None :
+        log.info('Updating [' + split + '] with [' +
+                 str(int(np.sum(outstanding))) + '] outstanding examples of [' +
+                 str(numBatches * batchSize) + ']')
+
+    timer = time()
+    try :
+        batch = 0
+        while batch < numBatches :
+            if not fullBatches[batch] :
+                batch += 1
+                continue
+            stop = batch
+            while stop < numBatches and fullBatches[stop] :
+                stop += 1
+            ingestBatches(dataH5, [manifest.paths[ii] for ii in \
+                                   entries[batch*batchSize:stop*batchSize]],
+                          stop - batch, dataH5.shape[1:], dataH5.dtype,
+                          workers, engine, log=log, startBatch=batch,
+                          norm=norm,
+                          commit=lambda b : manifest.commit(
+                              group, entries[b*batchSize:(b+1)*batchSize]))
+            batch = stop
+
+        patch = np.nonzero(outstanding.ravel() &
+                           ~np.repeat(fullBatches, batchSize))[0]
+        decodeSlots(dataH5, [manifest.paths[ii] for ii in entries[patch]],
+                    patch, workers, lambda slot : manifest.commit(
+                        group, entries[slot]), log, norm)
+    finally :
+        manifest.save(group)
+
+    if log is not None :
+        log.info('Updated [' + split + '] in ' + str(time() - timer) + 's')
+    return numBatches
@@ -0,0 +1,180 @@
+import numpy as np
+import threading
+import atexit
+import weakref
+from timeit import default_timer as timer
+
+def _closeRef(ref) :
+    obj = ref()
+    if obj is not None :
+        obj.close()
+
+def closeAtExit(obj) :
+    '''Close the object during shutdown, should it still be alive. Only a
+       weak reference is registered, so the object and its buffers may be
+       collected once it is discarded.
+    '''
+    atexit.register(_closeRef, weakref.ref(obj))
+
+def readBatch(out, source, index) :
+    '''Read a single batch from the source into a preallocated buffer.
+       h5py datasets are read directly into the buffer, while numpy arrays
+       and memmaps are copied.
+    '''
+    if hasattr(source, 'read_direct') :
+        source.read_direct(out, np.s_[index])
+    else :
+        out[...] = source[index]
+
+class BatchPrefetcher () :
+    '''Read mini-batches from disk-backed datasets in the background. While
+       batch ii is being consumed, batches ii+1..ii+depth are read into a
+       fixed ring of preallocated buffers. Requests which arrive in order
+       are served from the ring, while an out of order request restarts the
+       read-ahead at the requested batch.
+
+       NOTE: The buffer handed out by get() is reused once the following
+             get() is called. Copy it if it must outlive the next request.
+
+       sources : List of datasets indexed by batch (ie. [data, labels]).
+                 These may be h5py.Dataset, numpy.memmap or numpy.ndarray.
+       depth   : Number of batches to read ahead
+       order   : Optional sequence of batch indices expected. Defaults to
+                 sequential order, wrapping at the end of the epoch.
+       log     : Logger to use
+    '''
+    def __init__ (self, sources, depth=2, order=None, log=None) :
+        self._sources = sources
+        self._numBatches = len(sources[0])
+        self._depth = max(1, min(depth, self._numBatches))
+        self._log = log
+
+        # allocate the ring -- one extra buffer is in use by the consumer
+        self._buffers = [[np.ndarray(s.shape[1:], s.dtype) for s in sources] \
+                         for ii in range(self._depth + 1)]
+        self._free = list(range(self._depth + 1))
+        self._ready = {}
+        self._inUse = None
+        self._loading = None
+        self._generation = 0
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self.setOrder(order)
+        self.resetStats()
+
+        self._thread = threading.Thread(target=self._readAhead)
+        self._thread.daemon = True
+        self._thread.start()
+
+        # ensure the read-ahead is not interrupted mid-read during shutdown
+        closeAtExit(self)
+
+    def setOrder(self, order=None) :
+        '''Specify the order batches will be requested. This allows the
+           read-ahead to follow shuffled epochs.
+        '''
+        with self._cond :
+            self._order = list(range(self._numBatches)) \
+                          if order is None else list(order)
+            self._position = dict((idx, ii) \
+                                  for ii, idx in enumerate(self._order))
+            # an empty source has nothing to read ahead
+            if len(self._order) > 0 :
+                self._seek(self._order[0])
+            else :
+                self._generation += 1
+                self._cursor = 0
+            self._cond.notify_all()
+
+    def resetStats(self) :
+        '''Reset the stall accounting.'''
+        self.stallTime = 0.
+        self.hits = 0
+        self.misses = 0
+
+    def _readAhead(self) :
+        while True :
+            with self._cond :
+                while not self._closed and (len(self._free) == 0 or
+                                            len(self._order) == 0) :
+                    self._cond.wait()
+                if self._closed :
+                    return
+                slot = self._free.pop()
+                index = self._order[self._cursor]
+                self._cursor = (self._cursor + 1) % len(self._order)
+                generation = self._generation
+                self._loading = (index, generation)
+
+            # read outside the lock so the consumer is never blocked on IO
+            error = None
+            try :
+                for buf, source in zip(self._buffers[slot], self._sources) :
+                    readBatch(buf, source, index)
+            except Exception as ex :
+                error = ex
+
+            with self._cond :
+                self._loading = None
+                if error is None and generation == self._generation and \
+                   index not in self._ready :
+                    self._ready[index] = slot
+                else :
+                    self._free.append(slot)
+                    if error is not None and generation == self._generation :
+                        self._error = error
+                self._cond.notify_all()
+
+    def _seek(self, index) :
+        '''Discard the read-ahead and restart it at the requested batch.'''
+        if index not in self._position :
+            raise IndexError('Batch [' + str(index) + '] is not in the ' +
+                             'prefetch order.')
+        self._generation += 1
+        self._error = None
+        self._free.extend(self._ready.values())
+        self._ready = {}
+        self._cursor = self._position[index]
+
+    def get(self, index) :
+        '''Return the buffers for the batch. This blocks if the batch has not
+           yet been read, and the time spent waiting is added to stallTime.
+        '''
+        with self._cond :
+            # the previous batch has been consumed
+            if self._inUse is not None :
+                self._free.append(self._inUse)
+                self._inUse = None
+                self._cond.notify_all()
+
+            # the batch is either staged, being read, or the next to be read
+            # by a read-ahead which has fallen behind.
+            if index in self._ready or \
+               self._loading == (index, self._generation) or \
+               (len(self._ready) == 0 and len(self._order) > 0 and
+                self._order[self._cursor] == index) :
+                self.hits += 1
+            else :
+                self.misses += 1
+                self._seek(index)
+                self._cond.notify_all()
+
+            start = timer()
+            while index not in self._ready :
+                if self._error is not None :
+                    error, self._error = self._error, None
+                    raise error
+                self._cond.wait()
+            self.stallTime += timer() - start
+
+            self._inUse = self._ready.pop(index)
+            return self._buffers[self._inUse]
+
+    def close(self) :
+        '''Stop the read-ahead thread and wait for any read in flight.'''
+        with self._cond :
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not threading.current_thread() :
+            self._thread.join()
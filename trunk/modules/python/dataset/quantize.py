@@ -0,0 +1,126 @@
+import numpy as np
+
+storageTypes = ('floatX', 'float16', 'uint8')
+
+def storageDtype(storage) :
+    '''Return the dtype of the pixels for the storage mode.
+
+       storage : 'floatX' stores theano.config.floatX pixels. 'float16' halves
+                 the storage, while 'uint8' stores the raw pixels of 8-bit
+                 imagery.
+    '''
+    import theano
+    if storage not in storageTypes :
+        raise ValueError('Unsupported storage [' + str(storage) + ']')
+    return np.dtype(theano.config.floatX if storage == 'floatX' else storage)
+
+def checkNormalization(storage, normalization) :
+    '''Reject the normalization if the storage cannot recover it. uint8
+       stores the raw pixels, and its dequantization is a single affine
+       transform per channel, so only the 'dataset' statistics apply to it.
+    '''
+    if storage == 'uint8' and normalization != 'dataset' :
+        raise ValueError('uint8 storage requires dataset normalization, ' +
+                         'as per-image normalization cannot be recovered ' +
+                         'from the raw pixels.')
+
+def writeQuantization(dataH5, scale, offset) :
+    '''Store the per-channel transform (data * scale + offset), which
+       recovers the floatX pixels from the stored pixels.
+    '''
+    dataH5.attrs['scale'] = np.asarray(scale, dtype=np.float32)
+    dataH5.attrs['offset'] = np.asarray(offset, dtype=np.float32)
+
+def getQuantization(data) :
+    '''Return the per-channel (scale, offset) which dequantizes the data, or
+       None if the data holds floatX pixels.
+
+       data : h5py.Dataset, or a theano.shared variable from
+              dataset.shared.toShared
+    '''
+    attrs = getattr(data, 'attrs', None)
+    if attrs is not None and 'scale' in attrs :
+        return attrs['scale'], attrs['offset']
+    return getattr(getattr(data, 'tag', None), 'quantization', None)
+
+def dequantize(data, quant, out=None) :
+    '''Recover the floatX pixels of a batch formatted
+       (..., numChannels, rows, cols).
+
+       data   : Stored pixels
+       quant  : Per-channel (scale, offset) from getQuantization
+       out    : Optional floatX buffer to write into
+       return : The dequantized pixels
+    '''
+    import theano
+    if out is None :
+        out = np.ndarray(data.shape, dtype=theano.config.floatX)
+    np.multiply(data, np.asarray(quant[0], out.dtype).reshape(-1, 1, 1),
+                out=out)
+    np.add(out, np.asarray(quant[1], out.dtype).reshape(-1, 1, 1), out=out)
+    return out
+
+def dequantizeVariable(x, quant) :
+    '''Dequantize a symbolic batch within the compiled graph. The stored
+       pixels are transferred to the device, and only cast to floatX there.
+
+       x      : theano variable of the stored pixels (..., numChannels,
+                rows, cols)
+       quant  : Per-channel (scale, offset), or None for floatX pixels
+       return : floatX theano variable
+    '''
+    import theano
+    if quant is None :
+        return x
+    floatX = theano.config.floatX
+    return theano.tensor.cast(x, floatX) * \
+           np.asarray(quant[0], floatX).reshape(-1, 1, 1) + \
+           np.asarray(quant[1], floatX).reshape(-1, 1, 1)
+
+def quantizedInput(data, name='quantizedInput') :
+    '''Create a symbolic batch input for the dtype of a quantized dataset.
+
+       data   : Dataset formatted (numBatches, batchSize, ...)
+       return : (input variable, dequantized floatX variable)
+    '''
+    import theano
+    var = theano.tensor.TensorType(str(data.dtype),
+                                   (False,) * (len(data.shape) - 1))(name)
+    return var, dequantizeVariable(var, getQuantization(data))
+
+def finalizeStorage(hdf5, datasets, storage, normalization, log=None) :
+    '''Record the dequantization of a compact storage mode.
+
+       float16 pixels are normalized as they are ingested, so they are only
+       cast. uint8 pixels are stored raw, and the transform standardizes
+       them with the dataset statistics recomputed over the training set.
+       These are stored, so inference may standardize its imagery with
+       dataset.statistics.loadStatistics. uint8 with per-image normalization
+       is rejected (see checkNormalization).
+
+       hdf5          : HDF5 file opened for writing
+       datasets      : Names of the datasets, starting with the training data
+       storage       : Storage mode of the datasets
+       normalization : 'image' or 'dataset'
+       log           : Logger to use
+    '''
+    from dataset.statistics import datasetStatistics, writeStatistics
+    if storage == 'floatX' :
+        return
+    checkNormalization(storage, normalization)
+    datasets = [name for name in datasets if name in hdf5]
+    trainH5 = hdf5[datasets[0]]
+    numChannels = trainH5.shape[2]
+    if storage == 'float16' :
+        scale, offset = np.ones(numChannels), np.zeros(numChannels)
+    else :
+        writeStatistics(trainH5, datasetStatistics(trainH5, log))
+        scale = 1. / trainH5.attrs['std']
+        offset = -trainH5.attrs['mean'] * scale
+    for name in datasets :
+        writeQuantization(hdf5[name], scale, offset)
+    hdf5.flush()
+    if log is not None :
+        log.info('Stored [' + storage + '] pixels with scale [' +
+                 str(np.round(scale, 5)) + '] and offset [' +
+                 str(np.round(offset, 5)) + ']')
@@ -1,6 +1,7 @@
 import os
 import numpy as np
 import theano as t
+from dataset.scan import splitSegment
 
 def mostCommon(arr, func, sampleSize=None) :
     '''Identify the most common element of the series.'''
@@ -27,16 +28,89 @@ def padImageData(imgData, dims) :
         imgData = np.pad(imgData, pads, mode='constant', constant_values=0)
     return imgData
 
-def normalize(v) :
-    '''Normalize a vector in a naive manner.'''
+def outputBuffer(out, shape) :
+    '''Return the buffer an image of the shape is decoded into. A new buffer
+       is allocated if out is None. Otherwise the image occupies the leading
+       corner of out, and the remainder is zeroed as by padImageData.
+
+       out    : Buffer to decode into, sized at least shape, or None
+       shape  : Shape of the image (numChannels, rows, cols)
+       return : numpy.ndarray view of exactly shape
+    '''
+    if out is None :
+        return np.ndarray(shape, dtype=t.config.floatX)
+    if len(out.shape) != len(shape) or \
+       any(o < s for o, s in zip(out.shape, shape)) :
+        raise ValueError('The image ' + str(tuple(shape)) + ' does not fit ' +
+                         'the buffer ' + str(out.shape))
+    if tuple(out.shape) == tuple(shape) :
+        return out
+    out.fill(0)
+    return out[tuple(slice(0, d) for d in shape)]
+
+def checkStorage(pixelType, a) :
+    '''Verify the buffer holds pixels of the type exactly. An integer buffer
+       (ie. uint8 storage) would silently wrap wider, signed or fractional
+       pixels, so these are rejected.
+    '''
+    if a.dtype.kind in 'ui' and not np.can_cast(pixelType, a.dtype) :
+        raise ValueError('Pixels of type [' + str(np.dtype(pixelType)) +
+                         '] cannot be stored as [' + str(a.dtype) + ']. ' +
+                         'Use the float16 or floatX storage.')
+
+def clipStorage(a) :
+    '''Saturate a float16 buffer to its finite range. Pixels beyond the
+       range are otherwise stored as inf when they are cast.
+    '''
+    if a.dtype == np.float16 :
+        limit = np.finfo(np.float16).max
+        np.clip(a, -limit, limit, out=a)
+    return a
+
+def storePixels(a, pixels) :
+    '''Copy decoded pixels into the buffer, as verified by checkStorage and
+       saturated by clipStorage.
+    '''
+    checkStorage(pixels.dtype, a)
+    with np.errstate(over='ignore') :
+        a[...] = pixels
+    return clipStorage(a)
+
+def normalize(v, out=None) :
+    '''Normalize a vector in a naive manner. If out is specified the
+       result is written into it, which may be v itself, and no temporary
+       is allocated.
+    '''
     minimum, maximum = np.amin(v), np.amax(v)
-    return (v - minimum) / (maximum - minimum)
+    if out is None :
+        return (v - minimum) / (maximum - minimum)
+    np.subtract(v, minimum, out=out)
+    np.divide(out, maximum - minimum, out=out)
+    return out
+
+def statisticalNorm(v, out=None) :
+    '''Zero-mean and unit variance, rescaled to [0, 1].
+
+       NOTE: The range normalization undoes any affine transform, so the
+             zero-mean, unit variance pass does not change the result and
+             is not performed.
+    '''
+    return normalize(v, out)
 
-def statisticalNorm(v) :
-    '''Zero-mean and unit variance.'''
-    return normalize((v - v.mean()) / v.std())
+def applyDatasetNorm(a, norm) :
+    '''Standardize the decoded image in place when norm holds dataset
+       statistics. This is a no-op for the 'image' and None modes.
 
-def convertPhaseAmp(imData, log=None) :
+       a      : Decoded image (numChannels, rows, cols)
+       norm   : 'image', None or per-channel (mean, std)
+       return : a
+    '''
+    if norm is None or isinstance(norm, str) :
+        return a
+    from dataset.statistics import standardize
+    return standardize(a, norm, a)
+
+def convertPhaseAmp(imData, log=None, out=None, norm='image') :
     '''Extract the phase and amplitude components of a complex number.
        This is assumed to be a better classifier than the raw IQ image.
        TODO: For SAR products, the data is Rayleigh distributed for the 
@@ -45,37 +119,90 @@ def convertPhaseAmp(imData, log=None) :
              strength of Rayleigh distribution.
        TODO: Research other possible feature spaces which could elicit better
              learning or augment the phase/amp components.
+
+       out  : Optional buffer to write the (2, rows, cols) result into
+       norm : 'image' normalizes each component on its own, None leaves
+              the components unnormalized, or (mean, std) of the dataset
+              standardizes them
     '''
     if imData.dtype != np.complex64 :
         raise ValueError('The array must be of type numpy.complex64.')
-    imageDims = imData.shape
-    a = np.asarray(np.concatenate((normalize(np.angle(imData)), 
-                                   normalize(np.absolute(imData)))),
-                      dtype=t.config.floatX)
-    return np.resize(a, (2, imageDims[0], imageDims[1]))
+    a = outputBuffer(out, (2,) + imData.shape)
+    checkStorage(imData.real.dtype, a)
+
+    # each component is computed directly into its band and normalized
+    # in place -- the real and imaginary parts are strided views
+    np.arctan2(imData.imag, imData.real, out=a[0])
+    with np.errstate(over='ignore') :
+        np.absolute(imData, out=a[1])
+    clipStorage(a[1])
+    if norm == 'image' :
+        normalize(a[0], a[0])
+        normalize(a[1], a[1])
+    return applyDatasetNorm(a, norm)
 
 '''TODO: These methods may need to be implemented as derived classes.'''
-def openSICD(image, log=None) :
-    '''This method reads the XML and complex data from SICD.'''
+def _sicdSchemaPaths() :
+    '''Setup the schema validation if the user has it specified.'''
     import pysix.six_sicd
-
-    # setup the schema validation if the user has it specified
     schemaPaths = pysix.six_sicd.VectorString()
     if 'SIX_SCHEMA_PATH' in os.environ :
         schemaPaths.push_back(os.environ['SIX_SCHEMA_PATH'])
+    return schemaPaths
+
+def openSICD(image, log=None) :
+    '''This method reads the XML and complex data from SICD.'''
+    import pysix.six_sicd
 
     # read the image components --
     # wbData    : the raw IQ image data
     # cmplxData : the struct for sicd metadata
-    wbData, cmplxData = pysix.six_sicd.read(image, schemaPaths)
+    wbData, cmplxData = pysix.six_sicd.read(image, _sicdSchemaPaths())
     return (wbData, cmplxData)
 
-def readSICD(image, log=None) :
+def openSICDReader(image, log=None) :
+    '''Load the SICD metadata without reading the wideband data.
+
+       return : (pysix.six_sicd.NITFReadControl, ComplexData)
+    '''
+    import pysix.six_sicd
+    readControl = pysix.six_sicd.NITFReadControl()
+    readControl.load(image, _sicdSchemaPaths())
+    cmplxData = pysix.six_sicd.asComplexData(
+        readControl.getContainer().getData(0))
+    return readControl, cmplxData
+
+def readSICD(image, log=None, out=None, norm='image') :
     '''This method should read and prepare the data for training or testing.'''
     wbData, cmplxData = openSICD(image, log)
-    return convertPhaseAmp(wbData, log)
+    return convertPhaseAmp(wbData, log, out, norm)
+
+def readSICDRegion(image, rowRange=None, colRange=None, log=None,
+                   out=None, norm='image') :
+    '''Read a window of the complex image and convert it as readSICD. The
+       region is read with a block read of the wideband data, so only the
+       window is held in memory.
+    '''
+    import pysix.six_base
+    readControl, cmplxData = openSICDReader(image, log)
+    if rowRange is None :
+        rowRange = (0, cmplxData.getNumRows())
+    if colRange is None :
+        colRange = (0, cmplxData.getNumCols())
+
+    # the reader fills the buffer directly
+    wbData = np.empty((rowRange[1] - rowRange[0], colRange[1] - colRange[0]),
+                      dtype=np.complex64)
+    region = pysix.six_base.Region()
+    region.setStartRow(rowRange[0])
+    region.setNumRows(wbData.shape[0])
+    region.setStartCol(colRange[0])
+    region.setNumCols(wbData.shape[1])
+    region.setBuffer(wbData.__array_interface__['data'][0])
+    readControl.interleaved(region, 0)
+    return convertPhaseAmp(wbData, log, out, norm)
 
-def readSIDD(image, log=None) :
+def readSIDD(image, log=None, out=None, norm='image') :
     '''This method should read a prepare the data for training or testing.'''
     raise NotImplementedError('Implement the datasetUtils.readSIDD() method')
 
@@ -83,60 +210,133 @@ def openSIO(image, log=None) :
     import coda.sio_lite
     return coda.sio_lite.read(image)
 
-def readSIO(image, log=None) :
+def readSIO(image, log=None, out=None, norm='image') :
     imData = openSIO(image, log)
     if imData.dtype == np.complex64 :
-        return convertPhaseAmp(imData, log)
-    else :
+        return convertPhaseAmp(imData, log, out, norm)
+    elif out is None and (norm is None or isinstance(norm, str)) :
         # TODO: this assumes the imData is already band-interleaved
         return imData
+    else :
+        a = outputBuffer(out, imData.shape)
+        return applyDatasetNorm(storePixels(a, imData), norm)
+
+def _nitfWindow(rowRange, colRange, bands) :
+    import nitf
+    window = nitf.SubWindow()
+    window.startRow = rowRange[0]
+    window.numRows = rowRange[1] - rowRange[0]
+    window.startCol = colRange[0]
+    window.numCols = colRange[1] - colRange[0]
+    window.bandList = list(bands)
+    return window
 
-def readNITF(image, log=None) :
+def readNITFBands(image, segment, rowRange, colRange, bands) :
+    '''Read bands of a window through a handle of its own. A nitf handle is
+       not shared across threads, so each concurrent read opens the file.
+    '''
+    import nitf
+    reader = nitf.read(image)[0]
+    try :
+        return reader.newImageReader(segment).read(
+            _nitfWindow(rowRange, colRange, bands))
+    finally :
+        reader.io.close()
+
+def readNITFRegion(image, rowRange=None, colRange=None, bands=None,
+                   log=None, out=None, norm='image', segment=0, workers=1) :
+    '''Read a window of an image segment. The NITF subwindow only reads the
+       blocks which overlap the window, so only the window is held in memory.
+
+       segment : Index of the image segment within the file
+       workers : Number of threads reading the bands concurrently. Each
+                 thread reads its share of the bands directly into the
+                 output through a separate handle.
+    '''
+    from multiprocessing.pool import ThreadPool
     import nitf
 
     # read the nitf
     reader, record = nitf.read(image)
 
-    # there could be multiple images per nitf --
-    # for now just read the first.
-    # TODO: we could read each image separately, but its unlikely to
-    #       encounter a multi-image file in the wild.
-    segment = record.getImages()[0]
-    imageReader = reader.newImageReader(0)
-    window = nitf.SubWindow()
-    window.numRows = segment.subheader['numRows'].intValue()
-    window.numCols = segment.subheader['numCols'].intValue()
-    window.bandList = range(segment.subheader.getBandCount())
-
-    # read the bands and interleave them by band --
-    # this assumes the image is non-complex and treats bands as color.
-    a = np.concatenate(imageReader.read(window))
-    a = np.resize(statisticalNorm(a), 
-                  (segment.subheader.getBandCount(),
-                   window.numRows, window.numCols))
-
-    # explicitly close the handle -- for peace of mind
-    reader.io.close()
-    return a
+    try :
+        # there could be multiple images per nitf --
+        # each segment is read on its own. See expandSegments.
+        subheader = record.getImages()[segment].subheader
+        if rowRange is None :
+            rowRange = (0, subheader['numRows'].intValue())
+        if colRange is None :
+            colRange = (0, subheader['numCols'].intValue())
+        bands = list(range(subheader.getBandCount()) \
+                     if bands is None else bands)
+
+        # read the bands and interleave them by band --
+        # this assumes the image is non-complex and treats bands as color.
+        a = outputBuffer(out, (len(bands), rowRange[1] - rowRange[0],
+                               colRange[1] - colRange[0]))
+        def readGroup(group) :
+            data = reader.newImageReader(segment).read(
+                _nitfWindow(rowRange, colRange, bands)) \
+                if len(group) == len(bands) else \
+                readNITFBands(image, segment, rowRange, colRange,
+                              [bands[ii] for ii in group])
+            for ii, band in zip(group, data) :
+                storePixels(a[ii], np.reshape(band, a.shape[1:]))
+
+        workers = max(1, min(workers, len(bands)))
+        if workers == 1 :
+            readGroup(range(len(bands)))
+        else :
+            pool = ThreadPool(workers)
+            try :
+                pool.map(readGroup, [list(g) for g in np.array_split(
+                    np.arange(len(bands)), workers)])
+            finally :
+                pool.terminate()
+                pool.join()
 
-def makePILImageBandContiguous(img, log=None) :
+        if norm == 'image' :
+            return statisticalNorm(a, a)
+        elif norm is not None :
+            norm = tuple(np.asarray(s)[bands] for s in norm)
+        return applyDatasetNorm(a, norm)
+    finally :
+        # explicitly close the handle -- for peace of mind
+        reader.io.close()
+
+def readNITF(image, log=None, out=None, norm='image', segment=0,
+             workers=1) :
+    return readNITFRegion(image, log=log, out=out, norm=norm,
+                          segment=segment, workers=workers)
+
+def makePILImageBandContiguous(img, log=None, out=None, norm='image') :
     '''This will split the image so each channel will be contigous in memory.
        The resultant format is (channels, rows, cols), where channels are
-       ordered in [Red, Green. Blue] for three channel products.
+       ordered in [Red, Green. Blue] for three channel products. Each
+       channel is converted directly into the output and normalized in
+       place, so out may be a slot of a staging buffer.
     '''
     if img.mode == 'RBG' or img.mode == 'RGB' :
-        # channels are interleaved by band
-        a = np.asarray(np.concatenate(
-                       [statisticalNorm(np.asarray(x)) for x in img.split()]),
-                       dtype=t.config.floatX)
-        a = np.resize(a, (3, img.size[1], img.size[0]))
-        return a if img.mode == 'RGB' else a[[0,2,1],:,:]
-    elif img.mode == 'L' :
-        # just one channel
-        a = np.asarray(img.getdata(), dtype=t.config.floatX)
-        return np.resize(statisticalNorm(a), (1, img.size[1], img.size[0]))
-
-def readPILImage(image, log=None) :
+        # channels are interleaved by pixel in the decoded image
+        pixels = np.asarray(img)
+        a = outputBuffer(out, (3, img.size[1], img.size[0]))
+        checkStorage(pixels.dtype, a)
+        for ii, band in enumerate([0,1,2] if img.mode == 'RGB' else \
+                                  [0,2,1]) :
+            a[ii] = pixels[:, :, band]
+            if norm == 'image' :
+                statisticalNorm(a[ii], a[ii])
+        return applyDatasetNorm(a, norm)
+    elif len(img.getbands()) == 1 :
+        # just one channel -- 8-bit, 16/32-bit integer or float pixels
+        pixels = np.asarray(img)
+        a = outputBuffer(out, (1, img.size[1], img.size[0]))
+        storePixels(a[0], pixels)
+        if norm == 'image' :
+            statisticalNorm(a, a)
+        return applyDatasetNorm(a, norm)
+
+def readPILImage(image, log=None, out=None, norm='image') :
     '''This method should be used for all regular image formats from JPEG,
        PNG, TIFF, etc. A PIL error may originate from this method if the image
        format is unsupported.
@@ -144,30 +344,380 @@ def readPILImage(image, log=None) :
     from PIL import Image
     img = Image.open(image)
     img.load() # because PIL can be lazy
-    return makePILImageBandContiguous(img)
+    return makePILImageBandContiguous(img, log, out, norm)
 
-def readImage(image, log=None) :
-    '''Load the image into memory. It can be any type supported by PIL.'''
+def readImage(image, log=None, out=None, norm='image') :
+    '''Load the image into memory. The format is identified from the
+       contents of the file (see decoderFor), and it can be SIO, NITF, SICD
+       or any type supported by PIL.
+
+       image  : Path to the image, or a segment of a multi-image NITF
+                addressed by dataset.scan.segmentSource
+       log    : Logger to use
+       out    : Optional buffer to decode into. The image is placed in its
+                leading corner and the remainder is zero-padded.
+       norm   : 'image' normalizes the image on its own, None leaves the
+                decoded values, or the per-channel (mean, std) of a dataset
+                (see dataset.statistics) standardizes the image with them
+       return : numpy.ndarray (numChannels, rows, cols) view of the image
+    '''
     if log is not None :
         log.debug('Openning Image [' + image + ']')
-    imageLower = image.lower()
-    # TODO: Images are named differently and this is not a great measure for
-    #       for image types. Change this in the future to a try/catch and 
-    #       allow the library decide what it is (or pass in a parameter for
-    #       optimized performance).
-    if imageLower.endswith('.sio') :
-        return readSIO(image, log)
-    elif 'sicd' in imageLower :
-        return readSICD(image, log)
-    elif 'sidd' in imageLower :
-        return readSIDD(image, log)
-    elif imageLower.endswith('.nitf') or imageLower.endswith('.ntf') :
-        return readNITF(image, log)
+    path, segment = splitSegment(image)
+    if segment is not None :
+        return readNITF(path, log, out, norm, segment)
+    return decoderFor(image).read(image, log, out, norm)
+
+def supportsRegionReads(image) :
+    '''Whether readImageRegion reads only the requested window of the image.
+       Other formats are decoded in full on every region read.
+    '''
+    if splitSegment(image)[1] is not None :
+        return True
+    return decoderFor(image).readRegion is not None
+
+def readImageRegion(image, rowRange, colRange, bands=None, log=None,
+                    norm='image') :
+    '''Load a window of the image into memory. NITF and SICD imagery only
+       reads the window from disk, so the memory used is proportional to the
+       window rather than the scene.
+
+       NOTE: In the 'image' mode, the window is normalized independently of
+             the remainder of the image, as if it were an image of its own.
+
+       image    : Path to the image
+       rowRange : Rows to read (start, stop)
+       colRange : Columns to read (start, stop)
+       bands    : List of bands to read. All bands are read if None.
+       log      : Logger to use
+       norm     : Normalization to apply, as in readImage
+       return   : numpy.ndarray formatted (numBands, numRows, numCols)
+    '''
+    if log is not None :
+        log.debug('Openning Region [' + image + '] rows ' + str(rowRange) +
+                  ' cols ' + str(colRange))
+    path, segment = splitSegment(image)
+    if segment is not None :
+        return readNITFRegion(path, rowRange, colRange, bands, log,
+                              norm=norm, segment=segment)
+    decoder = decoderFor(image)
+    if decoder.readBands :
+        return decoder.readRegion(image, rowRange, colRange, bands, log,
+                                  norm=norm)
+    elif decoder.readRegion is not None :
+        region = decoder.readRegion(image, rowRange, colRange, log=log,
+                                    norm=norm)
     else :
-        return readPILImage(image, log)
+        region = decoder.read(image, log, norm=norm)[
+            :, rowRange[0]:rowRange[1], colRange[0]:colRange[1]]
+    return region if bands is None else region[list(bands)]
+
+def imageNormalization(image, log=None, maxPixels=2**22) :
+    '''Compute the 'image' normalization of the whole image as per-channel
+       (mean, std), as taken by the norm of readImageRegion. Windows read
+       with it match the same window of readImage(image), rather than each
+       window being normalized on its own. The image is streamed a strip of
+       rows at a time, so only the strip is held in memory.
+
+       image     : Path to the image
+       log       : Logger to use
+       maxPixels : Number of pixels per channel read in each strip
+       return    : Per-channel (mean, std)
+    '''
+    numChannels, rows, cols = getImageDims(image, log)
+    stripRows = max(1, maxPixels // max(1, cols))
+    minimum = np.full(numChannels, np.inf)
+    maximum = np.full(numChannels, -np.inf)
+    for row in range(0, rows, stripRows) :
+        strip = readImageRegion(image, (row, min(rows, row + stripRows)),
+                                (0, cols), norm=None)
+        minimum = np.minimum(minimum, np.amin(strip, axis=(1, 2)))
+        maximum = np.maximum(maximum, np.amax(strip, axis=(1, 2)))
+
+    # NITF bands are normalized together, while the components of complex
+    # imagery are normalized separately (see convertPhaseAmp)
+    path, segment = splitSegment(image)
+    if segment is not None or decoderFor(image).name == 'nitf' :
+        minimum[:] = np.amin(minimum)
+        maximum[:] = np.amax(maximum)
+    scale = maximum - minimum
+    scale[scale == 0] = 1.
+    if log is not None :
+        log.debug('Image normalization of [' + image + '] offset ' +
+                  str(minimum) + ' scale ' + str(scale))
+    return minimum, scale
+
+def getPILImageDims(image, log=None) :
+    '''Read the dimensions from the header. PIL is lazy, so Image.open only
+       parses the header and no pixels are decoded.
+    '''
+    from PIL import Image
+    img = Image.open(image)
+    try :
+        return (len(img.getbands()), img.size[1], img.size[0])
+    finally :
+        img.close()
+
+def getNITFSegments(image, log=None) :
+    '''Read the dimensions of every image segment from the subheaders.
+
+       return : List of (numChannels, rows, cols) for each segment
+    '''
+    import nitf
+    reader, record = nitf.read(image)
+    try :
+        return [(im.subheader.getBandCount(),
+                 im.subheader['numRows'].intValue(),
+                 im.subheader['numCols'].intValue()) \
+                for im in record.getImages()]
+    finally :
+        reader.io.close()
+
+def getNITFDims(image, log=None, segment=0) :
+    '''Read the dimensions from the subheader of the image segment.'''
+    return getNITFSegments(image, log)[segment]
+
+def getSICDDims(image, log=None) :
+    '''Read the dimensions from the SICD metadata. The complex data is
+       returned as phase and amplitude bands by readSICD.
+    '''
+    # load only the XML metadata -- the wideband data is not read
+    cmplxData = openSICDReader(image, log)[1]
+    return (2, cmplxData.getNumRows(), cmplxData.getNumCols())
+
+class Decoder () :
+    '''The functions which decode an image format.
+
+       name       : Name of the format
+       modules    : Modules the decoder imports, see preloadDecoders
+       read       : readImage(image, log, out, norm) for the format
+       readRegion : Windowed read of the format, or None if the format is
+                    decoded in full on every read (ie. PIL, which decodes
+                    the whole image before cropping). This is called as
+                    readRegion(image, rowRange, colRange, log=, norm=)
+       readBands  : Whether readRegion also selects the bands, and is called
+                    as readRegion(image, rowRange, colRange, bands, log,
+                    norm=)
+       dims       : getImageDims(image, log) for the format, or None if the
+                    image must be decoded
+    '''
+    def __init__ (self, name, modules, read, readRegion=None,
+                  readBands=False, dims=None) :
+        self.name = name
+        self.modules = modules
+        self.read = read
+        self.readRegion = readRegion
+        self.readBands = readBands
+        self.dims = dims
+
+decoders = {
+    'sio'  : Decoder('sio', ('coda.sio_lite',), readSIO),
+    'sicd' : Decoder('sicd', ('pysix.six_sicd', 'pysix.six_base'), readSICD,
+                     readSICDRegion, dims=getSICDDims),
+    'sidd' : Decoder('sidd', ('pysix.six_sicd',), readSIDD),
+    'nitf' : Decoder('nitf', ('nitf',), readNITF, readNITFRegion, True,
+                     getNITFDims),
+    'pil'  : Decoder('pil', ('PIL.Image',), readPILImage,
+                     dims=getPILImageDims),
+}
+
+# the magic numbers of SIO, in either byte order, with and without the
+# user data section
+_sioMagic = (b'\xff\x01\x7f\xfe', b'\xfe\x7f\x01\xff',
+             b'\xff\x02\x7f\xfd', b'\xfd\x7f\x02\xff')
+
+def _sniffNITFProduct(f, header) :
+    '''Identify SICD and SIDD products by the root of the XML held in the
+       first data extension segment. The offset of the segment is summed
+       from the segment lengths in the NITF 2.1 / NSIF 1.0 file header.
+    '''
+    import re
+    if header[4:9] not in (b'02.10', b'01.00') :
+        return 'nitf'
+    try :
+        f.seek(354)
+        offset = int(f.read(6))
+        def skipSegments(subheaderLength, dataLength) :
+            count = int(f.read(3))
+            fieldLength = subheaderLength + dataLength
+            lengths = f.read(count * fieldLength)
+            return sum(int(lengths[ii:ii+subheaderLength]) +
+                       int(lengths[ii+subheaderLength:ii+fieldLength]) \
+                       for ii in range(0, len(lengths), fieldLength))
+
+        # image, graphic, reserved and text segments precede the DES
+        offset += skipSegments(6, 10)
+        offset += skipSegments(4, 6)
+        f.read(3)
+        offset += skipSegments(4, 5)
+        if int(f.read(3)) == 0 :
+            return 'nitf'
+        offset += int(f.read(4))
+    except ValueError :
+        return 'nitf'
+    f.seek(offset)
+    match = re.search(br'<(?:\w+:)?(SICD|SIDD)[\s>]', f.read(4096))
+    return 'nitf' if match is None else match.group(1).decode().lower()
+
+def sniffFormat(image) :
+    '''Identify the format from the magic bytes of the file.
+
+       return : Key into decoders
+    '''
+    with open(image, 'rb') as f :
+        header = f.read(9)
+        if header[:4] in _sioMagic :
+            return 'sio'
+        elif header[:4] in (b'NITF', b'NSIF') :
+            return _sniffNITFProduct(f, header)
+    # PIL identifies the remaining formats from their own headers
+    return 'pil'
+
+# decoders identified per (directory, extension) --
+# NITF containers are not cached, as SICD, SIDD and plain NITF products
+# share an extension and are commonly found in the same directory.
+_decoderCache = {}
+
+def decoderFor(image) :
+    '''Return the Decoder for the image. The first file of each directory
+       and extension is sniffed, and the remainder use the cached decoder.
+    '''
+    key = (os.path.dirname(image), os.path.splitext(image)[1].lower())
+    name = _decoderCache.get(key)
+    if name is None :
+        name = sniffFormat(image)
+        if name in ('sio', 'pil') :
+            _decoderCache[key] = name
+    return decoders[name]
+
+def preloadDecoders(names=None) :
+    '''Import the modules of the decoders up front. Worker processes call
+       this as they start, so the first image decoded by each worker does
+       not pay for the imports. Decoders whose modules are not installed
+       are skipped.
+
+       names : Decoders to preload. All are preloaded if None.
+    '''
+    import importlib
+    for name in decoders if names is None else names :
+        for module in decoders[name].modules :
+            try :
+                importlib.import_module(module)
+            except ImportError :
+                pass
 
 def getImageDims(image, log=None) :
-    '''Load the image and return its dimensions.
+    '''Return the dimensions of the image without decoding it. The header
+       of the image is read where the format allows, otherwise the image is
+       loaded.
         format -- (numChannels, rows, cols)
     '''
-    return readImage(image, log).shape
+    if log is not None :
+        log.debug('Probing Image [' + image + ']')
+    path, segment = splitSegment(image)
+    if segment is not None :
+        return getNITFDims(path, log, segment)
+    decoder = decoderFor(image)
+    if decoder.dims is None :
+        return decoder.read(image, log).shape
+    return decoder.dims(image, log)
+
+def probeImageDims(images, sampleSize=None, workers=None, log=None) :
+    '''Probe the dimensions of many images concurrently. Only the headers
+       are read, so this costs kilobytes of IO per image.
+
+       images     : List of image paths
+       sampleSize : Number of images to probe. All are probed if None.
+       workers    : Number of concurrent probes. Defaults to 4x the cores.
+       log        : Logger to use
+       return     : (images probed, int64 array (numImages, 3) of the
+                     (numChannels, rows, cols) of each)
+    '''
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    from numpy.random import choice
+
+    images = list(images)
+    if sampleSize is not None and sampleSize < len(images) :
+        images = [images[ii] for ii in \
+                  choice(len(images), sampleSize, replace=False)]
+    if len(images) == 0 :
+        return images, np.zeros((0, 3), dtype=np.int64)
+
+    pool = ThreadPool(4 * cpu_count() if workers is None else workers)
+    try :
+        dims = pool.map(getImageDims, images)
+    finally :
+        pool.terminate()
+        pool.join()
+    return images, np.asarray(dims, dtype=np.int64)
+
+def countSegments(image) :
+    '''Return the number of image segments held in the file. SICD and SIDD
+       products are read as a single image.
+    '''
+    if decoderFor(image).name != 'nitf' :
+        return 1
+    return len(getNITFSegments(image))
+
+def expandSegments(table, workers=None, log=None) :
+    '''Replace each multi-image NITF in the table with a row per image
+       segment, addressed by dataset.scan.segmentSource. The segments are
+       then ingested as separate examples, decoded concurrently by the batch
+       pipeline. Files holding a single image keep their path, and only the
+       headers are read.
+
+       table   : dataset.scan.FileTable
+       workers : Number of concurrent probes. Defaults to 4x the cores.
+       log     : Logger to use
+       return  : dataset.scan.FileTable
+    '''
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    from dataset.scan import segmentSource
+
+    counts = np.ones(len(table), dtype=np.int64)
+    multi = np.asarray([p.lower().endswith(('.nitf', '.ntf')) \
+                        for p in table.paths], dtype=bool)
+    if not np.any(multi) :
+        return table
+    pool = ThreadPool(4 * cpu_count() if workers is None else workers)
+    try :
+        counts[multi] = pool.map(countSegments, table.paths[multi])
+    finally :
+        pool.terminate()
+        pool.join()
+    if np.all(counts == 1) :
+        return table
+
+    # repeat each row per segment and number the segments within each file
+    rows = np.repeat(np.arange(len(table)), counts)
+    expanded = table[rows]
+    segments = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+    split = counts[rows] > 1
+    expanded.paths[split] = [segmentSource(p, s) for p, s in \
+                             zip(expanded.paths[split], segments[split])]
+    if log is not None :
+        log.info('Expanded [' + str(int(np.sum(counts > 1))) +
+                 '] multi-image files into [' + str(int(np.sum(split))) +
+                 '] segments')
+    return expanded
+
+def shapeDistribution(dims, log=None) :
+    '''Summarize the shapes of the probed images.
+
+       dims   : Array (numImages, 3) returned by probeImageDims
+       log    : Logger to use
+       return : (shapes, counts) ordered from most to least common
+    '''
+    shapes, counts = np.unique(dims, axis=0, return_counts=True)
+    order = np.argsort(-counts, kind='mergesort')
+    shapes, counts = shapes[order], counts[order]
+    if log is not None :
+        log.info('Image shapes [' + ', '.join(
+            str(tuple(int(d) for d in s)) + ' x' + str(c) for s, c in \
+            zip(shapes[:5], counts[:5])) + ']' +
+            (' and [' + str(len(shapes) - 5) + '] others' \
+             if len(shapes) > 5 else ''))
+    return shapes, counts
@@ -0,0 +1,118 @@
+import numpy as np
+import threading
+from dataset.prefetch import readBatch
+
+def epochPermutation(numBatches, batchSize, rng) :
+    '''Draw a permutation of every example in the dataset, formatted as the
+       example indices of each mini-batch.
+
+       numBatches : Number of mini-batches in the dataset
+       batchSize  : Size of a mini-batch
+       rng        : numpy.random.RandomState to use
+       return     : int32 array (numBatches, batchSize) of indices into the
+                    flattened (numBatches * batchSize, ...) dataset
+    '''
+    return rng.permutation(numBatches * batchSize).astype(np.int32).reshape(
+        numBatches, batchSize)
+
+class GroupShuffler () :
+    '''Shuffle a disk-backed dataset each epoch without copying it. The batch
+       order is permuted, and consecutive groups of groupSize batches are
+       read together and their examples permuted across the group. Within a
+       group the batches are read in sorted order, so each chunk is visited
+       once and the reads move forward through the file.
+
+       This is a bounded-locality shuffle. The batch order spans the whole
+       epoch, but an example is only mixed with the examples of the other
+       batches of its group. Larger groups approach a full shuffle at the
+       cost of one resident batch per group member, so the group should
+       span the window or read-ahead the dataset is consumed through.
+
+       The shuffled dataset is exposed through views, one per source, which
+       are indexed by batch like the sources themselves. Thus they may be
+       handed to the BatchPrefetcher or the SharedWindow.
+
+       NOTE: The examples of a group are permuted with a seed drawn once per
+             epoch, so a group which is read again (ie. after the read-ahead
+             seeks) returns the identical batches.
+       NOTE: A batch is returned as a view of the resident group, which is
+             valid until a batch of another group is read. The
+             BatchPrefetcher and SharedWindow copy it into their own
+             buffers.
+
+       sources   : List of datasets indexed by batch (ie. [data, labels])
+       groupSize : Number of batches whose examples are mixed together
+       rng       : numpy.random.RandomState to use
+    '''
+    def __init__ (self, sources, groupSize, rng=None) :
+        self._sources = sources
+        self._numBatches = len(sources[0])
+        self._batchSize = sources[0].shape[1]
+        self._groupSize = max(1, min(int(groupSize), self._numBatches))
+        self._rng = np.random.RandomState() if rng is None else rng
+        self._lock = threading.Lock()
+
+        # one buffer per source holds the resident group
+        self._groupBuffers = [np.ndarray((self._groupSize,) + s.shape[1:],
+                                         s.dtype) for s in sources]
+        self._group = None
+        self.views = [ShuffledView(self, ii) for ii in range(len(sources))]
+        self.shuffle()
+
+    def __len__ (self) :
+        return self._numBatches
+
+    def shuffle(self) :
+        '''Draw the order of the next epoch.'''
+        with self._lock :
+            self._batchOrder = self._rng.permutation(self._numBatches)
+            self._seed = self._rng.randint(2**31 - 1)
+            self._group = None
+
+    def _readGroup(self, group) :
+        '''Read the batches of the group and permute their examples.'''
+        start = group * self._groupSize
+        batches = np.sort(self._batchOrder[start:start + self._groupSize])
+        perm = np.random.RandomState(self._seed + group).permutation(
+            len(batches) * self._batchSize)
+        for buf, source in zip(self._groupBuffers, self._sources) :
+            for ii, batch in enumerate(batches) :
+                readBatch(buf[ii], source, batch)
+            flat = np.reshape(buf[:len(batches)],
+                              (len(perm),) + buf.shape[2:])
+            flat[...] = flat[perm]
+        self._group = group
+
+    def read(self, sourceIndex, index) :
+        '''Return batch index of the shuffled epoch for the source.'''
+        group, offset = divmod(index, self._groupSize)
+        with self._lock :
+            if group != self._group :
+                self._readGroup(group)
+            return self._groupBuffers[sourceIndex][offset]
+
+class ShuffledView () :
+    '''A batch indexed view of one source of a GroupShuffler.'''
+    def __init__ (self, shuffler, sourceIndex) :
+        self._shuffler = shuffler
+        self._sourceIndex = sourceIndex
+        source = shuffler._sources[sourceIndex]
+        self.shape = source.shape
+        self.dtype = source.dtype
+        self.ndim = len(source.shape)
+        # expose any quantization of the source (see dataset.quantize)
+        self.attrs = getattr(source, 'attrs', {})
+
+    def __len__ (self) :
+        return self.shape[0]
+
+    def __getitem__ (self, index) :
+        if isinstance(index, slice) :
+            # a slice may span groups, so each batch is copied out before
+            # the next group replaces it
+            indices = range(*index.indices(len(self)))
+            out = np.ndarray((len(indices),) + self.shape[1:], self.dtype)
+            for ii, batch in enumerate(indices) :
+                out[ii] = self[batch]
+            return out
+        return self._shuffler.read(self._sourceIndex, int(index))
@@ -0,0 +1,120 @@
+import os
+import numpy as np
+
+try :
+    from os import scandir
+except ImportError :
+    # python < 3.5 provides this through the scandir package
+    from scandir import scandir
+
+class FileTable () :
+    '''A columnar table of files. Each column is a separate array, which is
+       far more compact than a list of tuples on large corpora, and allows
+       the table to be filtered and shuffled with numpy indexing.
+
+       paths  : List of file paths
+       labels : Label index of each file
+       sizes  : Size of each file in bytes
+       mtimes : Modification time of each file
+    '''
+    def __init__ (self, paths=None, labels=None, sizes=None, mtimes=None) :
+        self.paths = np.asarray([] if paths is None else paths, dtype=object)
+        self.labels = np.zeros(len(self.paths), np.int32) \
+                      if labels is None else np.asarray(labels, np.int32)
+        self.sizes = np.zeros(len(self.paths), np.int64) \
+                     if sizes is None else np.asarray(sizes, np.int64)
+        self.mtimes = np.zeros(len(self.paths), np.float64) \
+                      if mtimes is None else np.asarray(mtimes, np.float64)
+
+    def __len__ (self) :
+        return len(self.paths)
+
+    def __getitem__ (self, index) :
+        '''Select the rows by slice, index array or boolean mask.'''
+        return FileTable(self.paths[index], self.labels[index],
+                         self.sizes[index], self.mtimes[index])
+
+    def __add__ (self, other) :
+        return FileTable(np.concatenate((self.paths, other.paths)),
+                         np.concatenate((self.labels, other.labels)),
+                         np.concatenate((self.sizes, other.sizes)),
+                         np.concatenate((self.mtimes, other.mtimes)))
+
+    def shuffle(self, rng=None) :
+        '''Return the table in random order.'''
+        rng = np.random if rng is None else rng
+        return self[rng.permutation(len(self))]
+
+def scanOne(path) :
+    '''List a single directory. The stat of each file is taken from the
+       directory entry, so the directory is walked only once.
+
+       return : (path, [subdirectories], [names], [sizes], [mtimes])
+    '''
+    dirs, names, sizes, mtimes = [], [], [], []
+    for entry in scandir(path) :
+        if entry.is_dir() :
+            dirs.append(entry.path)
+        elif entry.is_file() :
+            st = entry.stat()
+            names.append(entry.name)
+            sizes.append(st.st_size)
+            mtimes.append(st.st_mtime)
+    return path, dirs, names, sizes, mtimes
+
+def scanDirectory(path, workers=None, log=None) :
+    '''Walk the directory tree, listing each level of the tree in parallel.
+       On network-mounted storage the listing is bound by the latency of
+       each request, so many directories are listed concurrently.
+
+       path    : Root of the directory tree
+       workers : Number of concurrent listings. Defaults to 4x the cores.
+       log     : Logger to use
+       return  : List of (path, [names], sizes, mtimes) for each directory
+                 sorted by path, including the root.
+    '''
+    from time import time
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+
+    timer = time()
+    workers = 4 * cpu_count() if workers is None else workers
+    pool = ThreadPool(workers)
+    listings, frontier = [], [path]
+    try :
+        while len(frontier) > 0 :
+            level = pool.map(scanOne, frontier)
+            frontier = [d for listing in level for d in listing[1]]
+            listings.extend((p, names, np.asarray(sizes, np.int64),
+                             np.asarray(mtimes, np.float64)) \
+                            for p, dirs, names, sizes, mtimes in level)
+    finally :
+        pool.terminate()
+        pool.join()
+
+    listings.sort(key=lambda listing : listing[0])
+    if log is not None :
+        log.info('Scanned [' + str(sum(len(l[1]) for l in listings)) +
+                 '] files in [' + str(len(listings)) + '] directories in ' +
+                 str(time() - timer) + 's')
+    return listings
+
+# separates the path of a file from the index of an image segment within it
+segmentSeparator = '#'
+
+def segmentSource(path, segment) :
+    '''Address a single image segment of a multi-image file, so it may be
+       listed, ingested and recorded in the manifest as an image of its own.
+    '''
+    return path + segmentSeparator + str(segment)
+
+def splitSegment(source) :
+    '''Split a source into the file path and the segment index.
+
+       return : (path, segment), where segment is None for a plain path
+    '''
+    path, sep, segment = source.rpartition(segmentSeparator)
+    if sep == '' or not segment.isdigit() or \
+       not path.lower().endswith(('.nitf', '.ntf')) :
+        return source, None
+    return path, int(segment)
@@ -7,9 +7,22 @@ def isShared(x) :
     '''
     return 'SharedVariable' in str(type(x))
 
+def compactShared() :
+    '''Test if a theano.shared variable of a compact type (ie. uint8 or
+       float16) is placed on the device. The legacy cuda backend
+       (device=gpu) only places float32 variables on the GPU, so compact
+       variables would remain in host memory.
+    '''
+    return not t.config.device.startswith('gpu')
+
 def toShared(x, borrow=True, log=None) :
     '''Transfer numpy.ndarry to theano.shared variable.
        NOTE: Shared variables allow for optimized GPU execution
+       NOTE: A quantized HDF5 dataset (see dataset.quantize) keeps its stored
+             type when the backend places it on the device (see
+             compactShared), and its quantization is tagged on the shared
+             variable so it may be dequantized within the compiled
+             functions. Otherwise it is dequantized to floatX on the host.
 
        x      : numpy.ndarray or list object to convert
        borrow : False provides back a deep copy of the memory, True may provide
@@ -18,9 +31,18 @@ def toShared(x, borrow=True, log=None) :
        log    : Logger to use
     '''
     import numpy as np
+    from dataset.quantize import getQuantization
     if log is not None :
         log.debug('Wrap memory into shared variables')
-    return t.shared(np.asarray(x, dtype=t.config.floatX), borrow=borrow)
+    quant = getQuantization(x)
+    if quant is not None and not compactShared() :
+        from dataset.quantize import dequantize
+        return t.shared(dequantize(np.asarray(x), quant), borrow=borrow)
+    if quant is None :
+        return t.shared(np.asarray(x, dtype=t.config.floatX), borrow=borrow)
+    shared = t.shared(np.asarray(x), borrow=borrow)
+    shared.tag.quantization = quant
+    return shared
 
 def fromShared(x, borrow=True, log=None) :
     '''Transfer the memory back to a numpy.ndarry.
@@ -1,6 +1,175 @@
+import numpy as np
+
 def naiveShuffle(x, log=None) :
     '''Randomize the dataset, which enforces stochasticity in training'''
     import random
     if log is not None :
         log.info('Shuffling the Elements')
     random.shuffle(x)
+
+def writeExamples(dataH5, start, examples) :
+    '''Write a run of examples into a (numBatches, batchSize, ...) dataset
+       beginning at the flat example offset. Only the batches at either end
+       of the run may be partially written.
+
+       dataH5   : Dataset to populate. This may be a HDF5 dataset.
+       start    : Flat example offset (batch * batchSize + example)
+       examples : Examples to write (numExamples, ...)
+    '''
+    batchSize = dataH5.shape[1]
+    numExamples = len(examples)
+    ii = 0
+    while ii < numExamples :
+        batch, offset = divmod(start + ii, batchSize)
+        if offset == 0 and numExamples - ii >= batchSize :
+            # write all complete mini-batches at once
+            numFull = (numExamples - ii) // batchSize
+            dataH5[batch:batch + numFull] = np.reshape(
+                examples[ii:ii + numFull * batchSize],
+                (numFull, batchSize) + examples.shape[1:])
+            ii += numFull * batchSize
+        else :
+            count = min(batchSize - offset, numExamples - ii)
+            dataH5[batch, offset:offset + count] = examples[ii:ii + count]
+            ii += count
+
+def hdf5Shuffle(inFile, memory=2**30, tmpDir=None, rng=None, log=None) :
+    '''Shuffle the training examples of a HDF5 dataset in place. The examples
+       are permuted across mini-batch boundaries, and train/indices is
+       permuted with train/data so any labels stay aligned. The slots of the
+       manifest are remapped to the new positions, so the file may still be
+       updated incrementally (see dataset.manifest). The gather overwrites
+       the examples in place, so the manifest marks every example as
+       outstanding until the shuffle completes. An interrupted shuffle is
+       then decoded again by the next incremental update.
+
+       The dataset need not fit in memory. The shuffle is performed as two
+       sequential passes over the data --
+
+           scatter : read blocks of mini-batches in order, and append each
+                     example to a randomly selected bucket in a temporary
+                     file.
+           gather  : read each bucket whole, permute it in memory, and write
+                     it back over the next contiguous run of examples.
+
+       Random bucket assignment followed by a uniform permutation within each
+       bucket produces a uniform permutation of the entire dataset. There are
+       enough buckets that each fits within the memory budget. The number of
+       appends grows with (dataset size / memory) ** 2, so the budget should
+       be as large as the machine allows.
+
+       inFile : HDF5 file containing train/data, and optionally train/indices
+       memory : Memory budget of the shuffle in bytes
+       tmpDir : Directory for the temporary bucket file. Defaults to the
+                directory of inFile, as it requires as much space as the
+                training set.
+       rng    : numpy.random.RandomState to use
+       log    : Logger to use
+    '''
+    import os
+    import h5py
+    import tempfile
+    from time import time
+
+    if rng is None :
+        rng = np.random.RandomState()
+    if tmpDir is None :
+        tmpDir = os.path.dirname(os.path.abspath(inFile))
+
+    with h5py.File(inFile, mode='r+') as hdf5 :
+        sources = [hdf5['train/data']]
+        if 'train/indices' in hdf5 :
+            sources.append(hdf5['train/indices'])
+        numBatches, batchSize = sources[0].shape[:2]
+        numExamples = numBatches * batchSize
+        exampleBytes = sum(int(np.prod(s.shape[2:])) * s.dtype.itemsize \
+                           for s in sources) + 8
+
+        # the buckets are sized to use half the budget on average, which
+        # leaves room for the imbalance of the random assignment and the
+        # permuted copy.
+        numBuckets = max(1, int(np.ceil(4. * numExamples * exampleBytes /
+                                        memory)))
+        blockBatches = max(1, int(memory // 2 //
+                                  (exampleBytes * batchSize)))
+        if log is not None :
+            log.info('Shuffling [' + str(numExamples) + '] examples of [' +
+                     inFile + '] through [' + str(numBuckets) + '] buckets')
+
+        fd, tmpFile = tempfile.mkstemp(suffix='.hdf5', dir=tmpDir)
+        os.close(fd)
+        try :
+            with h5py.File(tmpFile, mode='w') as tmp :
+                buckets = [[tmp.create_dataset(
+                                str(bb) + '/' + str(ii),
+                                shape=(0,) + s.shape[2:], dtype=s.dtype,
+                                maxshape=(None,) + s.shape[2:], chunks=True) \
+                            for ii, s in enumerate(sources)] + \
+                           [tmp.create_dataset(
+                                str(bb) + '/origin', shape=(0,),
+                                dtype=np.int64, maxshape=(None,),
+                                chunks=True)] \
+                           for bb in range(numBuckets)]
+
+                # scatter the examples into the buckets --
+                # the examples of each block are grouped by bucket, so each
+                # bucket receives a single contiguous append per block.
+                timer = time()
+                for start in range(0, numBatches, blockBatches) :
+                    stop = min(start + blockBatches, numBatches)
+                    # the original position of each example is carried
+                    # along, so the manifest may follow the permutation
+                    blocks = [np.reshape(s[start:stop], (-1,) + s.shape[2:]) \
+                              for s in sources] + \
+                             [np.arange(start * batchSize, stop * batchSize)]
+                    assign = rng.randint(0, numBuckets, len(blocks[0]))
+                    order = np.argsort(assign, kind='mergesort')
+                    offsets = np.searchsorted(assign[order],
+                                              np.arange(numBuckets + 1))
+                    blocks = [block[order] for block in blocks]
+                    for bb in range(numBuckets) :
+                        first, last = offsets[bb], offsets[bb + 1]
+                        if first == last :
+                            continue
+                        for dest, block in zip(buckets[bb], blocks) :
+                            size = dest.shape[0]
+                            dest.resize(size + last - first, axis=0)
+                            dest[size:] = block[first:last]
+                if log is not None :
+                    log.debug('Scattered the examples in ' +
+                              str(time() - timer) + 's')
+
+                # gather each bucket back in order --
+                # the examples are invalid until the slots are remapped.
+                doneH5 = hdf5.get('manifest/train/done')
+                if doneH5 is not None :
+                    done = doneH5[...]
+                    doneH5[...] = False
+                    hdf5.flush()
+                timer = time()
+                offset = 0
+                slotMap = np.arange(numExamples)
+                for bucket in buckets :
+                    perm = rng.permutation(bucket[0].shape[0])
+                    for dest, src in zip(sources, bucket) :
+                        writeExamples(dest, offset, src[...][perm])
+                    slotMap[bucket[-1][...][perm]] = \
+                        np.arange(offset, offset + len(perm))
+                    offset += len(perm)
+                if log is not None :
+                    log.debug('Gathered the examples in ' +
+                              str(time() - timer) + 's')
+        finally :
+            os.remove(tmpFile)
+
+        # each ingested file now occupies the slot its example moved to
+        if 'manifest/train/slot' in hdf5 :
+            slotsH5 = hdf5['manifest/train/slot']
+            slots = slotsH5[...]
+            moved = (slots >= 0) & (slots < numExamples)
+            slots[moved] = slotMap[slots[moved]]
+            slotsH5[...] = slots
+            hdf5.flush()
+        if doneH5 is not None :
+            doneH5[...] = done
+        hdf5.flush()
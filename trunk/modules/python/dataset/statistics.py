@@ -0,0 +1,175 @@
+import numpy as np
+
+class ChannelStats () :
+    '''Per-channel mean and variance of a stream of image batches. Each batch
+       is reduced on its own and merged into the running totals with the
+       parallel form of Welford's algorithm, so the statistics are exact
+       over the whole stream and partial statistics may also be merged.
+
+       numChannels : Number of channels in the imagery
+    '''
+    def __init__ (self, numChannels) :
+        self.count = 0
+        self.mean = np.zeros(numChannels, dtype=np.float64)
+        self.m2 = np.zeros(numChannels, dtype=np.float64)
+
+    def update(self, data) :
+        '''Accumulate a batch formatted (..., numChannels, rows, cols).'''
+        data = np.asarray(data)
+        axes = tuple(ii for ii in range(data.ndim) if ii != data.ndim - 3)
+        count = data.size // data.shape[-3]
+        if count == 0 :
+            return
+        mean = np.mean(data, axis=axes, dtype=np.float64)
+        m2 = np.var(data, axis=axes, dtype=np.float64) * count
+        self._combine(count, mean, m2)
+
+    def merge(self, other) :
+        '''Merge the statistics accumulated by another ChannelStats.'''
+        if other.count > 0 :
+            self._combine(other.count, other.mean, other.m2)
+
+    def _combine(self, count, mean, m2) :
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (float(count) / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (float(self.count) * count /
+                                               total)
+        self.count = total
+
+    def variance(self) :
+        return self.m2 / max(self.count, 1)
+
+    def std(self) :
+        '''Standard deviation of each channel. A constant channel reports
+           one, so standardizing it does not divide by zero.
+        '''
+        std = np.sqrt(self.variance())
+        std[std == 0] = 1.
+        return std
+
+def standardize(data, stats, out=None) :
+    '''Apply the affine transform (data - mean) / std to each channel.
+
+       data   : Imagery formatted (..., numChannels, rows, cols)
+       stats  : Per-channel (mean, std)
+       out    : Optional buffer to write into, which may be data itself
+       return : The standardized imagery
+    '''
+    dtype = data.dtype if out is None else out.dtype
+    mean = np.asarray(stats[0], dtype=dtype).reshape(-1, 1, 1)
+    std = np.asarray(stats[1], dtype=dtype).reshape(-1, 1, 1)
+    if out is None :
+        return (data - mean) / std
+    np.subtract(data, mean, out=out)
+    np.divide(out, std, out=out)
+    return out
+
+def writeStatistics(dataH5, stats) :
+    '''Store the statistics in the attributes of the HDF5 dataset.'''
+    dataH5.attrs['mean'] = stats.mean
+    dataH5.attrs['std'] = stats.std()
+    dataH5.attrs['count'] = stats.count
+
+def readStatistics(dataH5) :
+    '''Return the (mean, std) stored with the HDF5 dataset, or None.'''
+    if 'mean' not in dataH5.attrs :
+        return None
+    return dataH5.attrs['mean'], dataH5.attrs['std']
+
+def loadStatistics(filepath) :
+    '''Return the (mean, std) of the training set of a HDF5 dataset file.
+       This is used to standardize imagery at inference time.
+    '''
+    import h5py
+    with h5py.File(filepath, mode='r') as hdf5 :
+        stats = readStatistics(hdf5['train/data'])
+    if stats is None :
+        raise ValueError('No dataset statistics in [' + filepath + ']')
+    return stats
+
+def datasetStatistics(dataH5, log=None) :
+    '''Stream the dataset a mini-batch at a time and accumulate the
+       statistics of each channel.
+
+       dataH5 : Dataset formatted (numBatches, batchSize, channels, rows, cols)
+       log    : Logger to use
+       return : ChannelStats
+    '''
+    from time import time
+    from dataset.prefetch import readBatch
+    timer = time()
+    stats = ChannelStats(dataH5.shape[2])
+    batch = np.ndarray(dataH5.shape[1:], dtype=dataH5.dtype)
+    for ii in range(dataH5.shape[0]) :
+        readBatch(batch, dataH5, ii)
+        stats.update(batch)
+    if log is not None :
+        log.info('Computed the statistics of [' + str(stats.count) +
+                 '] pixels per channel in ' + str(time() - timer) + 's')
+    return stats
+
+def standardizeDataset(dataH5, stats, log=None, interval=64) :
+    '''Standardize the dataset in place a mini-batch at a time. The progress
+       is recorded in the 'standardized' attribute, so an interrupted pass
+       resumes without transforming any batch twice.
+
+       dataH5   : Dataset formatted (numBatches, batchSize, ...)
+       stats    : Per-channel (mean, std)
+       log      : Logger to use
+       interval : Number of batches between progress updates
+    '''
+    from dataset.prefetch import readBatch
+    start = int(dataH5.attrs.get('standardized', 0))
+    batch = np.ndarray(dataH5.shape[1:], dtype=dataH5.dtype)
+    if log is not None :
+        log.info('Standardizing [' + dataH5.name + '] from batch [' +
+                 str(start) + ']')
+    for ii in range(start, dataH5.shape[0]) :
+        readBatch(batch, dataH5, ii)
+        dataH5[ii] = standardize(batch, stats, batch)
+        if (ii + 1) % interval == 0 :
+            dataH5.attrs['standardized'] = ii + 1
+            dataH5.file.flush()
+    del dataH5.attrs['standardized']
+    dataH5.file.flush()
+
+def prepareStatistics(hdf5, datasets, log=None) :
+    '''Determine how imagery is normalized as it is added to a file built
+       with dataset statistics. An interrupted standardization is completed
+       first.
+
+       hdf5     : HDF5 file opened for writing
+       datasets : Names of the datasets, starting with the training data
+       log      : Logger to use
+       return   : (mean, std) when the file already holds standardized data,
+                  or None when the imagery is to be written unnormalized
+    '''
+    stats = readStatistics(hdf5[datasets[0]])
+    if stats is not None :
+        for name in datasets :
+            if name in hdf5 and 'standardized' in hdf5[name].attrs :
+                standardizeDataset(hdf5[name], stats, log)
+    return stats
+
+def finalizeStatistics(hdf5, datasets, log=None) :
+    '''Compute the statistics over the unnormalized training data, store
+       them, and standardize every dataset with them.
+
+       hdf5     : HDF5 file opened for writing
+       datasets : Names of the datasets, starting with the training data
+       log      : Logger to use
+       return   : (mean, std)
+    '''
+    datasets = [name for name in datasets if name in hdf5]
+    stats = datasetStatistics(hdf5[datasets[0]], log)
+    # the attributes are written before any data is transformed, so an
+    # interruption leaves the file resumable by prepareStatistics
+    for name in datasets :
+        hdf5[name].attrs['standardized'] = 0
+    writeStatistics(hdf5[datasets[0]], stats)
+    hdf5.flush()
+    stats = readStatistics(hdf5[datasets[0]])
+    for name in datasets :
+        standardizeDataset(hdf5[name], stats, log)
+    return stats
@@ -0,0 +1,159 @@
+import numpy as np
+import threading
+from timeit import default_timer as timer
+
+class SharedWindow () :
+    '''A fixed-size theano.shared window over a disk-backed dataset. The
+       window holds windowSize consecutive batches on the target device, so
+       functions compiled with index-based givens run at in-memory speed.
+       While the network trains on the current window, the next window is
+       read into a host staging buffer in the background. Crossing into the
+       next window only costs the set_value transfer to the device.
+
+       sources    : List of datasets indexed by batch (ie. [data, labels]).
+                    These may be h5py.Dataset, numpy.memmap or numpy.ndarray.
+       windowSize : Number of batches held on the device at once
+       labels     : Treat the last source as integer labels. This matches
+                    dataset.shared.splitToShared, where labels are stored as
+                    floatX and cast to int32 on the device.
+                    NOTE: A quantized source keeps its stored type on the
+                          device (see dataset.quantize), and its variable
+                          is tagged with the quantization. Backends which
+                          only place floatX on the device (see
+                          dataset.shared.compactShared) receive the window
+                          dequantized on the host instead.
+       log        : Logger to use
+    '''
+    def __init__ (self, sources, windowSize, labels=False, log=None) :
+        import theano
+        from dataset.quantize import getQuantization
+        from dataset.prefetch import closeAtExit
+        from dataset.shared import compactShared
+        self._sources = sources
+        self._numBatches = len(sources[0])
+        self._windowSize = max(1, min(int(windowSize), self._numBatches))
+        self._numWindows = int(np.ceil(float(self._numBatches) /
+                                       self._windowSize))
+        self._log = log
+
+        # two host buffers per source -- one backs the device window, while
+        # the other is filled with the next window in the background.
+        quants = [getQuantization(s) for s in sources]
+        compact = compactShared()
+        dtypes = [s.dtype if quant is not None and compact else \
+                  theano.config.floatX for s, quant in zip(sources, quants)]
+        # sources dequantized on the host as the window is read
+        self._quants = [None if compact else quant for quant in quants]
+        self._host = [[np.zeros([self._windowSize] + list(s.shape[1:]),
+                                dtype=dtype) \
+                       for s, dtype in zip(sources, dtypes)] \
+                      for ii in range(2)]
+        self._shared = [theano.shared(buf, borrow=True) \
+                        for buf in self._host[0]]
+        for shared, quant in zip(self._shared, quants) :
+            if quant is not None and compact :
+                shared.tag.quantization = quant
+        self.variables = list(self._shared)
+        if labels :
+            self.variables[-1] = theano.tensor.cast(self._shared[-1],
+                                                    'int32')
+
+        self.stallTime = 0.
+        self.swaps = 0
+        self._current = None
+        self._front = 0
+        self._loader = None
+        self._loading = None
+        self._error = None
+        self._swap(0)
+
+        # ensure the loader is not interrupted mid-read during shutdown
+        closeAtExit(self)
+
+    def _bounds(self, window) :
+        start = window * self._windowSize
+        return start, min(start + self._windowSize, self._numBatches)
+
+    def _load(self, window, buffers) :
+        '''Read the window as a single contiguous block from each source.'''
+        from dataset.quantize import dequantize
+        start, stop = self._bounds(window)
+        try :
+            for buf, source, quant in zip(buffers, self._sources,
+                                          self._quants) :
+                if quant is not None :
+                    dequantize(source[start:stop], quant,
+                               buf[0:stop-start])
+                elif hasattr(source, 'read_direct') and \
+                     source.dtype == buf.dtype :
+                    source.read_direct(buf, np.s_[start:stop],
+                                       np.s_[0:stop-start])
+                else :
+                    buf[0:stop-start] = source[start:stop]
+        except Exception as ex :
+            self._error = ex
+
+    def _startLoad(self, window) :
+        '''Begin reading the window into the back buffer.'''
+        back = self._host[1 - self._front]
+        self._loader = threading.Thread(target=self._load,
+                                        args=(window, back))
+        self._loader.daemon = True
+        self._loading = window
+        self._loader.start()
+
+    def _swap(self, window) :
+        '''Make the window resident on the device.'''
+        start = timer()
+        if self._loading != window :
+            # the window was not anticipated -- read it synchronously
+            if self._loader is not None :
+                self._loader.join()
+            self._startLoad(window)
+        self._loader.join()
+        self.stallTime += timer() - start
+        if self._error is not None :
+            error, self._error = self._error, None
+            self._loading = None
+            raise error
+
+        # swap the buffers and transfer the window to the device
+        self._front = 1 - self._front
+        for shared, buf in zip(self._shared, self._host[self._front]) :
+            shared.set_value(buf, borrow=True)
+        self._current = window
+        self.swaps += 1
+
+        # read ahead into the buffer which no longer backs the device
+        self._startLoad((window + 1) % self._numWindows)
+
+    def getNumBatches(self) :
+        return self._numBatches
+
+    def local(self, index) :
+        '''Return the index into the window for the global batch index. This
+           swaps in the window containing the batch if it is not resident.
+        '''
+        window = index // self._windowSize
+        if window != self._current :
+            self._swap(window)
+        return index - window * self._windowSize
+
+    def resetStats(self) :
+        '''Reset the stall accounting.'''
+        self.stallTime = 0.
+        self.swaps = 0
+
+    def restart(self, window=0) :
+        '''Discard the resident window, as the sources have changed (ie. the
+           next epoch was shuffled), and begin reading the window.
+        '''
+        self.close()
+        self._current = None
+        self._startLoad(window)
+
+    def close(self) :
+        '''Wait for any read in flight.'''
+        if self._loader is not None :
+            self._loader.join()
+        self._loading = None
@@ -1,61 +1,202 @@
 import numpy as np
 from net import ClassifierNetwork
 
-def createClassMap(network, image) :
-    '''This is an exhaustive search algorithm which checks all available 
-       sub-regions. This creates two matrices of the classifications and 
-       their associated likelihood confidences.
-       This can be thought of as a heat map for the classification and the 
-       confidence in those classifications. Areas of high-confidence and large
-       regions of like classifications are likely to contain an identifiable
-       object.
-
-       network : Pre-trained ClassifierNetwork to classify the image
-       image   : image to classify. The size is assumed to be greater than
-                 or equal to the network's input size. 
-                 (numChannels, numRows, numCols)
+def _verifyImage(network, image) :
+    '''Verify the image may be classified by the network.
 
-       return  : numpy.ndarray(classification), numpy.ndarray(confidence)
+       return : network input shape (numChannels, numRows, numCols)
     '''
-
     # verify the types and sizing
     if not isinstance(network, ClassifierNetwork) :
         raise ValueError('network must be a ClassifierNetwork object')
     if not isinstance(image, np.ndarray) :
         raise ValueError('imageRegion must be a numpy.ndarray object')
+    return _verifyShape(network, image.shape)
+
+def _verifyShape(network, shape) :
+    '''Verify an image of the shape may be classified by the network.
 
+       return : network input shape (numChannels, numRows, numCols)
+    '''
     # only check the (numChannels, numRows, numCols) sizing on the network
     networkInputShape = network.getNetworkInputSize()[-3:]
-    if image.shape[0] != networkInputShape[0] :
+    if shape[0] != networkInputShape[0] :
         raise Exception('The imageRegion has a different number of channels ' +
                         'than the network was trained to recognize.')
-    if image.shape[1] < networkInputShape[1] or \
-       image.shape[2] < networkInputShape[2] :
+    if shape[1] < networkInputShape[1] or \
+       shape[2] < networkInputShape[2] :
         raise Exception('The imageRegion is smaller than the network input.')
+    return networkInputShape
+
+def slidingWindows(image, windowShape, step=1) :
+    '''Create a view of every window in the image without copying. The
+       windows are ordered by their upper-left pixel.
+
+       image       : image to window (numChannels, numRows, numCols)
+       windowShape : size of each window (numRows, numCols)
+       step        : number of pixels between neighboring windows
 
-    # create the memory buffers
-    featureShape = (image.shape[1] - networkInputShape[1] + 1,
-                    image.shape[2] - networkInputShape[2] + 1)
+       return      : numpy.ndarray view of shape
+                     (outRows, outCols, numChannels, winRows, winCols)
+    '''
+    from numpy.lib.stride_tricks import as_strided
+    outShape = ((image.shape[1] - windowShape[0]) // step + 1,
+                (image.shape[2] - windowShape[1]) // step + 1)
+    chanStride, rowStride, colStride = image.strides
+    return as_strided(image,
+                      shape=outShape + (image.shape[0],) + tuple(windowShape),
+                      strides=(rowStride * step, colStride * step,
+                               chanStride, rowStride, colStride))
+
+def packWindows(batch, windows, start, count) :
+    '''Copy count windows, beginning at the flattened window index start,
+       into the mini-batch buffer. Copies are performed a row of windows at
+       a time so no intermediate arrays are created.
+    '''
+    outCols = windows.shape[1]
+    dst = 0
+    while dst < count :
+        row, col = divmod(start + dst, outCols)
+        num = min(count - dst, outCols - col)
+        batch[dst:dst+num] = windows[row, col:col+num]
+        dst += num
+
+def createClassMap(network, image, step=1, batchSize=None) :
+    '''This is an exhaustive search algorithm which checks all available 
+       sub-regions. This creates two matrices of the classifications and 
+       their associated likelihood confidences.
+       This can be thought of as a heat map for the classification and the 
+       confidence in those classifications. Areas of high-confidence and large
+       regions of like classifications are likely to contain an identifiable
+       object.
+
+       The windows are strided views into the image, which are packed into
+       mini-batches matching the network's compiled batch size, so the
+       network is activated once per mini-batch rather than once per pixel.
+
+       network   : Pre-trained ClassifierNetwork to classify the image
+       image     : image to classify. The size is assumed to be greater than
+                   or equal to the network's input size. 
+                   (numChannels, numRows, numCols)
+       step      : number of pixels between neighboring windows. The output
+                   maps are subsampled by this factor.
+       batchSize : number of windows to classify per network call. This
+                   defaults to the network's compiled batch size. Smaller
+                   values are zero-padded to the compiled size.
+
+       return    : numpy.ndarray(classification), numpy.ndarray(confidence)
+    '''
+    import theano
+
+    networkInputShape = _verifyImage(network, image)
+    if step < 1 :
+        raise ValueError('step must be a positive integer')
+
+    # create the window view and the memory buffers --
+    # the mini-batch buffer is allocated at the compiled batch size, and
+    # reused for every call into the network.
+    windows = slidingWindows(image, networkInputShape[1:], step)
+    featureShape = windows.shape[:2]
     classifications = np.ndarray(featureShape, dtype='int32')
     confidence = np.ndarray(featureShape)
+    compiledSize = network.getNetworkInputSize()[0]
+    batchSize = compiledSize if batchSize is None else \
+                max(1, min(batchSize, compiledSize))
+    batch = np.zeros([compiledSize] + list(networkInputShape),
+                     dtype=theano.config.floatX)
 
-    # fill out each matrix with the network output
-    # TODO: It's likely faster to slide down the rows, because the reload
-    #       will be aligned with contiguous memory.
-    # TODO: Thread this, it's embarrassingly parallel, but watch out
-    #       because the internal values may cause race conditions.
-    numRows, numCols = networkInputShape[1], networkInputShape[2]
-    for ii in range(featureShape[0]) :
-        for jj in range(featureShape[1]) :
-            classifications[ii][jj], softmax = network.classifyAndSoftmax(
-                np.reshape(image[:,ii:ii+numRows,jj:jj+numCols],
-                           (1,1,numRows,numCols)))
-            confidence[ii][jj] = softmax[0][classifications[ii][jj]]
-
+    # fill out each matrix with the network output in bulk --
+    # a partial mini-batch leaves stale windows in the tail of the buffer,
+    # however their outputs are discarded.
+    numWindows = featureShape[0] * featureShape[1]
+    classFlat = classifications.reshape(-1)
+    confFlat = confidence.reshape(-1)
+    for start in range(0, numWindows, batchSize) :
+        count = min(batchSize, numWindows - start)
+        packWindows(batch, windows, start, count)
+        classIndex, softmax = network.classifyAndSoftmax(batch)
+        classFlat[start:start+count] = classIndex[:count]
+        confFlat[start:start+count] = softmax[np.arange(count),
+                                              classIndex[:count]]
 
     # return the results
     return classifications, confidence
 
+def createDenseClassMap(network, image, tileSize=256) :
+    '''Create the same classification and confidence maps as createClassMap,
+       using the fully-convolutional form of the network. The convolutions
+       shared by overlapping windows are computed once.
+
+       The dense network produces outputs spaced by its pooling factor, so
+       each tile is classified once per pooling offset (shift-and-stitch) and
+       the shifted outputs are interleaved back into pixel order. Tiles
+       overlap by the network input size less one (the halo), so the tiles
+       stitch without seams.
+
+       network  : Pre-trained ClassifierNetwork to classify the image
+       image    : image to classify. The size is assumed to be greater than
+                  or equal to the network's input size. 
+                  (numChannels, numRows, numCols)
+       tileSize : number of output pixels along each side of a tile. This is
+                  rounded to a multiple of the pooling factor, and bounds the
+                  memory used by each pass through the network.
+
+       return   : numpy.ndarray(classification), numpy.ndarray(confidence)
+    '''
+    import theano
+
+    networkInputShape = _verifyImage(network, image)
+    numChannels, winRows, winCols = networkInputShape
+    poolRows, poolCols = network.getPoolingFactor()
+    featureShape = (image.shape[1] - winRows + 1,
+                    image.shape[2] - winCols + 1)
+    tileRows = max(poolRows, min(tileSize, featureShape[0]) // poolRows *
+                             poolRows)
+    tileCols = max(poolCols, min(tileSize, featureShape[1]) // poolCols *
+                             poolCols)
+
+    # pad the scene so every tile and its halo lie within the buffer --
+    # windows which extend into the padding are discarded.
+    paddedFeature = (int(np.ceil(float(featureShape[0]) / tileRows)) *
+                     tileRows,
+                     int(np.ceil(float(featureShape[1]) / tileCols)) *
+                     tileCols)
+    scene = np.zeros((numChannels, paddedFeature[0] + winRows - 1,
+                      paddedFeature[1] + winCols - 1),
+                     dtype=theano.config.floatX)
+    scene[:, :image.shape[1], :image.shape[2]] = image
+    classifications = np.ndarray(paddedFeature, dtype='int32')
+    confidence = np.ndarray(paddedFeature)
+
+    # each pooling offset crops the tile to the same size, so all offsets
+    # are classified together as a single batch.
+    outRows, outCols = tileRows // poolRows, tileCols // poolCols
+    cropRows = tileRows - poolRows + winRows
+    cropCols = tileCols - poolCols + winCols
+    shifts = np.ndarray((poolRows * poolCols, numChannels, cropRows, cropCols),
+                        dtype=theano.config.floatX)
+
+    def stitch(maps) :
+        '''Interleave the per-offset outputs into pixel order.'''
+        return maps[:, :outRows, :outCols].reshape(
+            poolRows, poolCols, outRows, outCols).transpose(
+            2, 0, 3, 1).reshape(tileRows, tileCols)
+
+    for row in range(0, paddedFeature[0], tileRows) :
+        for col in range(0, paddedFeature[1], tileCols) :
+            for ii in range(poolRows) :
+                for jj in range(poolCols) :
+                    shifts[ii * poolCols + jj] = scene[
+                        :, row+ii:row+ii+cropRows, col+jj:col+jj+cropCols]
+            classIndex, conf = network.classifyDense(shifts)
+            classifications[row:row+tileRows, col:col+tileCols] = \
+                stitch(classIndex)
+            confidence[row:row+tileRows, col:col+tileCols] = stitch(conf)
+
+    # return the results
+    return classifications[:featureShape[0], :featureShape[1]], \
+           confidence[:featureShape[0], :featureShape[1]]
+
 def singleClassify(network, image) :
     '''This is an exhaustive search algorithm which checks all available 
        sub-regions. This assumes the image or subregion contains only one 
@@ -90,28 +231,44 @@ def singleClassify(network, image) :
 
 if __name__ == "__main__" :
     import argparse
-    from datasetUtils import readImage
+    from dataset.reader import readImage
     from net import ClassifierNetwork as Network
     from dataset.reader import normalize
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--multiple', dest='multi', type=bool, default=True,
                         help='Specify that the image contains multiple objects')
+    parser.add_argument('--step', dest='step', type=int, default=1,
+                        help='Number of pixels between classified windows.')
+    parser.add_argument('--dense', dest='dense', action='store_true',
+                        help='Classify using the fully-convolutional network.')
     parser.add_argument('--syn', dest='synapse', type=str, default=None,
                         help='Load from a previously saved network.')
+    parser.add_argument('--stats', dest='stats', type=str, default=None,
+                        help='HDF5 dataset whose statistics standardize ' +
+                             'the image, when built with dataset ' +
+                             'normalization.')
     parser.add_argument('--out', dest='outFile', type=str, default=None,
                         help='Output image with box classifications.')
     parser.add_argument('image', help='Image to classify')
     options = parser.parse_args()
 
-    # load everything into memory
-    image = readImage(options.image)
+    # load everything into memory --
+    # dataset statistics replace the per-image normalization
+    norm = 'image'
+    if options.stats is not None :
+        from dataset.statistics import loadStatistics
+        norm = loadStatistics(options.stats)
+    image = readImage(options.image, norm=norm)
 
     network = Network(options.synapse)
 
     # perform classification for multiple objects
-    if options.multi :
-        classification, confidence = createClassMap(network, image)
+    if options.multi and options.dense :
+        classification, confidence = createDenseClassMap(network, image)
+    elif options.multi :
+        classification, confidence = createClassMap(network, image,
+                                                    options.step)
     else :
         classification, confidence = singleClassify(network, image)
 
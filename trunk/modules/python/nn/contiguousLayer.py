@@ -67,6 +67,29 @@ class ContiguousLayer(Layer) :
         # create a convenience function
         self.output = self._setOutput((self._numNeurons,), outClass, outTrain)
 
+    def finalizeDense(self, layerInput, windowShape) :
+        '''Setup the dense computation graph for this layer. The layer is
+           converted to the equivalent convolution, where the kernel spans
+           the entire per-window input. A layer following another contiguous
+           layer becomes a 1x1 convolution.
+
+           layerInput  : tensor4 input (numTiles, channels, rows, columns)
+           windowShape : per-window input size of this layer --
+                         (channels, rows, columns) or (pattern size,)
+        '''
+        from theano.tensor.nnet.conv import conv2d
+
+        # the weights are stored in the flattened C-order of the input.
+        # conv2d flips the kernel, so it is pre-flipped to produce the same
+        # inner product as dot().
+        kernelShape = (self._numNeurons,) + tuple(windowShape) \
+                      if len(windowShape) == 3 else \
+                      (self._numNeurons, windowShape[0], 1, 1)
+        kernel = self._weights.T.reshape(kernelShape)[:, :, ::-1, ::-1]
+        return self._setDenseOutput(
+            conv2d(layerInput, kernel) +
+            self._thresholds.dimshuffle('x', 0, 'x', 'x'))
+
     def getInputSize (self) :
         '''(numInputs, pattern size)'''
         return self._inputSize
@@ -103,6 +103,23 @@ class ConvolutionalLayer(Layer) :
         self.output = self._setOutput(self.getOutputSize()[1:], 
                                       outClass, outTrain)
 
+    def finalizeDense(self, layerInput, windowShape) :
+        '''Setup the dense computation graph for this layer. This is the
+           classification path of finalize() without a fixed input size, so
+           the layer may be applied across an entire scene in one pass.
+
+           layerInput  : tensor4 input (numTiles, channels, rows, columns)
+           windowShape : per-window input size of this layer. This is unused
+                         as the kernels are already spatial.
+        '''
+        from theano.tensor.nnet.conv import conv2d
+        from theano.tensor.signal.pool import pool_2d
+
+        pooling = pool_2d(conv2d(layerInput, self._weights),
+                          self._downsampleFactor, ignore_border=True)
+        return self._setDenseOutput(
+            pooling + self._thresholds.dimshuffle('x', 0, 'x', 'x'))
+
     def getInputSize (self) :
         '''The initial input size provided at construction. This is sized
            (batch size, channels, rows, columns)'''
@@ -118,6 +135,9 @@ class ConvolutionalLayer(Layer) :
                 self._kernelSize[0],
                 self._inputSize[2] - self._kernelSize[2] + 1,
                 self._inputSize[3] - self._kernelSize[3] + 1)
+    def getDownsampleFactor (self) :
+        '''The max pooling factor (rowFactor, columnFactor)'''
+        return tuple(self._downsampleFactor)
     def getOutputSize (self) :
         '''This is the post downsample size of the output.
            (batch size, number of kernels, rows, columns)'''
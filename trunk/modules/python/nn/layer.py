@@ -130,9 +130,24 @@ class Layer () :
         # computation graph.
         return (self._setActivation(outClass), self._setActivation(outTrain))
 
+    def _setDenseOutput(self, out) :
+        '''Activate the dense output. This matches the classification path
+           of _setOutput, where the output is scaled by the dropout factor.
+        '''
+        if self._dropout is not None :
+            out = out / self._dropout
+        return self._setActivation(out)
+
     def finalize(self, networkInput, layerInput) :
         raise NotImplementedError('Implement the finalize() method')
 
+    def finalizeDense(self, layerInput, windowShape) :
+        raise NotImplementedError('Implement the finalizeDense() method')
+
+    def getDownsampleFactor(self) :
+        '''The spatial subsampling performed by this layer (rows, columns).'''
+        return (1, 1)
+
     def getWeights(self) :
         '''This allows the network backprop all layers efficiently.'''
         return [self._weights, self._thresholds]
@@ -100,6 +100,7 @@ class ClassifierNetwork (Network) :
         if '_outClassMax' in dict : del dict['_outClassMax']
         if '_classify' in dict : del dict['_classify']
         if '_classifyAndSoftmax' in dict : del dict['_classifyAndSoftmax']
+        if '_classifyDense' in dict : del dict['_classifyDense']
         return dict
 
     def __setstate__(self, dict) :
@@ -112,6 +113,8 @@ class ClassifierNetwork (Network) :
             delattr(self, '_classify')
         if hasattr(self, '_classifyAndSoftmax') : 
             delattr(self, '_classifyAndSoftmax')
+        if hasattr(self, '_classifyDense') : 
+            delattr(self, '_classifyDense')
         Network.__setstate__(self, dict)
 
     def addLayer(self, layer) :
@@ -199,6 +202,59 @@ class ClassifierNetwork (Network) :
         self._endProfile()
         return classIndex, softmax
 
+    def getPoolingFactor(self) :
+        '''Return the total subsampling of the network (rows, columns). This
+           is the spacing between outputs of the dense classification.
+        '''
+        rows, cols = 1, 1
+        for layer in self._layers :
+            factor = layer.getDownsampleFactor()
+            rows, cols = rows * factor[0], cols * factor[1]
+        return rows, cols
+
+    def finalizeDense(self) :
+        '''Setup the fully-convolutional form of the network. The contiguous
+           layers are converted to their equivalent convolutions, so an input
+           larger than the network input is classified at every window
+           position spaced by the pooling factor, without recomputing the
+           convolutions shared by overlapping windows.
+        '''
+        inputSize = self.getNetworkInputSize()
+        if len(inputSize) != 4 :
+            raise ValueError('Dense classification requires a network input ' +
+                             'of (batch size, channels, rows, columns).')
+
+        self._startProfile('Finalizing Dense Network', 'info')
+        denseInput = t.tensor4('denseInput')
+        layerInput, windowShape = denseInput, inputSize[1:]
+        for layer in self._layers :
+            layerInput = layer.finalizeDense(layerInput, windowShape)
+            windowShape = layer.getOutputSize()[1:]
+
+        # softmax across the class axis of each output position
+        outClass = t.exp(layerInput - layerInput.max(axis=1, keepdims=True))
+        outClass = outClass / outClass.sum(axis=1, keepdims=True)
+        self._classifyDense = theano.function(
+            [denseInput], [t.argmax(outClass, axis=1), t.max(outClass, axis=1)])
+        self._endProfile()
+
+    def classifyDense (self, inputs) :
+        '''Classify every window position within the inputs in one pass.
+           The input is assumed to be numpy.ndarray of shape
+           (numTiles, channels, rows, columns), where rows and columns are
+           at least the size of the network input.
+
+           return : (classification map, confidence map) each of shape
+                    (numTiles, outRows, outCols). Neighboring outputs are
+                    spaced by getPoolingFactor() in the input.
+        '''
+        self._startProfile('Classifying the Dense Inputs', 'debug')
+        if not hasattr(self, '_classifyDense') :
+            self.finalizeDense()
+        classIndex, confidence = self._classifyDense(inputs)
+        self._endProfile()
+        return classIndex, confidence
+
 
 class LabeledClassifierNetwork (ClassifierNetwork) :
     '''The LabeledClassifierNetwork adds labeling to the classification.
@@ -265,9 +321,25 @@ class TrainerNetwork (LabeledClassifierNetwork) :
        filepath : Path to an already trained network on disk 
                   'None' creates randomized weighting
        prof     : Profiler to use
+       prefetch : Number of batches to read ahead when the datasets are not
+                  theano.shared (ie. backed by HDF5 or numpy.memmap)
+       window   : Number of batches to hold in a rotating theano.shared window
+                  when the datasets are not theano.shared. This keeps the
+                  index-based functions while streaming from disk.
+                  None feeds each batch from the host via the prefetcher.
+       shuffle  : Draw a new permutation of the training examples each
+                  epoch. A theano.shared training set is gathered through
+                  an index vector, while a disk-backed training set is
+                  shuffled across groups of batches.
+       shuffleGroup : Number of batches whose examples are mixed together
+                  when the training set is not theano.shared. Defaults to
+                  the window size, otherwise 8 batches. The batch order is
+                  always shuffled across the epoch, while examples only mix
+                  within a group (see dataset.sampler.GroupShuffler).
     '''
     def __init__ (self, train, test, labels, regType='L2', regScaleFactor=0.,
-                  filepath=None, prof=None) :
+                  filepath=None, prof=None, prefetch=2, window=None,
+                  shuffle=False, shuffleGroup=None) :
         from nn.reg import Regularization
         LabeledClassifierNetwork.__init__(self, labels, filepath=filepath,
                                           prof=prof)
@@ -288,6 +360,15 @@ class TrainerNetwork (LabeledClassifierNetwork) :
                                 self._testLabels.shape[1]
 
         self._regularization = Regularization(regType, regScaleFactor)
+        self._prefetch = prefetch
+        self._window = window
+        self._trainPrefetch = None
+        self._testPrefetch = None
+        self._shuffle = shuffle
+        self._shuffleGroup = shuffleGroup if shuffleGroup is not None else \
+                             window if window is not None else 8
+        self._trainShuffle = None
+        self._trainPerm = None
 
     def __getstate__(self) :
         '''Save network pickle'''
@@ -304,6 +385,17 @@ class TrainerNetwork (LabeledClassifierNetwork) :
         # remove the functions -- they will be rebuilt JIT
         if '_checkAccuracy' in dict : del dict['_checkAccuracy']
         if '_trainNetwork' in dict : del dict['_trainNetwork']
+        # the prefetchers hold threads and buffers tied to this process
+        if '_prefetch' in dict : del dict['_prefetch']
+        if '_window' in dict : del dict['_window']
+        if '_trainPrefetch' in dict : del dict['_trainPrefetch']
+        if '_testPrefetch' in dict : del dict['_testPrefetch']
+        # the epoch permutation is tied to the training set
+        if '_shuffle' in dict : del dict['_shuffle']
+        if '_shuffleGroup' in dict : del dict['_shuffleGroup']
+        if '_trainShuffle' in dict : del dict['_trainShuffle']
+        if '_trainPerm' in dict : del dict['_trainPerm']
+        if '_shuffleRNG' in dict : del dict['_shuffleRNG']
         return dict
 
     def __setstate__(self, dict) :
@@ -312,14 +404,62 @@ class TrainerNetwork (LabeledClassifierNetwork) :
         # theano functions to be rebuilt with the new buffers
         if hasattr(self, '_checkAccuracy') : delattr(self, '_checkAccuracy')
         if hasattr(self, '_trainNetwork') : delattr(self, '_trainNetwork')
+        self._closePrefetch()
         ClassifierNetwork.__setstate__(self, dict)
 
+    def _closePrefetch(self) :
+        '''Stop any background readers attached to the datasets.'''
+        for name in ('_trainPrefetch', '_testPrefetch') :
+            if hasattr(getattr(self, name, None), 'close') :
+                getattr(self, name).close()
+            setattr(self, name, None)
+
+    def _logPrefetchStall(self, prefetcher, message) :
+        '''Report the time spent waiting on the disk-backed dataset.'''
+        if prefetcher is not None :
+            if hasattr(prefetcher, 'swaps') :
+                counts = ' - Swaps: ' + str(prefetcher.swaps)
+            else :
+                counts = ' - Hits: ' + str(prefetcher.hits) + \
+                         ' - Misses: ' + str(prefetcher.misses)
+            self._startProfile(message + ' Prefetch Stall: ' +
+                               str(prefetcher.stallTime) + 's' + counts,
+                               'info')
+            self._endProfile()
+            prefetcher.resetStats()
+
+    def _shuffleEpoch(self) :
+        '''Draw the permutation of the training examples for the next epoch.
+           This is a no-op until the network is finalized, as finalizing
+           draws the permutation of the first epoch.
+        '''
+        from dataset.sampler import epochPermutation
+        from dataset.window import SharedWindow
+        if getattr(self, '_trainPerm', None) is not None :
+            self._trainPerm.set_value(epochPermutation(
+                *self._trainPerm.get_value(borrow=True).shape,
+                rng=self._shuffleRNG), borrow=True)
+        elif getattr(self, '_trainShuffle', None) is not None :
+            # any read-ahead of the previous order must be discarded
+            if isinstance(self._trainPrefetch, SharedWindow) :
+                self._trainPrefetch.close()
+                self._trainShuffle.shuffle()
+                self._trainPrefetch.restart()
+            else :
+                self._trainShuffle.shuffle()
+                self._trainPrefetch.setOrder()
+
     def finalizeNetwork(self, networkInput) :
         '''Setup the network based on the current network configuration.
            This creates several network-wide functions so they will be
            pre-compiled and optimized when we need them.
         '''
         from nn.costUtils import crossEntropyLoss, compileUpdates
+        from dataset.prefetch import BatchPrefetcher
+        from dataset.window import SharedWindow
+        from dataset.sampler import epochPermutation, GroupShuffler
+        from dataset.quantize import getQuantization, dequantizeVariable, \
+                                     quantizedInput
 
         if len(self._layers) == 0 :
             raise IndexError('Network must have at least one layer' +
@@ -332,6 +472,9 @@ class TrainerNetwork (LabeledClassifierNetwork) :
         self._profiler = None
         ClassifierNetwork.finalizeNetwork(self, networkInput)
         self._profiler = tmp
+        self._closePrefetch()
+        self._trainShuffle = None
+        self._trainPerm = None
 
         # create a function to quickly check the accuracy against the test set
         index = t.lscalar('index')
@@ -343,17 +486,45 @@ class TrainerNetwork (LabeledClassifierNetwork) :
         # NOTE: This uses the lamda function as a means to consolidate the
         #       calling scheme. This saves us from later using conditionals in
         #       the inner loops and optimizes the libary
+        # NOTE: Quantized datasets are transferred in their stored type where
+        #       the device accepts it (see dataset.shared.compactShared), and
+        #       dequantized to floatX within the compiled function.
+        testQuant = getQuantization(self._testData)
         if isShared(self._testData) :
             checkAcc = theano.function(
                 [index], numCorrect, 
-                givens={self.getNetworkInput()[0] : self._testData[index],
+                givens={self.getNetworkInput()[0] :
+                            dequantizeVariable(self._testData[index],
+                                               testQuant),
                         expectedLabels: self._testLabels[index]})
             self._checkAccuracy = lambda ii : checkAcc(ii)
-        else :
+        elif self._window is not None :
+            # stream the test set through a device-resident window
+            self._testPrefetch = SharedWindow(
+                [self._testData, self._testLabels], self._window, True)
+            testData, testLabels = self._testPrefetch.variables
             checkAcc = theano.function(
-                [self.getNetworkInput()[0], expectedLabels], numCorrect)
-            self._checkAccuracy = lambda ii : checkAcc(self._testData[ii],
-                                                       self._testLabels[ii])
+                [index], numCorrect,
+                givens={self.getNetworkInput()[0] :
+                            dequantizeVariable(testData[index],
+                                               getQuantization(testData)),
+                        expectedLabels: testLabels[index]})
+            self._checkAccuracy = lambda ii : checkAcc(
+                self._testPrefetch.local(ii))
+        else :
+            # read the test set in the background while the network runs
+            if testQuant is None :
+                checkAcc = theano.function(
+                    [self.getNetworkInput()[0], expectedLabels], numCorrect)
+            else :
+                testInput, testValue = quantizedInput(self._testData)
+                checkAcc = theano.function(
+                    [testInput, expectedLabels], numCorrect,
+                    givens={self.getNetworkInput()[0] : testValue})
+            self._testPrefetch = BatchPrefetcher(
+                [self._testData, self._testLabels], self._prefetch)
+            self._checkAccuracy = lambda ii : checkAcc(
+                *self._testPrefetch.get(ii))
 
         # create the cross entropy function --
         # This is the cost function for the network, and it assumes [0,1]
@@ -378,18 +549,77 @@ class TrainerNetwork (LabeledClassifierNetwork) :
         # NOTE: This uses the lamda function as a means to consolidate the
         #       calling scheme. This saves us from later using conditionals in
         #       the inner loops and optimizes the libary
-        if isShared(self._trainData) :
+        trainQuant = getQuantization(self._trainData)
+        trainSources = [self._trainData, self._trainLabels]
+        if self._shuffle :
+            import numpy as np
+            self._shuffleRNG = np.random.RandomState()
+            if not isShared(self._trainData) :
+                # permute the disk-backed set by groups of batches
+                self._trainShuffle = GroupShuffler(
+                    trainSources, self._shuffleGroup, self._shuffleRNG)
+                trainSources = self._trainShuffle.views
+
+        if isShared(self._trainData) and self._shuffle :
+            # gather each batch from the flattened training set --
+            # the permutation is an int32 matrix of example indices, so
+            # reshuffling an epoch only updates the indices on the device.
+            dataShape = self._trainData.shape.eval()
+            labelShape = self._trainLabels.shape.eval()
+            numExamples = int(dataShape[0] * dataShape[1])
+            self._trainPerm = theano.shared(epochPermutation(
+                dataShape[0], dataShape[1], self._shuffleRNG), borrow=True)
+            trainData = self._trainData.reshape(
+                [numExamples] + list(dataShape[2:]))
+            trainLabels = self._trainLabels.reshape(
+                [numExamples] + list(labelShape[2:]))
             trainNet = theano.function(
                 [index], xEntropy, updates=updates,
-                givens={self.getNetworkInput()[1]: self._trainData[index],
+                givens={self.getNetworkInput()[1]:
+                            dequantizeVariable(
+                                trainData[self._trainPerm[index]],
+                                trainQuant),
+                        expectedOutputs: trainLabels[self._trainPerm[index]]})
+            self._trainNetwork = lambda ii : trainNet(ii)
+        elif isShared(self._trainData) :
+            trainNet = theano.function(
+                [index], xEntropy, updates=updates,
+                givens={self.getNetworkInput()[1]:
+                            dequantizeVariable(self._trainData[index],
+                                               trainQuant),
                         expectedOutputs: self._trainLabels[index]})
             self._trainNetwork = lambda ii : trainNet(ii)
-        else :
+        elif self._window is not None :
+            # stream the training set through a device-resident window --
+            # the next window is read from disk while this one trains.
+            self._trainPrefetch = SharedWindow(
+                trainSources, self._window, self._trainLabels.ndim != 3)
+            trainData, trainLabels = self._trainPrefetch.variables
             trainNet = theano.function(
-                [self.getNetworkInput()[1], expectedOutputs],
-                 xEntropy, updates=updates)
-            self._trainNetwork = lambda ii : trainNet(self._trainData[ii], 
-                                                      self._trainLabels[ii])
+                [index], xEntropy, updates=updates,
+                givens={self.getNetworkInput()[1]:
+                            dequantizeVariable(trainData[index],
+                                               getQuantization(trainData)),
+                        expectedOutputs: trainLabels[index]})
+            self._trainNetwork = lambda ii : trainNet(
+                self._trainPrefetch.local(ii))
+        else :
+            # read the next batches in the background while the network
+            # trains on the current batch
+            if trainQuant is None :
+                trainNet = theano.function(
+                    [self.getNetworkInput()[1], expectedOutputs],
+                     xEntropy, updates=updates)
+            else :
+                trainInput, trainValue = quantizedInput(self._trainData)
+                trainNet = theano.function(
+                    [trainInput, expectedOutputs], xEntropy,
+                    updates=updates,
+                    givens={self.getNetworkInput()[1]: trainValue})
+            self._trainPrefetch = BatchPrefetcher(trainSources,
+                                                  self._prefetch)
+            self._trainNetwork = lambda ii : trainNet(
+                *self._trainPrefetch.get(ii))
         self._endProfile()
 
     def train(self, index) :
@@ -402,8 +632,12 @@ class TrainerNetwork (LabeledClassifierNetwork) :
                            '/' + str(self._numTrainBatches) + ']', 'debug')
         if not hasattr(self, '_trainNetwork') :
             from dataset.shared import toShared
+            from dataset.quantize import getQuantization, dequantizeVariable
+            # the network is built on floatX, whatever type is stored
             inp = toShared(self._trainData[0], borrow=True) \
-                  if not isShared(self._trainData) else self._trainData[0]
+                  if not isShared(self._trainData) else \
+                  dequantizeVariable(self._trainData[0],
+                                     getQuantization(self._trainData))
             self.finalizeNetwork(inp[:])
         if not isinstance(index, int) :
             raise Exception('Variable index must be an integer value')
@@ -428,7 +662,10 @@ class TrainerNetwork (LabeledClassifierNetwork) :
             #    layer.writeWeights(globalEpoch + localEpoch)
             self._startProfile('Running Epoch [' +
                                str(globalEpoch + localEpoch) + ']', 'info')
+            self._shuffleEpoch()
             [self.train(ii) for ii in range(self._numTrainBatches)]
+            self._logPrefetchStall(self._trainPrefetch, 'Epoch [' +
+                                   str(globalEpoch + localEpoch) + ']')
             self._endProfile()
         return globalEpoch + numEpochs
 
@@ -440,14 +677,19 @@ class TrainerNetwork (LabeledClassifierNetwork) :
         self._startProfile('Checking Accuracy', 'debug')
         if not hasattr(self, '_checkAccuracy') :
             from dataset.shared import toShared
+            from dataset.quantize import getQuantization, dequantizeVariable
+            # the network is built on floatX, whatever type is stored
             inp = toShared(self._trainData[0], borrow=True) \
-                  if not isShared(self._trainData) else self._trainData[0]
+                  if not isShared(self._trainData) else \
+                  dequantizeVariable(self._trainData[0],
+                                     getQuantization(self._trainData))
             self.finalizeNetwork(inp[:])
 
         # return the sum of all correctly classified targets
         acc = 0.0
         for ii in range(self._numTestBatches) :
             acc += float(self._checkAccuracy(ii))
+        self._logPrefetchStall(self._testPrefetch, 'Accuracy')
 
         self._endProfile()
         return acc / float(self._numTestSize) * 100.
@@ -0,0 +1,155 @@
+import numpy as np
+
+def tileGrid(featureShape, tileSize) :
+    '''Divide the output maps into tiles.
+
+       featureShape : size of the classification map (rows, cols)
+       tileSize     : number of output pixels along each side of a tile
+
+       return       : list of (row, col, numRows, numCols)
+    '''
+    return [(row, col, min(tileSize, featureShape[0] - row),
+             min(tileSize, featureShape[1] - col)) \
+            for row in range(0, featureShape[0], tileSize) \
+            for col in range(0, featureShape[1], tileSize)]
+
+# process-local state for the tile workers --
+# the pool initializer populates these, so each worker loads and compiles
+# the network once, and the scene is inherited via shared memory rather
+# than pickled with every tile. A scene on disk is held as its path.
+_workerNetwork = None
+_workerScene = None
+_workerDense = False
+_workerNorm = 'image'
+
+def _initTileWorker(filepath, raw, sceneShape, dtype, dense, norm='image') :
+    '''Load the network and setup the handle to the shared scene.'''
+    global _workerNetwork, _workerScene, _workerDense, _workerNorm
+    from nn.net import ClassifierNetwork
+    from dataset.ingest.pipeline import slotView
+    from dataset.reader import preloadDecoders
+    preloadDecoders()
+    _workerNetwork = ClassifierNetwork(filepath)
+    _workerScene = raw if isinstance(raw, str) else \
+                   slotView(raw, sceneShape, dtype)
+    _workerDense = dense
+    _workerNorm = norm
+
+def _classifyTileWorker(tile) :
+    '''Classify a tile of the shared scene. The tile is read along with its
+       halo, so the returned maps are exactly the tile's output pixels.
+    '''
+    from nn.classifierUtils import createClassMap, createDenseClassMap
+    row, col, numRows, numCols = tile
+    winRows, winCols = _workerNetwork.getNetworkInputSize()[-2:]
+    if isinstance(_workerScene, str) :
+        from dataset.reader import readImageRegion
+        region = readImageRegion(_workerScene,
+                                 (row, row + numRows + winRows - 1),
+                                 (col, col + numCols + winCols - 1),
+                                 norm=_workerNorm)
+    else :
+        region = _workerScene[:, row:row + numRows + winRows - 1,
+                                 col:col + numCols + winCols - 1]
+    if _workerDense :
+        classifications, confidence = createDenseClassMap(
+            _workerNetwork, region, max(numRows, numCols))
+    else :
+        classifications, confidence = createClassMap(_workerNetwork, region)
+    return tile, classifications, confidence
+
+def classifyScene(filepath, image, workers=None, tileSize=256, dense=False,
+                  log=None, norm='image') :
+    '''Create the classification and confidence maps of createClassMap by
+       classifying overlapping tiles of the scene in a pool of processes.
+       Each process holds its own network, which avoids sharing the
+       internal state of a network between threads.
+
+       NOTE: Each worker compiles the network on its first tile. When using
+             a GPU, set the theano device so the workers do not contend for
+             the same device.
+
+       NOTE: When image is the path of a NITF or SICD, each worker reads
+             only its tiles from disk, so the memory used is proportional to
+             the tile size rather than the scene. The 'image' normalization
+             is computed over the whole scene first, so every tile shares
+             the same transform. Other formats are decoded into memory.
+
+       filepath : Path to the pre-trained ClassifierNetwork synapse
+       image    : image to classify (numChannels, numRows, numCols), or the
+                  path to the image
+       workers  : Number of worker processes. Defaults to the cpu count
+       tileSize : number of output pixels along each side of a tile
+       dense    : Classify each tile with the fully-convolutional network
+       log      : Logger to use
+       norm     : Normalization of a scene read from disk, as in
+                  reader.readImage
+
+       return   : numpy.ndarray(classification), numpy.ndarray(confidence)
+    '''
+    import multiprocessing
+    from time import time
+    from multiprocessing.sharedctypes import RawArray
+    from dataset.ingest.pipeline import slotView
+    from nn.net import ClassifierNetwork
+    from nn.classifierUtils import _verifyShape
+    from dataset.reader import readImage, getImageDims, \
+                               supportsRegionReads, imageNormalization
+
+    if workers is None :
+        workers = multiprocessing.cpu_count()
+    if isinstance(image, str) and not supportsRegionReads(image) :
+        image = readImage(image, log, norm=norm)
+    elif isinstance(image, str) and norm == 'image' :
+        # tiles normalized on their own would leave seams in the maps
+        norm = imageNormalization(image, log)
+    sceneShape = tuple(getImageDims(image)) if isinstance(image, str) else \
+                 image.shape
+
+    # verify the sizing against the network before spawning the workers
+    winRows, winCols = _verifyShape(ClassifierNetwork(filepath),
+                                    sceneShape)[-2:]
+    featureShape = (sceneShape[1] - winRows + 1,
+                    sceneShape[2] - winCols + 1)
+    tiles = tileGrid(featureShape, tileSize)
+
+    # copy the scene into shared memory for the workers --
+    # a scene on disk is instead read a tile at a time by each worker.
+    if isinstance(image, str) :
+        raw, dtype = image, None
+    else :
+        dtype = np.dtype(image.dtype)
+        raw = RawArray(dtype.char, int(np.prod(image.shape)))
+        slotView(raw, image.shape, dtype)[:] = image
+
+    classifications = np.ndarray(featureShape, dtype='int32')
+    confidence = np.ndarray(featureShape)
+
+    if log is not None :
+        log.info('Classifying [' + str(len(tiles)) + '] tiles with [' +
+                 str(workers) + '] workers')
+
+    timer = time()
+    pool = multiprocessing.Pool(workers, _initTileWorker,
+                                (filepath, raw, sceneShape, dtype, dense,
+                                 norm))
+    try :
+        # stitch each tile into the maps as it completes
+        for tile, tileClass, tileConf in \
+            pool.imap_unordered(_classifyTileWorker, tiles) :
+            row, col, numRows, numCols = tile
+            classifications[row:row+numRows, col:col+numCols] = tileClass
+            confidence[row:row+numRows, col:col+numCols] = tileConf
+        pool.close()
+    except :
+        pool.terminate()
+        raise
+    finally :
+        pool.join()
+    elapsed = time() - timer
+
+    if log is not None :
+        log.info('Classified [' + str(len(tiles)) + '] tiles in ' +
+                 str(elapsed) + 's - ' + str(len(tiles) / elapsed) +
+                 ' tiles/s')
+    return classifications, confidence
@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+
+class TestDenseClassMap (unittest.TestCase) :
+    '''The fully-convolutional network must reproduce the maps of the
+       sliding-window search, including across tile boundaries.
+    '''
+    def _network(self) :
+        from numpy.random import RandomState
+        from nn.net import ClassifierNetwork
+        from nn.convolutionalLayer import ConvolutionalLayer
+        from nn.contiguousLayer import ContiguousLayer
+        rng = RandomState(0)
+        network = ClassifierNetwork()
+        network.addLayer(ConvolutionalLayer(
+            layerID='c1', inputSize=(8, 2, 12, 12), kernelSize=(3, 2, 3, 3),
+            downsampleFactor=(2, 2), randomNumGen=rng))
+        outputSize = network.getNetworkOutputSize()
+        network.addLayer(ContiguousLayer(
+            layerID='f2', inputSize=(outputSize[0],
+                                     int(np.prod(outputSize[1:]))),
+            numNeurons=6, randomNumGen=rng))
+        network.addLayer(ContiguousLayer(
+            layerID='f3', inputSize=network.getNetworkOutputSize(),
+            numNeurons=4, randomNumGen=rng))
+        return network
+
+    def test_denseMatchesSlidingWindow(self) :
+        import theano
+        from nn.classifierUtils import createClassMap, createDenseClassMap
+        network = self._network()
+        image = np.random.RandomState(1).uniform(
+            size=(2, 29, 34)).astype(theano.config.floatX)
+
+        classMap, confMap = createClassMap(network, image)
+        for tileSize in (4, 8, 256) :
+            denseClass, denseConf = createDenseClassMap(network, image,
+                                                        tileSize)
+            np.testing.assert_array_equal(denseClass, classMap)
+            np.testing.assert_allclose(denseConf, confMap, rtol=1e-4,
+                                       atol=1e-5)
+
+if __name__ == '__main__' :
+    unittest.main()
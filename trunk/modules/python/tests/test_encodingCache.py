@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+class TestIndexCache (unittest.TestCase) :
+    '''A similarity index restored from the cache must answer as the index
+       it was built from, without copying the memory mapped encodings.
+    '''
+    def setUp(self) :
+        from ae.similarity import normalizeRows
+        self.root = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.encodings = normalizeRows(rng.randn(500, 16))
+        self.queries = rng.randn(7, 16)
+        self.filepath = os.path.join(self.root, 'net_targets_unit.npy')
+
+    def tearDown(self) :
+        shutil.rmtree(self.root)
+
+    def test_restoreIndex(self) :
+        from ae.similarity import createIndex
+        from ae.encodingCache import readEncodings, writeEncodings, \
+                                     readIndex, writeIndex
+        writeEncodings(self.filepath, self.encodings)
+        enc = readEncodings(self.filepath)
+        for indexType, indexArgs in (('exact', {}),
+                                     ('ivf', {'numLists' : 10}),
+                                     ('lsh', {'numBits' : 6})) :
+            self.assertIsNone(readIndex(self.filepath, enc, indexType,
+                                        indexArgs))
+            built = createIndex(enc, indexType, normalized=True, **indexArgs)
+            self.assertIs(built.getVectors(), enc)
+            writeIndex(self.filepath, built, indexType, indexArgs)
+
+            index = readIndex(self.filepath, enc, indexType, indexArgs)
+            self.assertIs(index.getVectors(), enc)
+            for expected, actual in zip(built.query(self.queries, 5),
+                                        index.query(self.queries, 5)) :
+                np.testing.assert_array_equal(actual, expected)
+            np.testing.assert_allclose(index.getMeanVector(),
+                                       built.getMeanVector())
+
+    def test_seededIndexNotCached(self) :
+        from ae.similarity import createIndex
+        from ae.encodingCache import writeEncodings, readIndex, writeIndex
+        writeEncodings(self.filepath, self.encodings)
+        indexArgs = {'rng' : np.random.RandomState(1)}
+        writeIndex(self.filepath, createIndex(self.encodings, 'ivf',
+                                              **indexArgs), 'ivf', indexArgs)
+        self.assertIsNone(readIndex(self.filepath, self.encodings, 'ivf',
+                                    indexArgs))
+        self.assertEqual(os.listdir(self.root), ['net_targets_unit.npy'])
+
+if __name__ == '__main__' :
+    unittest.main()
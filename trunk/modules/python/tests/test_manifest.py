@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+class TestPlanUpdate (unittest.TestCase) :
+    '''The plan keeps the slots of unchanged files, decodes only changed
+       contents, and fills every slot of the complete mini-batches.
+    '''
+    def setUp(self) :
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self) :
+        shutil.rmtree(self.root)
+
+    def _writeFile(self, name, contents) :
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f :
+            f.write(contents)
+        return path
+
+    def _plan(self, manifest, paths) :
+        from dataset.manifest import planUpdate
+        return planUpdate(manifest, paths, [0] * len(paths), 4, 2)
+
+    def _checkSlots(self, manifest, numBatches) :
+        assigned = manifest.slots[manifest.slots >= 0]
+        self.assertEqual(sorted(assigned), list(range(numBatches * 4)))
+
+    def test_plan(self) :
+        from dataset.manifest import Manifest
+        paths = [self._writeFile(str(ii), str(ii).encode('ascii')) \
+                 for ii in range(10)]
+        manifest = Manifest()
+        numBatches, moves = self._plan(manifest, paths)
+        self.assertEqual((numBatches, moves), (2, []))
+        self._checkSlots(manifest, numBatches)
+        manifest.done[manifest.slots >= 0] = True
+        slots = dict(zip(manifest.paths, manifest.slots))
+
+        # unchanged, and touched but identical, files keep their slots
+        st = os.stat(paths[0])
+        os.utime(paths[0], (st.st_atime, st.st_mtime + 10))
+        numBatches, moves = self._plan(manifest, paths)
+        self.assertEqual((numBatches, moves), (2, []))
+        self.assertEqual(dict(zip(manifest.paths, manifest.slots)), slots)
+        self.assertEqual(int(np.sum(manifest.done)), 8)
+
+        # changed contents are decoded again in place
+        changed = [p for p in paths if slots[p] == 3][0]
+        self._writeFile(os.path.basename(changed), b'changed')
+        os.utime(changed, (st.st_atime, st.st_mtime + 20))
+        numBatches, moves = self._plan(manifest, paths)
+        entry = manifest.paths.index(changed)
+        self.assertEqual(manifest.slots[entry], 3)
+        self.assertFalse(manifest.done[entry])
+        self.assertEqual(int(np.sum(manifest.done)), 7)
+
+    def test_removeAndAdd(self) :
+        from dataset.manifest import Manifest
+        paths = [self._writeFile(str(ii), str(ii).encode('ascii')) \
+                 for ii in range(12)]
+        manifest = Manifest()
+        self._plan(manifest, paths)
+        manifest.done[:] = True
+        slots = dict(zip(manifest.paths, manifest.slots))
+
+        # removing files shrinks the split, and the examples beyond the
+        # capacity move into the vacated slots
+        removed = [p for p in paths if slots[p] in (1, 6)]
+        paths = [p for p in paths if p not in removed]
+        numBatches, moves = self._plan(manifest, paths)
+        self.assertEqual(numBatches, 2)
+        self._checkSlots(manifest, numBatches)
+        self.assertEqual(sorted(dst for src, dst in moves), [1, 6])
+        self.assertTrue(all(src >= 8 for src, dst in moves))
+        self.assertTrue(np.all(manifest.done[manifest.slots >= 0]))
+
+        # new files fill the next mini-batch and are outstanding
+        paths += [self._writeFile('new' + str(ii), b'new' + str(ii).encode(
+                      'ascii')) for ii in range(2)]
+        numBatches, moves = self._plan(manifest, paths)
+        self.assertEqual((numBatches, moves), (3, []))
+        self._checkSlots(manifest, numBatches)
+        for ii in range(2) :
+            entry = manifest.paths.index(paths[-1 - ii])
+            self.assertGreaterEqual(manifest.slots[entry], 8)
+            self.assertFalse(manifest.done[entry])
+
+class TestUpdateSplit (unittest.TestCase) :
+    '''An incremental build decodes only the outstanding examples, and the
+       file matches a build from scratch slot for slot.
+    '''
+    def setUp(self) :
+        self.root = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self) :
+        shutil.rmtree(self.root)
+
+    def _writeImage(self, label, name) :
+        from PIL import Image
+        path = os.path.join(self.root, label)
+        if not os.path.isdir(path) :
+            os.makedirs(path)
+        path = os.path.join(path, name + '.png')
+        Image.fromarray(self.rng.randint(0, 255, (6, 5)).astype(np.uint8)) \
+             .save(path)
+        return path
+
+    def _build(self) :
+        '''Build the dataset, counting the images decoded.'''
+        import dataset.reader
+        from dataset.ingest.labeled import hdf5Dataset
+        readImage = dataset.reader.readImage
+        decoded = []
+        def countingRead(image, *args, **kwargs) :
+            decoded.append(image)
+            return readImage(image, *args, **kwargs)
+        dataset.reader.readImage = countingRead
+        try :
+            filepath = hdf5Dataset(self.root, holdoutPercentage=0., minTest=0,
+                                   batchSize=4)
+        finally :
+            dataset.reader.readImage = readImage
+        return filepath, decoded
+
+    def _verify(self, filepath) :
+        import h5py
+        from dataset.reader import readImage
+        with h5py.File(filepath, mode='r') as hdf5 :
+            group = hdf5['manifest/train']
+            dataH5 = hdf5['train/data']
+            slots = group['slot'][...]
+            self.assertTrue(np.all(group['done'][...][slots >= 0]))
+            self.assertEqual(sorted(slots[slots >= 0]),
+                             list(range(dataH5.shape[0] * dataH5.shape[1])))
+            for path, slot in zip(group['path'][...], slots) :
+                if slot < 0 :
+                    continue
+                path = path.decode('utf-8') if isinstance(path, bytes) \
+                       else path
+                batch, example = divmod(int(slot), dataH5.shape[1])
+                np.testing.assert_allclose(dataH5[batch, example],
+                                           readImage(path))
+
+    def test_incremental(self) :
+        paths = [self._writeImage(label, label + str(ii)) \
+                 for label in ('a', 'b') for ii in range(7)]
+        filepath, decoded = self._build()
+        self.assertEqual(len(decoded), 12)
+        self._verify(filepath)
+
+        # nothing changed
+        filepath, decoded = self._build()
+        self.assertEqual(decoded, [])
+
+        # the two unassigned files and two new files fill a mini-batch
+        added = [self._writeImage('b', 'added' + str(ii)) for ii in range(2)]
+        filepath, decoded = self._build()
+        self.assertEqual(len(decoded), 4)
+        self.assertTrue(set(added) <= set(decoded))
+        self._verify(filepath)
+
+        # a changed file is decoded again
+        st = os.stat(paths[5])
+        self.rng = np.random.RandomState(1)
+        self._writeImage('a', 'a5')
+        os.utime(paths[5], (st.st_atime, st.st_mtime + 10))
+        filepath, decoded = self._build()
+        self.assertEqual(decoded, [paths[5]])
+        self._verify(filepath)
+
+        # a removed file is replaced by moving an existing example
+        os.remove(paths[0])
+        filepath, decoded = self._build()
+        self.assertEqual(decoded, [])
+        self._verify(filepath)
+
+if __name__ == '__main__' :
+    unittest.main()
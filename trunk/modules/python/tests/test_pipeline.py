@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+
+class UnpicklableError (Exception) :
+    '''An error which cannot be returned from a worker process.'''
+    def __init__ (self) :
+        Exception.__init__(self, 'unpicklable')
+        self.callback = lambda : None
+
+class TestIngestBatches (unittest.TestCase) :
+    '''The ordered pipeline writes each batch to its slice regardless of the
+       order the decoders complete, and reports failed decoders.
+    '''
+    def setUp(self) :
+        from PIL import Image
+        self.root = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.images = []
+        for ii in range(24) :
+            path = os.path.join(self.root, str(ii) + '.png')
+            Image.fromarray(rng.randint(0, 255, (6, 5)).astype(np.uint8)) \
+                 .save(path)
+            self.images.append(path)
+
+    def tearDown(self) :
+        shutil.rmtree(self.root)
+
+    def _ingest(self, timeout=60., **kwargs) :
+        '''Run the ingest, failing rather than hanging should it block.'''
+        from dataset.ingest.pipeline import ingestBatches
+        data = np.zeros((6, 4, 1, 6, 5), dtype=np.float32)
+        result = {}
+        def run() :
+            try :
+                ingestBatches(data, self.images, 6, data.shape[1:],
+                              data.dtype, **kwargs)
+            except Exception as ex :
+                result['error'] = ex
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), 'The ingest did not complete.')
+        return data, result.get('error')
+
+    def _expected(self) :
+        from dataset.reader import readImage
+        return np.reshape([readImage(p) for p in self.images],
+                          (6, 4, 1, 6, 5))
+
+    def test_order(self) :
+        commits = []
+        data, error = self._ingest(workers=4, commit=commits.append)
+        self.assertIsNone(error)
+        np.testing.assert_allclose(data, self._expected())
+        self.assertEqual(commits, list(range(6)))
+
+    def test_backpressure(self) :
+        # a single staging slot serializes the decoders without deadlock
+        data, error = self._ingest(workers=4, numSlots=1)
+        self.assertIsNone(error)
+        np.testing.assert_allclose(data, self._expected())
+
+    def test_processEngine(self) :
+        data, error = self._ingest(workers=2, engine='process')
+        self.assertIsNone(error)
+        np.testing.assert_allclose(data, self._expected())
+
+    def test_failedDecoder(self) :
+        os.remove(self.images[9])
+        data, error = self._ingest(workers=2)
+        self.assertIsInstance(error, IOError)
+
+    def test_unpicklableWorkerError(self) :
+        # the worker's result cannot be returned to the parent, so only the
+        # pool's error callback can wake the writer
+        import dataset.reader
+        readImage = dataset.reader.readImage
+        def failingRead(image, *args, **kwargs) :
+            if image == self.images[9] :
+                raise UnpicklableError()
+            return readImage(image, *args, **kwargs)
+        dataset.reader.readImage = failingRead
+        try :
+            data, error = self._ingest(workers=2, engine='process')
+        finally :
+            dataset.reader.readImage = readImage
+        self.assertIsNotNone(error)
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+import numpy as np
+
+class TestStorePixels (unittest.TestCase) :
+    '''Decoded pixels are stored without wrapping or overflowing the compact
+       storage types.
+    '''
+    def test_float16Saturation(self) :
+        from dataset.reader import storePixels
+        out = np.zeros(4, dtype=np.float16)
+        with warnings.catch_warnings() :
+            warnings.simplefilter('error')
+            storePixels(out, np.array([1e6, -1e6, 1.5, 65504.],
+                                      dtype=np.float32))
+        limit = np.finfo(np.float16).max
+        np.testing.assert_array_equal(out, [limit, -limit, 1.5, 65504.])
+
+    def test_uint8Rejected(self) :
+        from dataset.reader import storePixels
+        out = np.zeros(3, dtype=np.uint8)
+        for dtype in (np.uint16, np.int8, np.float32) :
+            self.assertRaises(ValueError, storePixels, out,
+                              np.array([1, 2, 3], dtype=dtype))
+        storePixels(out, np.array([0, 128, 255], dtype=np.uint8))
+        np.testing.assert_array_equal(out, [0, 128, 255])
+
+class TestQuantizedDataset (unittest.TestCase) :
+    '''The dequantized compact storage must recover the floatX dataset.'''
+    def setUp(self) :
+        from PIL import Image
+        self.root = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        for label in ('a', 'b') :
+            os.makedirs(os.path.join(self.root, label))
+            for ii in range(8) :
+                Image.fromarray(rng.randint(0, 256, (6, 5, 3))
+                                   .astype(np.uint8)) \
+                     .save(os.path.join(self.root, label,
+                                        label + str(ii) + '.png'))
+
+    def tearDown(self) :
+        shutil.rmtree(self.root)
+
+    def _build(self, storage, normalization) :
+        '''Return the dequantized training examples ordered by file, and the
+           stored type.
+        '''
+        import h5py
+        from dataset.ingest.labeled import hdf5Dataset
+        from dataset.quantize import getQuantization, dequantize
+        filepath = hdf5Dataset(self.root, holdoutPercentage=0., minTest=0,
+                               batchSize=4, storage=storage,
+                               normalization=normalization)
+        with h5py.File(filepath, mode='r') as hdf5 :
+            dataH5 = hdf5['train/data']
+            quant = getQuantization(dataH5)
+            data = dataH5[...]
+            group = hdf5['manifest/train']
+            slots = group['slot'][...][np.argsort(group['path'][...])]
+        data = np.reshape(data, (-1,) + data.shape[2:])
+        return (data if quant is None else dequantize(data, quant))[slots], \
+               data.dtype
+
+    def test_uint8(self) :
+        expected, dtype = self._build('floatX', 'dataset')
+        actual, dtype = self._build('uint8', 'dataset')
+        self.assertEqual(dtype, np.uint8)
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
+    def test_float16(self) :
+        for normalization in ('image', 'dataset') :
+            expected, dtype = self._build('floatX', normalization)
+            actual, dtype = self._build('float16', normalization)
+            self.assertEqual(dtype, np.float16)
+            np.testing.assert_allclose(actual, expected, rtol=1e-3,
+                                       atol=1e-3)
+
+    def test_uint8ImageNormalization(self) :
+        from dataset.ingest.labeled import hdf5Dataset
+        self.assertRaises(ValueError, hdf5Dataset, self.root,
+                          holdoutPercentage=0., minTest=0, batchSize=4,
+                          storage='uint8', normalization='image')
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+class TestShuffleManifest (unittest.TestCase) :
+    '''An incremental build after hdf5Shuffle must find each file at the
+       slot its example was moved to.
+    '''
+    def setUp(self) :
+        self.root = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self) :
+        shutil.rmtree(self.root)
+
+    def _writeImage(self, label, name) :
+        from PIL import Image
+        path = os.path.join(self.root, label)
+        if not os.path.isdir(path) :
+            os.makedirs(path)
+        Image.fromarray(self.rng.randint(0, 255, (6, 5)).astype(np.uint8)) \
+             .save(os.path.join(path, name + '.png'))
+
+    def _verify(self, filepath) :
+        import h5py
+        from dataset.reader import readImage
+        with h5py.File(filepath, mode='r') as hdf5 :
+            labels = [l.decode('utf-8') if isinstance(l, bytes) else l \
+                      for l in hdf5['labels'][...]]
+            group = hdf5['manifest/train']
+            dataH5, indicesH5 = hdf5['train/data'], hdf5['train/indices']
+            batchSize = dataH5.shape[1]
+            for path, slot in zip(group['path'][...], group['slot'][...]) :
+                if slot < 0 :
+                    continue
+                path = path.decode('utf-8') if isinstance(path, bytes) \
+                       else path
+                batch, example = divmod(int(slot), batchSize)
+                np.testing.assert_allclose(dataH5[batch, example],
+                                           readImage(path))
+                self.assertEqual(labels[indicesH5[batch, example]],
+                                 os.path.basename(os.path.dirname(path)))
+
+    def test_rebuildAfterShuffle(self) :
+        from dataset.ingest.labeled import hdf5Dataset
+        from dataset.shuffle import hdf5Shuffle
+        for label in ('a', 'b') :
+            for ii in range(16) :
+                self._writeImage(label, label + str(ii))
+        filepath = hdf5Dataset(self.root, holdoutPercentage=0., minTest=0,
+                               batchSize=4)
+        self._verify(filepath)
+
+        hdf5Shuffle(filepath, rng=np.random.RandomState(1))
+        self._verify(filepath)
+
+        self._writeImage('a', 'added')
+        self.assertEqual(filepath, hdf5Dataset(
+            self.root, holdoutPercentage=0., minTest=0, batchSize=4))
+        self._verify(filepath)
+
+    def test_interruptedShuffle(self) :
+        import h5py
+        import dataset.shuffle
+        from dataset.ingest.labeled import hdf5Dataset
+        for label in ('a', 'b') :
+            for ii in range(16) :
+                self._writeImage(label, label + str(ii))
+        filepath = hdf5Dataset(self.root, holdoutPercentage=0., minTest=0,
+                               batchSize=4)
+
+        # fail part way through the gather, once examples are overwritten
+        writeExamples = dataset.shuffle.writeExamples
+        calls = []
+        def failingWrite(*args) :
+            calls.append(args)
+            if len(calls) > 2 :
+                raise KeyboardInterrupt()
+            writeExamples(*args)
+        dataset.shuffle.writeExamples = failingWrite
+        try :
+            self.assertRaises(KeyboardInterrupt, dataset.shuffle.hdf5Shuffle,
+                              filepath, memory=2**12,
+                              rng=np.random.RandomState(1))
+        finally :
+            dataset.shuffle.writeExamples = writeExamples
+        with h5py.File(filepath, mode='r') as hdf5 :
+            self.assertFalse(np.any(hdf5['manifest/train/done'][...]))
+
+        # the next update decodes the outstanding examples again
+        self.assertEqual(filepath, hdf5Dataset(
+            self.root, holdoutPercentage=0., minTest=0, batchSize=4))
+        self._verify(filepath)
+        with h5py.File(filepath, mode='r') as hdf5 :
+            self.assertTrue(np.all(hdf5['manifest/train/done'][...]))
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import numpy as np
+
+class TestChannelStats (unittest.TestCase) :
+    '''The streamed and merged statistics must match the statistics of the
+       whole set computed at once.
+    '''
+    def setUp(self) :
+        rng = np.random.RandomState(0)
+        # offset channels of differing scale, which stress the precision
+        self.data = (rng.randn(12, 5, 3, 7, 6) *
+                     np.array([1., 10., 1e-3]).reshape(3, 1, 1) +
+                     np.array([0., 1e4, -5.]).reshape(3, 1, 1)) \
+                    .astype(np.float32)
+
+    def _expected(self, data) :
+        data = data.astype(np.float64)
+        return np.mean(data, axis=(0, 1, 3, 4)), np.std(data,
+                                                         axis=(0, 1, 3, 4))
+
+    def test_update(self) :
+        from dataset.statistics import ChannelStats
+        stats = ChannelStats(3)
+        for batch in self.data :
+            stats.update(batch)
+        mean, std = self._expected(self.data)
+        self.assertEqual(stats.count, 12 * 5 * 7 * 6)
+        np.testing.assert_allclose(stats.mean, mean, rtol=1e-10)
+        np.testing.assert_allclose(stats.std(), std, rtol=1e-8)
+
+    def test_merge(self) :
+        from dataset.statistics import ChannelStats
+        # uneven partial statistics, including an empty one
+        parts = [ChannelStats(3) for ii in range(4)]
+        for batch, part in zip(self.data, [0, 0, 1, 2, 2, 2, 2, 2, 2, 2,
+                                           2, 0]) :
+            parts[part].update(batch)
+        stats = ChannelStats(3)
+        for part in parts :
+            stats.merge(part)
+        mean, std = self._expected(self.data)
+        self.assertEqual(stats.count, 12 * 5 * 7 * 6)
+        np.testing.assert_allclose(stats.mean, mean, rtol=1e-10)
+        np.testing.assert_allclose(stats.std(), std, rtol=1e-8)
+
+    def test_constantChannel(self) :
+        from dataset.statistics import ChannelStats, standardize
+        data = np.ones((4, 2, 3, 3), dtype=np.float32)
+        data[:, 1] = np.arange(4).reshape(4, 1, 1)
+        stats = ChannelStats(2)
+        stats.update(data[:2])
+        stats.update(data[2:])
+        np.testing.assert_allclose(stats.std(), [1., np.std(np.arange(4))])
+        out = standardize(data, (stats.mean, stats.std()))
+        np.testing.assert_allclose(out[:, 0], 0.)
+        np.testing.assert_allclose(np.mean(out[:, 1]), 0., atol=1e-6)
+        np.testing.assert_allclose(np.std(out[:, 1]), 1., rtol=1e-6)
+
+if __name__ == '__main__' :
+    unittest.main()
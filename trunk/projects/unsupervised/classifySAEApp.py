@@ -2,10 +2,39 @@ import argparse
 from dataset.ingest.labeled import ingestImagery
 from nn.profiler import setupLogging, Profiler
 
-def createNetworks(target, netFiles, prof) :
-    '''Read and create each network initialized with the target dataset.'''
+def createNetworks(target, netFiles, prof, cacheDir=None) :
+    '''Read and create each network initialized with the target dataset.
+       The target encodings of each network are cached in cacheDir.
+    '''
     from ae.net import ClassifierSAENetwork
-    return [ClassifierSAENetwork(target, syn, prof) for syn in netFiles]
+    return [ClassifierSAENetwork(target, syn, prof, cacheDir=cacheDir) \
+            for syn in netFiles]
+
+def scoreEnsemble(netList, imagery) :
+    '''Score each image as the mean closeness across all of the networks.
+       The responses accumulate in place into a preallocated array.
+
+       netList : List of ClassifierSAENetwork
+       imagery : Batched imagery (numBatches, batchSize, channels, rows, cols)
+       return  : numpy.ndarray of similarities (numBatches, batchSize)
+    '''
+    import numpy as np
+    sims = np.zeros(imagery.shape[:2], dtype=np.float32)
+    for ii, batch in enumerate(imagery) :
+        for net in netList :
+            net.closeness(batch, sims[ii])
+    sims /= float(len(netList))
+    return sims
+
+def topK(values, k) :
+    '''Return the indices of the k largest values, ordered high to low.'''
+    import numpy as np
+    k = max(0, min(k, values.size))
+    if k == 0 :
+        return np.zeros((0,), dtype=np.int64)
+    top = np.argpartition(-values, k - 1)[:k] if k < values.size else \
+          np.arange(values.size)
+    return top[np.argsort(-values[top], kind='mergesort')]
 
 def sortDataset(netList, imagery, percentile=.95, debug=False) :
     '''Test the imagery for how close it is to the target data. This also sorts
@@ -14,27 +43,18 @@ def sortDataset(netList, imagery, percentile=.95, debug=False) :
     from dataset.debugger import saveTiledImage
     import numpy as np
     import math
-    sims = []
     batchSize = imagery.shape[1]
-    for ii, batch in enumerate(imagery) :
-        # average the results found by multiple networks
-        cos = np.zeros((batchSize,), dtype=np.float32)
-        [net.closeness(batch, cos) for net in nets]
-        sims.append(cos / float(len(nets)))
 
-    # rank their closeness from high to low
-    sims = [(ii // batchSize, ii % batchSize, sim) \
-            for ii, sim in enumerate(np.concatenate(sims))]
-    sims = sorted(sims, key=lambda x: x[-1], reverse=True)
+    # average the results found by multiple networks
+    sims = scoreEnsemble(netList, imagery).reshape(-1)
+
+    # rank the most likely matches from high to low
+    numImages = int((1.-percentile) * sims.size)
+    ranked = topK(sims, numImages)
 
-    # reorder the imagery to match the ranking
-    numImages = int((1.-percentile) * np.prod(imagery.shape[:2]))
-    sortedImagery = np.zeros([numImages] + list(imagery.shape[-3:]),
-                             dtype=imagery.dtype)
-    sortedConfidence = np.zeros([numImages], dtype=np.float32)
-    for counter, (ii, jj, sim) in enumerate(sims[:numImages]) :
-        sortedImagery[counter][:] = imagery[ii][jj][:]
-        sortedConfidence[counter] = sim
+    # gather the imagery to match the ranking
+    sortedImagery = np.reshape(imagery, (-1,) + imagery.shape[-3:])[ranked]
+    sortedConfidence = sims[ranked]
 
     # dump the ranked result as a series of batches
     if debug :
@@ -81,6 +101,9 @@ if __name__ == '__main__' :
                         help='Load from a previously saved network.')
     parser.add_argument('--debug', dest='debug', type=bool, required=False,
                         help='Drop debugging information about the runs.')
+    parser.add_argument('--cache', dest='cacheDir', type=str,
+                        default='./saeEncodingCache',
+                        help='Directory to cache the encoded target data.')
     parser.add_argument('data', help='Directory of input imagery.')
     options = parser.parse_args()
 
@@ -95,7 +118,8 @@ if __name__ == '__main__' :
                                         batchSize=options.batchSize, log=log)
 
     # load all networks initialized to the target imagery
-    nets = createNetworks(options.targetDir, options.synapse, prof)
+    nets = createNetworks(options.targetDir, options.synapse, prof,
+                          options.cacheDir)
 
     # test the training data for similarity to the target
     sortDataset(nets, test[0].get_value(borrow=True), 
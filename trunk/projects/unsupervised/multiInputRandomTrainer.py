@@ -102,6 +102,11 @@ if __name__ == '__main__' :
                         help='Number of epochs to run per layer.')
     parser.add_argument('--numChips', dest='numChips', type=int, default=1000,
                         help='Number of epochs to run per layer.')
+    parser.add_argument('--shuffle', dest='shuffleSize', type=int,
+                        default=0,
+                        help='Number of chips in the ingest shuffle ' +
+                             'reservoir. This mixes the chips across images, ' +
+                             'and is limited to the available memory.')
     parser.add_argument('--epoch', dest='numEpochs', type=int, default=15,
                         help='Number of epochs to run per layer.')
     parser.add_argument('--batch', dest='batchSize', type=int, default=100,
@@ -123,9 +128,10 @@ if __name__ == '__main__' :
     #       one exists (for efficiency). So watch out for stale pickles!
     chipArgs = {'chipSize': options.chipSize, 
                 'numChips': options.numChips}
-    train = ingestImagery(filepath=options.data, shared=True,
+    train = ingestImagery(filepaths=options.data, shared=True,
                           batchSize=options.batchSize, 
-                          log=log, chipFunc=randomChip, kwargs=chipArgs)
+                          log=log, chipFunc=randomChip,
+                          shuffleSize=options.shuffleSize, kwargs=chipArgs)
 
     if options.synapse is not None :
         # load a previously saved network